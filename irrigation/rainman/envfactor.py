@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+	Calculate environmental factors.
+
+	An EnvGroup's factor for a History entry is an inverse-distance
+	weighted average of its EnvItems' factors, for each combination of
+	temperature, wind and sunshine, and then a weighted product of those.
+
+	The EnvItems are loaded once per group; results are remembered per
+	history entry, so that valves sharing a group don't recalculate them.
+	"""
+
+from array import array
+
+P = 4 # power factor, favoring nearest-neighbor
+
+# weight, (temp,wind,sun)
+QL = (
+	(6,(True,True,True)),
+	(4,(False,True,True)),
+	(4,(True,False,True)),
+	(4,(True,True,False)),
+	(1,(True,False,False)),
+	(1,(False,True,False)),
+	(1,(False,False,True)),
+	)
+
+MAX_CACHE = 200000 # per group
+
+class _Points(object):
+	"""The reference points for one combination of parameters"""
+	def __init__(self, tws, items):
+		self.tws = tws
+		self.cols = [array('d') for x in tws if x]
+		self.factors = array('d')
+		for it in items:
+			v = (it.temp,it.wind,it.sun)
+			if any((x is None) == t for x,t in zip(v,tws)):
+				continue
+			c = iter(self.cols)
+			for x,t in zip(v,tws):
+				if t:
+					next(c).append(x)
+			self.factors.append(it.factor)
+
+	def factor(self, h):
+		"""Returns the weighted factor for @h, or None"""
+		v = []
+		for x,t in zip((h.temp,h.wind,h.sun),self.tws):
+			if t:
+				if x is None:
+					return None
+				v.append(x)
+		if not self.factors:
+			return None
+		if len(v) == 1:
+			a, = v
+			dd = [(a-x)**2 for x in self.cols[0]]
+		elif len(v) == 2:
+			a,b = v
+			dd = [(a-x)**2+(b-y)**2 for x,y in zip(*self.cols)]
+		else:
+			a,b,c = v
+			dd = [(a-x)**2+(b-y)**2+(c-z)**2 for x,y,z in zip(*self.cols)]
+
+		sum_f = 0
+		sum_w = 0
+		for d,f in zip(dd,self.factors):
+			d = d**(P*0.5)
+			if d < 0.001: # close enough
+				return f
+			sum_f += f/d
+			sum_w += 1/d
+		return sum_f / sum_w
+
+class EnvFactors(object):
+	"""The reference points of one EnvGroup, and its results"""
+	def __init__(self, items):
+		items = list(items)
+		self.points = dict((tws,_Points(tws,items)) for _,tws in QL)
+		self.cache = {}
+		self.hits = 0
+		self.misses = 0
+
+	def factor_one(self, tws, h):
+		return self.points[tws].factor(h)
+
+	def factor(self, h, logger=None):
+		"""Calculate a weighted factor for history entry @h"""
+		# the current history entry gets updated, thus check the values
+		key = (h.id,h.temp,h.wind,h.sun)
+		if logger is None:
+			try:
+				res = self.cache[key]
+			except KeyError:
+				pass
+			else:
+				self.hits += 1
+				return res
+		self.misses += 1
+
+		sum_f = 1 # if there are no data, return 1
+		sum_w = 1
+		n = 1
+		for weight,tws in QL:
+			f = self.points[tws].factor(h)
+			if f is not None:
+				if logger:
+					logger("Simple factor %s%s%s: %f" % ("T" if tws[0] else "-", "W" if tws[1] else "-", "S" if tws[2] else "-", f))
+				sum_f *= f**weight
+				sum_w += weight
+				n += 1
+		res = sum_f ** (n/sum_w)
+		if key[0] is not None:
+			if len(self.cache) >= MAX_CACHE:
+				self.cache.clear()
+			self.cache[key] = res
+		return res
+
+	def factors(self, hs):
+		"""Calculate the factors for a sequence of history entries"""
+		return [self.factor(h) for h in hs]
+
+_groups = {}
+
+def env_factors(group):
+	"""Return the (shared) EnvFactors for this EnvGroup"""
+	try:
+		return _groups[group.id]
+	except KeyError:
+		pass
+	res = EnvFactors(group.items.all())
+	if group.id is not None:
+		_groups[group.id] = res
+	return res
+
+def invalidate(group_id=None):
+	"""Forget a group's items and results (or everybody's)"""
+	if group_id is None:
+		_groups.clear()
+	else:
+		_groups.pop(group_id,None)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+	A set of disjoint time ranges.
+
+	This has the same semantics as the range_* functions in rainman.utils
+	(sequences of (start,length) tuples, touching ranges are merged), but
+	keeps the ranges in sorted arrays so that inserting, lookup and
+	intersecting with a small set don't need to walk the whole thing.
+
+	Results which only depend on a group's days and overrides are cached;
+	the cache is cleared whenever one of these changes.
+	"""
+
+from bisect import bisect_left,bisect_right
+
+class IntervalSet(object):
+	"""\
+		A set of disjoint [start,end) ranges.
+
+		Iterating returns (start,length) tuples, in order.
+		Works with anything that can be added and compared, i.e. numbers,
+		or datetime+timedelta.
+		"""
+	def __init__(self, ranges=()):
+		self._s = [] # starts
+		self._e = [] # ends
+		for a,l in ranges:
+			self.add(a,l)
+
+	@classmethod
+	def _new(cls, s,e):
+		res = cls()
+		res._s = s
+		res._e = e
+		return res
+
+	def copy(self):
+		return self._new(self._s[:],self._e[:])
+
+	def __iter__(self):
+		for a,b in zip(self._s,self._e):
+			yield a,b-a
+
+	def __len__(self):
+		return len(self._s)
+
+	def __bool__(self):
+		return bool(self._s)
+	__nonzero__ = __bool__
+
+	def __eq__(self, other):
+		if not isinstance(other,IntervalSet):
+			return NotImplemented
+		return self._s == other._s and self._e == other._e
+	def __ne__(self, other):
+		res = self.__eq__(other)
+		if res is NotImplemented:
+			return res
+		return not res
+
+	def __repr__(self):
+		return "IntervalSet(%r)" % (list(self),)
+
+	def add(self, start, length):
+		"""Add the range [start,start+length)"""
+		end = start+length
+		if end <= start:
+			return
+		i = bisect_left(self._e, start) # first range which ends at or after start
+		j = bisect_right(self._s, end) # ranges which start at or before end
+		if i < j:
+			if self._s[i] < start:
+				start = self._s[i]
+			if self._e[j-1] > end:
+				end = self._e[j-1]
+		self._s[i:j] = [start]
+		self._e[i:j] = [end]
+
+	def remove(self, start, length):
+		"""Remove the range [start,start+length)"""
+		end = start+length
+		if end <= start:
+			return
+		i = bisect_right(self._e, start) # first range which ends after start
+		j = bisect_left(self._s, end) # ranges which start before end
+		s,e = [],[]
+		if i < j:
+			if self._s[i] < start:
+				s.append(self._s[i])
+				e.append(start)
+			if self._e[j-1] > end:
+				s.append(end)
+				e.append(self._e[j-1])
+		self._s[i:j] = s
+		self._e[i:j] = e
+
+	def find(self, t):
+		"""Returns the (start,length) which contains @t, or None"""
+		i = bisect_right(self._s, t)-1
+		if i >= 0 and t < self._e[i]:
+			return self._s[i],self._e[i]-self._s[i]
+		return None
+
+	def __contains__(self, t):
+		return self.find(t) is not None
+
+	def clip(self, start, end):
+		"""Returns the part of this set between @start and @end"""
+		i = bisect_right(self._e, start)
+		j = bisect_left(self._s, end)
+		s = self._s[i:j]
+		e = self._e[i:j]
+		if s:
+			if s[0] < start:
+				s[0] = start
+			if e[-1] > end:
+				e[-1] = end
+		return self._new(s,e)
+
+	def intersection(self, *others):
+		res = self
+		for o in others:
+			if not isinstance(o,IntervalSet):
+				o = IntervalSet(o)
+			res = res._intersect(o)
+		return res
+	__and__ = intersection
+
+	def _intersect(self, other):
+		# Walk the smaller set and look up the pieces of the larger one
+		if len(self) > len(other):
+			self,other = other,self
+		s,e = [],[]
+		for a,b in zip(self._s,self._e):
+			c = other.clip(a,b)
+			s.extend(c._s)
+			e.extend(c._e)
+		return self._new(s,e)
+
+	def union(self, *others):
+		res = self.copy()
+		for o in others:
+			for a,l in o:
+				res.add(a,l)
+		return res
+	__or__ = union
+
+	def invert(self, start, length):
+		"""Returns the parts of [start,start+length) which are not in this set"""
+		end = start+length
+		res = IntervalSet()
+		if end <= start:
+			return res
+		c = self.clip(start,end)
+		s,e = [],[]
+		for a,b in zip(c._s,c._e):
+			if start < a:
+				s.append(start)
+				e.append(a)
+			start = b
+		if start < end:
+			s.append(start)
+			e.append(end)
+		return self._new(s,e)
+
+MAX_CACHE = 10000
+
+_cache = {}
+
+def cached(key, fn, *a):
+	"""Return the IntervalSet for @key, calling fn(*a) if it's not known"""
+	try:
+		return _cache[key]
+	except KeyError:
+		pass
+	if len(_cache) >= MAX_CACHE:
+		_cache.clear()
+	res = fn(*a)
+	if not isinstance(res,IntervalSet):
+		res = IntervalSet(res)
+	_cache[key] = res
+	return res
+
+def invalidate(*a,**k):
+	"""Clear the cache. Usable as a signal receiver."""
+	_cache.clear()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+	Update the water levels of a site's valves.
+
+	The history entries are read once for all valves. The new levels are
+	calculated in memory and written in one transaction: one bulk insert
+	of Level rows and one UPDATE of the valves.
+	"""
+
+from bisect import bisect_right
+from datetime import timedelta
+from rainman.utils import now
+
+def update_levels(site, vids, take_flow, n=None, min_age=None, log=None):
+	"""\
+		Calculate new levels for these valves.
+
+		@take_flow: take_flow(valve id) returns the liters delivered since
+		            the last call, and resets that counter
+		@min_age: skip valves whose level is more recent (seconds)
+		@log: log(valve,text)
+
+		Returns a dict: valve id => (time,level) for each valve whose
+		level has been updated.
+		"""
+	from django.db import transaction
+	from django.db.models import Max,Case,When,Value,FloatField,DateTimeField
+	from rainman.models import Valve,Level
+
+	if log is None:
+		log = lambda v,txt: None
+	if n is None:
+		n = now()
+	vs = list(Valve.objects.filter(id__in=vids).select_related("envgroup").prefetch_related("groups"))
+	if not vs:
+		return {}
+	last = dict(Level.objects.filter(valve__in=vs).values_list("valve").annotate(Max("time")))
+	downdate = {}
+	work = []
+	for v in vs:
+		ts = last.get(v.id,None)
+		if ts is not None and v.time > ts:
+			log(v,"Timestamp downdate: %s %s" % (v.time,ts))
+			v.time = downdate[v.id] = ts
+		if min_age is not None and (n-v.time).total_seconds() < min_age:
+			continue
+		if ts is None:
+			ts = n-timedelta(1,0)
+		work.append((v,ts,take_flow(v.id)))
+
+	hs = []
+	if work:
+		hs = list(site.history.filter(time__gt=min(ts for v,ts,f in work)).order_by("time"))
+	times = [h.time for h in hs]
+
+	res = {}
+	levels = []
+	for v,ts,flow in work:
+		eg = v.envgroup
+		vh = hs[bisect_right(times,ts):]
+		if v.verbose>2:
+			fs = [None]*len(vh)
+		else:
+			fs = eg.env_factor_list(vh)
+		adj = v.adj
+		sum_f = 0
+		sum_r = 0
+		for h,f in zip(vh,fs):
+			if f is None:
+				log(v,"Env factor for %s: T=%s W=%s S=%s"%(h,h.temp,h.wind,h.sun))
+				f = eg.env_factor(h, logger=lambda txt: log(v,txt))
+			f *= adj
+			if v.verbose>1:
+				log(v,"Env factor for %s is %s"%(h,f))
+			sum_f += site.db_rate * v.do_shade(eg.factor*f) * (h.time-ts).total_seconds()
+			sum_r += v.runoff*h.rain
+			ts=h.time
+
+		if v.verbose:
+			log(v,"Apply env %f, rain %r,, flow %f = %f" % (sum_f,sum_r,flow,flow/v.area))
+
+		if v.time == ts:
+			continue
+		level = max(v.level,0) + sum_f
+		if (flow > 0 or sum_r > 0) and v.level > v.max_level:
+			level = v.max_level
+		level -= flow/v.area+sum_r
+		res[v.id] = (ts,level)
+		levels.append(Level(valve=v,time=ts,level=level,flow=flow))
+
+	times = dict(downdate)
+	times.update((id,t) for id,(t,l) in res.items())
+	if not times:
+		return res
+	with transaction.atomic():
+		Level.objects.bulk_create(levels)
+		upd = dict(time=Case(*(When(id=id,then=Value(t)) for id,t in times.items()), output_field=DateTimeField()))
+		if res:
+			upd['level'] = Case(*(When(id=id,then=Value(l)) for id,(t,l) in res.items()), default="level", output_field=FloatField())
+		Valve.objects.filter(id__in=list(times)).update(**upd)
+	return res
@@ -32,6 +32,10 @@ import sys, os, traceback
 
 _me = None
 def log(dev, text):
+	log_entry(dev,text).save()
+
+def log_entry(dev, text):
+	"""Print a log message and return the (unsaved) Log entry for it"""
 	v = c = s = None
 	if isinstance(dev,Valve):
 		v = dev
@@ -52,7 +56,7 @@ def log(dev, text):
 	if _me is None:
 		_me = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 	
-	Log(site=s,controller=c,valve=v, text=text, logger=_me).save()
+	return Log(site=s,controller=c,valve=v, text=text, logger=_me)
 
 def log_error(dev):
 	log(dev,traceback.format_exc())
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+		Benchmark the environmental factor calculation.
+		"""
+
+from django.core.management.base import BaseCommand, CommandError
+from rainman.envfactor import EnvFactors, QL, P
+from collections import namedtuple
+from random import Random
+from time import time
+
+Item = namedtuple("Item","temp wind sun factor")
+Hist = namedtuple("Hist","id temp wind sun")
+
+def synthetic(days, items, seed=1):
+	"""A site's worth of EnvItems and History entries, every 10 minutes"""
+	r = Random(seed)
+	its = []
+	for i in range(items):
+		its.append(Item(
+			r.uniform(-5,35) if i%4 != 1 else None,
+			r.uniform(0,15) if i%4 != 2 else None,
+			r.uniform(0,1) if i%4 != 3 else None,
+			r.uniform(0.2,3)))
+	hs = []
+	for i in range(days*24*6):
+		hs.append(Hist(i+1, r.uniform(-5,35), r.uniform(0,15), r.uniform(0,1)))
+	return its,hs
+
+def old_factor(items, h):
+	"""The former per-entry calculation, for comparison"""
+	sum_f = 1
+	sum_w = 1
+	n = 1
+	for weight,(qtemp,qwind,qsun) in QL:
+		ec = [it for it in items if (it.temp is not None) == qtemp and (it.wind is not None) == qwind and (it.sun is not None) == qsun]
+		sf = 0
+		sw = 0
+		f = None
+		for ef in ec:
+			d=0
+			if qtemp:
+				d += (h.temp-ef.temp)**2
+			if qwind:
+				d += (h.wind-ef.wind)**2
+			if qsun:
+				d += (h.sun-ef.sun)**2
+			d = d**(P*0.5)
+			if d < 0.001:
+				f = ef.factor
+				break
+			sf += ef.factor/d
+			sw += 1/d
+		else:
+			if sw:
+				f = sf/sw
+		if f is not None:
+			sum_f *= f**weight
+			sum_w += weight
+			n += 1
+	return sum_f ** (n/sum_w)
+
+class Command(BaseCommand):
+	help = 'Compare per-valve and shared environmental factor calculation on synthetic data'
+
+	def add_arguments(self, parser):
+		parser.add_argument('-d','--days',
+				action='store',
+				type=int,
+				dest='days',
+				default=365,
+				help='days of history')
+		parser.add_argument('-v','--valves',
+				action='store',
+				type=int,
+				dest='valves',
+				default=100,
+				help='number of valves sharing the group')
+		parser.add_argument('-i','--items',
+				action='store',
+				type=int,
+				dest='items',
+				default=20,
+				help='number of EnvItems')
+		parser.add_argument('-o','--old',
+				action='store',
+				type=int,
+				dest='old',
+				default=3,
+				help='number of valves to time the old code with (it is slow)')
+
+	def handle(self, *args, **options):
+		its,hs = synthetic(options['days'],options['items'])
+		nv = options['valves']
+		print("%d history entries, %d items, %d valves" % (len(hs),len(its),nv))
+
+		t1 = time()
+		n_old = min(options['old'],nv)
+		for v in range(n_old):
+			old = [old_factor(its,h) for h in hs]
+		t_old = (time()-t1)*nv/n_old if n_old else 0
+
+		t1 = time()
+		ef = EnvFactors(its)
+		new = ef.factors(hs)
+		t_first = time()-t1
+		for v in range(nv-1):
+			ef.factors(hs)
+		t_new = time()-t1
+
+		if n_old:
+			err = max(abs(a-b) for a,b in zip(old,new))
+			if err > 1e-9:
+				raise CommandError("Results differ by %g" % (err,))
+			print("old: %.2f sec (extrapolated)" % (t_old,))
+		print("new: %.2f sec; first valve %.2f sec; %d hits, %d misses" % (t_new,t_first,ef.hits,ef.misses))
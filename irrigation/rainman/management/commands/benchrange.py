@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+		Benchmark time range calculation.
+		"""
+
+from django.core.management.base import BaseCommand, CommandError
+from rainman.utils import range_union,range_intersection,range_invert
+from rainman.intervals import IntervalSet, cached, invalidate
+from datetime import datetime,timedelta
+from random import Random
+from time import time
+
+def calendar(r, start,end, n, size):
+	"""@n random sorted ranges of up to @size seconds"""
+	span = (end-start).total_seconds()
+	res = []
+	for t in sorted(r.uniform(0,span) for i in range(n)):
+		res.append((start+timedelta(0,t), timedelta(0,r.uniform(60,size))))
+	return list(range_union(res))
+
+class Command(BaseCommand):
+	help = 'Compare the range functions with IntervalSet on a dense synthetic calendar'
+
+	def add_arguments(self, parser):
+		parser.add_argument('-d','--days',
+				action='store',
+				type=int,
+				dest='days',
+				default=7,
+				help='length of the time window')
+		parser.add_argument('-g','--groups',
+				action='store',
+				type=int,
+				dest='groups',
+				default=10,
+				help='number of groups')
+		parser.add_argument('-v','--valves',
+				action='store',
+				type=int,
+				dest='valves',
+				default=100,
+				help='number of valves, each in two groups')
+		parser.add_argument('-o','--overrides',
+				action='store',
+				type=int,
+				dest='overrides',
+				default=200,
+				help='overrides per group and kind')
+
+	def handle(self, *args, **options):
+		r = Random(1)
+		start = datetime(2016,6,1)
+		end = start+timedelta(options['days'],0)
+		n = options['overrides']
+		groups = []
+		for g in range(options['groups']):
+			groups.append(dict(
+				days=calendar(r,start,end, options['days']*2, 4*3600),
+				xdays=calendar(r,start,end, options['days'], 3600),
+				allowed=calendar(r,start,end, n, 1800),
+				blocked=calendar(r,start,end, n, 1800),
+				))
+		valves = []
+		for v in range(options['valves']):
+			valves.append((r.randrange(len(groups)),r.randrange(len(groups)), calendar(r,start,end, n, 600)))
+		print("%d groups, %d valves, %d overrides each" % (len(groups),len(valves),n))
+
+		def old(g1,g2,sched):
+			gs = (groups[g1],groups[g2])
+			x = range_intersection(range_union(*(g['days'] for g in gs)), range_invert(start,end-start,range_union(*(g['xdays'] for g in gs))))
+			x = range_union(x, *(g['allowed'] for g in gs))
+			return list(range_intersection(x, sched, *(g['blocked'] for g in gs)))
+
+		def new(g1,g2,sched):
+			gs = [(i,groups[i]) for i in (g1,g2)]
+			def c(k,i,g):
+				return cached((k,i,start,end), lambda: g[k])
+			x = IntervalSet().union(*(c('days',i,g) for i,g in gs))
+			x = x.intersection(IntervalSet(((start,end-start),)), *(c('xdays',i,g).invert(start,end-start) for i,g in gs))
+			x = x.union(*(c('allowed',i,g) for i,g in gs))
+			return list(x.intersection(sched, *(c('blocked',i,g) for i,g in gs)))
+
+		t1 = time()
+		r_old = [old(*v) for v in valves]
+		t_old = time()-t1
+
+		invalidate()
+		t1 = time()
+		r_new = [new(*v) for v in valves]
+		t_new = time()-t1
+
+		if r_old != r_new:
+			raise CommandError("The results differ")
+		print("range functions: %.3f sec" % (t_old,))
+		print("IntervalSet: %.3f sec" % (t_new,))
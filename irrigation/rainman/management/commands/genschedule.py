@@ -30,6 +30,8 @@ from __future__ import absolute_import, print_function, division, unicode_litera
 from django.core.management.base import BaseCommand, CommandError
 from rainman.models import Site,Valve,Schedule,Controller,History,Level
 from rainman.utils import now,str_tz
+from rainman.intervals import invalidate
+from rainman.plan import Plan,Profile
 from rainman.logging import log
 from datetime import datetime,time,timedelta
 from django.db.models import F,Q
@@ -37,6 +39,7 @@ from django.utils.timezone import utc,get_current_timezone
 from optparse import make_option
 from time import sleep
 from traceback import print_exc
+from concurrent.futures import ThreadPoolExecutor
 import rpyc
 import errno
 import sys
@@ -97,6 +100,17 @@ class Command(BaseCommand):
 				dest='verbose',
 				default=False,
 				help="be more chatty")
+		parser.add_argument('-j','--jobs',
+				action='store',
+				type=int,
+				dest='jobs',
+				default=1,
+				help="plan this many independent feeds/controllers in parallel")
+		parser.add_argument('-p','--profile',
+				action='store_true',
+				dest='profile',
+				default=False,
+				help="report the time spent in each phase")
 
 	def handle(self, *args, **options):
 		if options['trigger']:
@@ -116,6 +130,7 @@ class Command(BaseCommand):
 				else:
 					print("Connecting to '%s' succeeded" % (s.host,), file=sys.stderr)
 			sleep(10)
+		invalidate() # other processes may have changed things
 		q = Q()
 		if options['site']:
 			q &= Q(controller__site__name=options['site'])
@@ -135,21 +150,44 @@ class Command(BaseCommand):
 			delay=10
 		soon=n+timedelta(0,delay*60)
 
-		sites = set()
-		if len(args):
-			for a in args:
-				v = Valve.objects.get(q & Q(name=a))
-				if options['trigger']:
-					sites.add(v.controller.site)
-				self.force_one_valve(v, options)
-				self.one_valve(v, options)
-		else:
-			for v in Valve.objects.filter(q).order_by("level"):
-				if options['trigger']:
-					sites.add(v.controller.site)
-				self.force_one_valve(v,options)
-			for v in Valve.objects.filter(q).order_by("level"):
-				self.one_valve(v,options)
+		prof = Profile()
+		with prof("prefetch"):
+			vq = Valve.objects.select_related("feed","controller__site").prefetch_related("groups")
+			if len(args):
+				valves = [vq.get(q & Q(name=a)) for a in args]
+			else:
+				valves = list(vq.filter(q).order_by("level"))
+			plan = Plan(valves, soon)
+		sites = set(v.controller.site for v in valves)
+
+		with prof("ranges"):
+			# Group availability is cached and shared by the valves
+			end = soon+timedelta(options['age'],0)
+			groups = {}
+			for v in valves:
+				for g in v.groups.all():
+					groups[g.id] = g
+			for g in groups.values():
+				g.range_set(soon,end)
+
+		with prof("plan"):
+			# Valves which share neither feed nor controller don't compete
+			comps = plan.components()
+			if options['jobs'] > 1 and len(comps) > 1:
+				with ThreadPoolExecutor(options['jobs']) as ex:
+					for _ in ex.map(lambda vs: self.plan_valves(vs,options,plan), comps):
+						pass
+			else:
+				for vs in comps:
+					self.plan_valves(vs,options,plan)
+
+		n_new = len(plan.new)
+		if options['save']:
+			with prof("save"):
+				plan.save()
+		if options['profile']:
+			print("%d valves, %d groups, %d independent sets, %d new schedules" % (len(valves),len(groups),len(comps),n_new), file=sys.stderr)
+			prof.report(file=sys.stderr)
 
 		if options['trigger']:
 			for s in sites:
@@ -157,12 +195,18 @@ class Command(BaseCommand):
 				c.root.command("trigger","read","schedule",*s.var.split())
 				c.close()
 
-	def one_valve(self,v,options):
+	def plan_valves(self,valves,options,plan):
+		for v in valves:
+			self.force_one_valve(v,options,plan)
+		for v in valves:
+			self.one_valve(v,options,plan)
+
+	def one_valve(self,v,options,plan):
 		if v.feed.disabled:
 			return
 		if (v.level < v.stop_level) if v.priority else (v.level < v.start_level):
 			if options['save'] and v.verbose:
-				log(v,"Nothing to do (has %s, need %s)" % (v.level,v.start_level))
+				plan.log(v,"Nothing to do (has %s, need %s)" % (v.level,v.start_level))
 			return
 		level = v.level
 		if level > v.max_level:
@@ -170,7 +214,7 @@ class Command(BaseCommand):
 		want = v.raw_watering_time(level)
 		has = timedelta(0,0)
 		last_end = None
-		for s in v.schedules.filter(start__gte=soon-timedelta(1,0)).order_by('start'):
+		for s in plan.schedules("valve",v.id,soon-timedelta(1,0)):
 			last_end=s.end
 			if s.end < n:
 				continue
@@ -188,19 +232,19 @@ class Command(BaseCommand):
 
 		if has:
 			if options['save']:
-				v.update(priority=(want.total_seconds() > has.total_seconds()*1.2))
+				plan.set_priority(v,(want.total_seconds() > has.total_seconds()*1.2))
 			if v.verbose:
-				log(v,"Already something to do (has %s, need %s, want %s, does %s)" % (v.level,v.start_level,want,has))
+				plan.log(v,"Already something to do (has %s, need %s, want %s, does %s)" % (v.level,v.start_level,want,has))
 			return
 		elif want.total_seconds() < 10:
 			if options['save']:
-				v.update(priority=False)
+				plan.set_priority(v,False)
 			if v.verbose:
-				log(v,"Too little to do (has %s, need %s, want %s)" % (v.level,v.start_level,want))
+				plan.log(v,"Too little to do (has %s, need %s, want %s)" % (v.level,v.start_level,want))
 			return
 		if options['verbose']:
 			print("Plan",v,"for",want,"Level",v.level,v.start_level,v.stop_level,"P" if v.priority else "")
-		for a,b in v.range(start=soon,days=options['age'], add=30):
+		for a,b in v.range(start=soon,days=options['age'], add=30, plan=plan):
 			if a > soon:
 				if options['verbose']:
 					print("NotYet",a,soon)
@@ -214,38 +258,32 @@ class Command(BaseCommand):
 				last_end=None
 			if b.total_seconds() < want.total_seconds()/5:
 				if v.verbose:
-					log(v,"slot too short at %s for %s (level %s; want %s)" % (str_tz(a),str(b),v.level,str(want)))
+					plan.log(v,"slot too short at %s for %s (level %s; want %s)" % (str_tz(a),str(b),v.level,str(want)))
 				continue
 			if v.max_run and b > v.max_run:
 				b=v.max_run
 			if b < want:
-				log(v, "Partial %s %s %s" % (str_tz(a),str(b),str(want)))
-				if options['save']:
-					sc=Schedule(valve=v,start=a,duration=b)
-					sc.save()
-					v.update(priority=True)
-					if v.verbose:
-						log(v,"Scheduled at %s for %s (level %s; want %s)" % (str_tz(a),str(b),v.level,str(want)))
+				plan.log(v, "Partial %s %s %s" % (str_tz(a),str(b),str(want)))
+				plan.add(Schedule(valve=v,start=a,duration=b))
+				plan.set_priority(v,True)
+				if options['save'] and v.verbose:
+					plan.log(v,"Scheduled at %s for %s (level %s; want %s)" % (str_tz(a),str(b),v.level,str(want)))
 				want -= b
 				break # bail out: get others scheduled first / do more in the same slot if v.max_run is set
 			else:
-				log(v,"Total %s %s" % (str_tz(a),str(want)))
-				if options['save']:
-					sc=Schedule(valve=v,start=a,duration=want)
-					sc.save()
-					v.update(priority=False)
-					if v.verbose:
-						log(v,"Scheduled at %s for %s (level %s)" % (str_tz(a),str(want),v.level))
+				plan.log(v,"Total %s %s" % (str_tz(a),str(want)))
+				plan.add(Schedule(valve=v,start=a,duration=want))
+				plan.set_priority(v,False)
+				if options['save'] and v.verbose:
+					plan.log(v,"Scheduled at %s for %s (level %s)" % (str_tz(a),str(want),v.level))
 				want = None
 				break
 		else:
 			if want:
-				log(v, "Missing %s" % (str(want),))
+				plan.log(v, "Missing %s" % (str(want),))
 
-	def force_one_valve(self,v,options):
-		for a,b in v.range(start=soon,forced=True):
+	def force_one_valve(self,v,options,plan):
+		for a,b in v.range(start=soon,forced=True,plan=plan):
 			print("Forced",str_tz(a),str(b))
-			if options['save']:
-				sc=Schedule(valve=v,start=a,duration=b,forced=True)
-				sc.save()
+			plan.add(Schedule(valve=v,start=a,duration=b,forced=True))
 
@@ -49,6 +49,8 @@ from django.core.exceptions import ObjectDoesNotExist
 from rainman.models import Site,Valve,Schedule,Controller,History,Level
 from rainman.utils import now,str_tz
 from rainman.logging import log,log_error
+from rainman.scheduler import SiteScheduler
+from rainman.levels import update_levels
 from datetime import datetime,time,timedelta
 from django.db.models import F,Q
 from django.db import transaction
@@ -417,6 +419,7 @@ class SchedSite(SchedCommon):
 		self.s = s
 		self.connect()
 		self._delay_on = Semaphore()
+		self.scheduler = SiteScheduler(s, self.sched_command, log=log, locked=self.valve_locked)
 
 		self.controllers = set()
 		self.envgroups = set()
@@ -502,8 +505,7 @@ class SchedSite(SchedCommon):
 
 	def sync(self,**k):
 		print("Sync", file=sys.stderr)
-		for c in self.controllers:
-			c.sync()
+		self.new_level_entries(self.valve_ids())
 		for eg in self.envgroups:
 			eg.sync()
 		for mm in self.meters.values():
@@ -531,12 +533,18 @@ class SchedSite(SchedCommon):
 		#Save(None)
 		sys.exit(0)
 
-	def run_schedule(self):
-		for c in self.controllers:
-			c.run_schedule()
+	def valve_locked(self,vid):
+		v = valves.get(vid,None)
+		return v is not None and v.locked
+
+	def sched_command(self,*a,**k):
+		if a[2] == "on":
+			self.delay_on()
+		self.send_command(*a,**k)
 
 	def refresh(self):
 		self.s.refresh()
+		self.scheduler.load_valves()
 		for eg in self.envgroups:
 			eg.refresh()
 		for c in self.controllers:
@@ -681,8 +689,22 @@ class SchedSite(SchedCommon):
 		return h
 
 	def sync_history(self):
-		for c in self.controllers:
-			c.sync_history()
+		self.new_level_entries(self.valve_ids(), min_age=295)
+
+	def valve_ids(self):
+		res = []
+		for v in Valve.objects.filter(controller__site=self.s).select_related("controller__site"):
+			res.append(SchedValve(v).v.id)
+		return res
+
+	def new_level_entries(self, vids, take_flow=None, min_age=None):
+		"""Update the levels of these valves in one go"""
+		self.current_history_entry()
+		if take_flow is None:
+			take_flow = lambda vid: valves[vid].take_flow()
+		res = update_levels(self.s, vids, take_flow, min_age=min_age, log=log)
+		for vid,(ts,level) in res.items():
+			valves[vid].level_updated(ts,level)
 
 	def main_task(self):
 		print("MainTask", file=sys.stderr)
@@ -690,7 +712,7 @@ class SchedSite(SchedCommon):
 		h = self.current_history_entry(3)
 		self.sync_history()
 			
-		gevent.spawn_later(2,connwrap,self.sched_task)
+		gevent.spawn_later(2,connwrap,self.run_sched_task,reason="MainTask")
 		print("MainTask end",h, file=sys.stderr)
 		return h
 
@@ -708,22 +730,28 @@ class SchedSite(SchedCommon):
 		print("RunSched",reason, file=sys.stderr)
 		self._sched = None
 		self._sched_running = AsyncResult()
+		nt = None
 		try:
-			self.sched_task()
+			nt = self.sched_task()
 		except Exception:
 			self.log(format_exc())
 		finally:
 			r,self._sched_running = self._sched_running,None
 			if self._sched is None:
-				self._sched = gevent.spawn_later(600,connwrap,self.run_sched_task,kill=False,reason="Timer 600")
+				d = 600
+				if nt is not None:
+					d = min(max((nt-now()).total_seconds(),0.1),d)
+				self._sched = gevent.spawn_later(d,connwrap,self.run_sched_task,kill=False,reason="Timer %.1f" % (d,))
 			if r is not None:
 				r.set(None)
 		print("RunSched end", file=sys.stderr)
 	run_sched_ext = async_gevent(run_sched_task)
 
 	def sched_task(self, kill=True):
-		self.refresh()
-		self.run_schedule()
+		"""Run due schedule events. Returns when to run again, or None."""
+		# The site, controllers etc. are reloaded by main_task and syncsched.
+		self.scheduler.refresh()
+		return self.scheduler.run()
 
 class SchedController(SchedCommon):
 	"""Mirrors a controller"""
@@ -744,16 +772,10 @@ class SchedController(SchedCommon):
 		log(self.c,txt)
 	
 	def sync(self):
-		for v in self.c.valves.all():
-			SchedValve(v).sync()
+		self.site.new_level_entries([SchedValve(v).v.id for v in self.c.valves.all()])
 		
 	def sync_history(self):
-		for v in self.c.valves.all():
-			SchedValve(v).sync_history()
-
-	def run_schedule(self):
-		for v in self.c.valves.all():
-			SchedValve(v).run_schedule()
+		self.site.new_level_entries([SchedValve(v).v.id for v in self.c.valves.all()], min_age=295)
 
 	def shutdown(self):
 		for v in self.c.valves.all():
@@ -777,21 +799,11 @@ class SchedController(SchedCommon):
 			SchedValve(v).check_flow(**k)
 
 	def has_max_on(self):
-		if not self.c.max_on:
-			return False
-		n=0
-		for v in self.c.valves.all():
-			if SchedValve(v).on:
-				n += 1
-		return n >= self.c.max_on
+		return self.site.scheduler.has_max_on(self.c)
 
 class SchedValve(SchedCommon):
 	"""Mirrors (and monitors) a valve."""
 	locked = False # external command, don't change
-	sched = None
-	sched_ts = None
-	sched_job = None
-	sched_lock = None
 	on = False
 	on_ts = None
 	flow = 0
@@ -806,7 +818,6 @@ class SchedValve(SchedCommon):
 		self.site = SchedSite(self.v.controller.site)
 		self.env = EnvGroup(self.v.envgroup)
 		self.controller = SchedController(self.v.controller)
-		self.sched_lock = Semaphore()
 		if self.site.qb:
 			try:
 				self.site.send_command("set","output","off",*(self.v.var.split()))
@@ -818,15 +829,11 @@ class SchedValve(SchedCommon):
 	def __init__(self,v):
 		pass
 
-	def _on(self,caller,sched=None,duration=None):
+	def _on(self,caller,duration=None):
+		"""Open the valve outside of the schedule, e.g. for checking flow"""
 		print("Open",caller,self.v.var, file=sys.stderr)
 		self.site.delay_on()
-		if duration is None and sched is not None:
-			duration = sched.duration
 		if self.controller.has_max_on():
-			print("… but too many:", ", ".join(str(v) for v in self.controller.c.valves.all() if SchedValve(v).on), file=sys.stderr)
-			if sched:
-				sched.update(seen = False)
 			self.log("NOT running %s for %s: too many"%(self.v,duration,))
 			raise TooManyOn(self)
 		if duration is None:
@@ -845,17 +852,8 @@ class SchedValve(SchedCommon):
 				self.site.send_command("set","output","off",*(self.v.var.split()))
 				raise RuntimeError("Could not start (logged)")
 
-		if sched is not None:
-			if self.v.verbose:
-				self.log("Opened for %s"%(sched,))
-			self.sched = sched
-			if not sched.seen:
-				sched.update(start=now(), seen=True)
-				sched.refresh()
-			#Save(sched)
-		else:
-			if self.v.verbose:
-				self.log("Opened for %s"%(duration,))
+		if self.v.verbose:
+			self.log("Opened for %s"%(duration,))
 
 	def _off(self, num):
 		if self.on:
@@ -871,94 +869,6 @@ class SchedValve(SchedCommon):
 		if self._flow_check is not None:
 			self._flow_check.dead()
 
-	def run_schedule(self):
-		if not self.sched_lock.acquire(blocking=False):
-			if self.v.verbose:
-				print("SCHED LOCKED1 %s" % (self.v.name,), file=sys.stderr)
-			return
-		try:
-			self._run_schedule()
-		except Exception:
-			self.log(format_exc())
-		finally:
-			self.sched_lock.release()
-
-	def _run_schedule(self):
-		if self.sched_job is not None:
-			self.sched_job.kill()
-			self.sched_job = None
-		if self.locked:
-			if self.v.verbose:
-				print("SCHED LOCKED2 %s" % (self.v.name,), file=sys.stderr)
-			return
-		n = now()
-
-		try:
-			if self.sched is not None:
-				self.sched.refresh()
-				if self.sched.end <= n:
-					if self.v.verbose:
-						print("Turn off: %s+%s <= %s" % (self.sched.start,self.sched.duration,n), file=sys.stderr)
-					self._off(2)
-					self.sched = None
-				else:
-					self.sched_job = gevent.spawn_later((self.sched.end-n).total_seconds(),connwrap,self.run_sched_task,reason="_run_schedule 1")
-					if self.v.verbose:
-						print("SCHED LATER %s: %s" % (self.v.name,humandelta(self.sched.end-n)), file=sys.stderr)
-					return
-		except ObjectDoesNotExist:
-			pass # somebody deleted it *shrug*
-		sched = None
-
-		if self.sched_ts is None:
-			try:
-				sched = self.v.schedules.filter(start__lt=n).order_by("-start")[0]
-			except IndexError:
-				self.sched_ts = n-timedelta(1,0)
-			else:
-				self.sched_ts = sched.end
-				if sched.end > n: # still running
-					if self.v.verbose:
-						print("SCHED RUNNING %s: %s" % (self.v.name,humandelta(sched.end-n)), file=sys.stderr)
-					try:
-						self._on(1,sched, sched.end-n)
-					except TooManyOn:
-						self.log("Could not schedule: too many open valves")
-					except NotConnected:
-						self.log("Could not schedule: connection to MoaT failed")
-					return
-
-		try:
-			sched = self.v.schedules.filter(start__gte=self.sched_ts).order_by("start")[0]
-		except IndexError:
-			if self.v.verbose:
-				print("SCHED EMPTY %s: %s" % (self.v.name,str_tz(self.sched_ts)), file=sys.stderr)
-			self._off(3)
-			return
-
-		if sched.end <= n:
-			if self.v.verbose:
-				print("SCHED %s: sched %d done for %s" % (self.v.name,sched.id,humandelta(n-sched.end)), file=sys.stderr)
-			self.sched_ts = None
-			return
-		if sched.start > n:
-			if self.v.verbose:
-				print("SCHED %s: sched %d in %s" % (self.v.name,sched.id,humandelta(sched.start-n)), file=sys.stderr)
-			self._off(4)
-			self.sched_job = gevent.spawn_later((sched.start-n).total_seconds(),connwrap,self.run_sched_task,reason="_run_schedule 2")
-			return
-		try:
-			self._on(2,sched)
-		except TooManyOn:
-			self.log("Could not schedule: too many open valves")
-		except NotConnected:
-			self.log("Could not schedule: connection to MoaT failed")
-	
-	def run_sched_task(self,reason="valve"):
-		self.sched_job = None
-		self.site.run_sched_task(reason=reason)
-	run_sched_ext = async_gevent(run_sched_task)
-
 	def add_flow(self, val):
 		if self._flow_check is not None:
 			if self._flow_check.add_flow(val):
@@ -994,6 +904,9 @@ class SchedValve(SchedCommon):
 	def watch_state(self,value=None,**kv):
 		"""output change NAME ::value ON"""
 		on = (str(value).lower() in ("1","true","on"))
+		if self.site.scheduler.valve_state(self.v.id,on):
+			# a start waited for this valve to close; the site timer is not due yet
+			gevent.spawn(connwrap,self.site.run_sched_task,reason="valve closed")
 		if self._flow_check is not None:
 			# TODO
 			self.on = on
@@ -1005,12 +918,7 @@ class SchedValve(SchedCommon):
 		try:
 			if on != self.on:
 				n=now()
-				print("Report %s" % ("ON" if on else "OFF"),self.v.var,self.sched, file=sys.stderr)
-				if self.sched is not None and not on:
-					self.sched.update(db_duration=(n-self.sched.start).total_seconds())
-					self.sched.refresh()
-					self.sched_ts = self.sched.end
-					self.sched = None
+				print("Report %s" % ("ON" if on else "OFF"),self.v.var,self.site.scheduler.current(self.v.id), file=sys.stderr)
 				flow,self.flow = self.flow,0
 				# If nothing happened, calculate.
 				if not on:
@@ -1029,71 +937,24 @@ class SchedValve(SchedCommon):
 		except Exception:
 			print_exc()
 
-	def sync(self):
+	def take_flow(self):
 		flow,self.flow = self.flow,0
-		self.new_level_entry(flow)
+		return flow
+
+	def sync(self):
+		self.site.new_level_entries((self.v.id,))
 
 	def sync_history(self):
-		n=now()
-		try:
-			lv = self.v.levels.order_by("-time")[0]
-		except IndexError:
-			pass
-		else:
-			if self.v.time > lv.time:
-				self.log("Timestamp downdate: %s %s" % (self.v.time,lv.time))
-				self.v.update(time = lv.time)
-				self.v.refresh()
-				#Save(self.v)
-		if (n-self.v.time).total_seconds() >= 295:
-			flow,self.flow = self.flow,0
-			self.new_level_entry(flow)
+		self.site.new_level_entries((self.v.id,), min_age=295)
 
 	def new_level_entry(self,flow=0):
-		self.site.current_history_entry()
-		n=now()
-		self.v.refresh()
-		hts = None
-		try:
-			lv = self.v.levels.order_by("-time")[0]
-		except IndexError:
-			ts = n-timedelta(1,0)
-		else:
-			ts = lv.time
-		sum_f = 0
-		sum_r = 0
-		for h in self.site.s.history.filter(time__gt=ts).order_by("time"):
-			if self.v.verbose>2:
-				self.log("Env factor for %s: T=%s W=%s S=%s"%(h,h.temp,h.wind,h.sun))
-			f = self.env.env_factor(h, logger=self.log if self.v.verbose>2 else None)*self.v.adj
-			if self.v.verbose>1:
-				self.log("Env factor for %s is %s"%(h,f))
-			sum_f += self.site.s.db_rate * self.v.do_shade(self.env.eg.factor*f) * (h.time-ts).total_seconds()
-			sum_r += self.v.runoff*h.rain
-			ts=h.time
-
-		if self.v.verbose:
-			self.log("Apply env %f, rain %r,, flow %f = %f" % (sum_f,sum_r,flow,flow/self.v.area))
-
-		if self.v.time == ts:
-			return
-		if self.v.level < 0:
-			level = 0
-		else:
-			level = F('level')
-		level += sum_f
-		if (flow > 0 or sum_r > 0) and self.v.level > self.v.max_level:
-			level = self.v.max_level
-		level -= flow/self.v.area+sum_r
-		#if level < 0:
-		#	self.log("Level %s ?!?"%(self.v.level,))
-		self.v.update(time=ts, level=level)
-		self.v.refresh()
-
-		lv = Level(valve=self.v,time=ts,level=self.v.level,flow=flow)
-		lv.save()
+		self.site.new_level_entries((self.v.id,), take_flow=lambda vid: flow)
 
-		if self.on and not (self.sched and self.sched.forced) and self.v.level <= self.v.stop_level:
+	def level_updated(self,ts,level):
+		self.v.time = ts
+		self.v.level = level
+		sched = self.site.scheduler.current(self.v.id)
+		if self.on and not (sched and sched.forced) and level <= self.v.stop_level:
 			self._off(5)
 
 	def log(self,txt):
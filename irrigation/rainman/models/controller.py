@@ -46,7 +46,7 @@ class Controller(Model,RangeMixin):
 	location = m.CharField(max_length=200, help_text="How to identify the controller (host name?)")
 	max_on = m.IntegerField(default=3, help_text="number of valves that can be on at any one time")
 
-	def _range(self,start,end, add=0):
+	def _range(self,start,end, add=0, plan=None):
 		if not isinstance(add,timedelta):
 			add = timedelta(0,add)
 
@@ -55,7 +55,11 @@ class Controller(Model,RangeMixin):
 		stops=[]
 		n_open = 0
 
-		for s in Schedule.objects.filter(valve__controller=self,start__lt=end,start__gte=start-timedelta(1,0)).order_by("start"):
+		if plan is not None:
+			ss = plan.schedules("controller",self.id,start-timedelta(1,0),end)
+		else:
+			ss = Schedule.objects.filter(valve__controller=self,start__lt=end,start__gte=start-timedelta(1,0)).order_by("start")
+		for s in ss:
 			if s.start+s.duration <= start:
 				continue
 			while stops and stops[0] < s.start:
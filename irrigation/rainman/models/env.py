@@ -28,7 +28,8 @@ import six
 from rainman.models import Model
 from rainman.models.site import Site
 from django.db import models as m
-from django.db.models import Q
+from django.db.models.signals import post_save,post_delete
+from rainman.envfactor import env_factors,invalidate
 
 # Tables for environmental effects.
 # Note that table names are different for Hysterical Raisins.
@@ -46,76 +47,28 @@ class EnvGroup(Model):
 	factor = m.FloatField(default=1.0, help_text="Base Factor")
 	rain = m.BooleanField(default=True,help_text="stop when it's raining?")
 
-	def __init__(self,*a,**k):
-		super(EnvGroup,self).__init__(*a,**k)
-		self.env_cache = {}
-
 	def list_valves(self):
 		return u"¦".join((d.name for d in self.valves.all()))
 
 	def refresh(self):
 		super(EnvGroup,self).refresh()
-		self.env_cache = {}
-
-	def env_factor_one(self, tws, h):
-		p=4 # power factor, favoring nearest-neighbor
+		invalidate(self.id)
 
-		qtemp,qwind,qsun = tws
-		if qtemp and h.temp is None: return None
-		if qwind and h.wind is None: return None
-		if qsun and h.sun is None: return None
-		q=Q()
-		q &= Q(temp__isnull=not qtemp)
-		q &= Q(wind__isnull=not qwind)
-		q &= Q(sun__isnull=not qsun)
+	@property
+	def env_factors(self):
+		return env_factors(self)
 
-		sum_f = 0
-		sum_w = 0
-		try:
-			ec = self.env_cache[tws]
-		except KeyError:
-			self.env_cache[tws] = ec = list(self.items.filter(q))
-		for ef in ec:
-			d=0
-			if qtemp:
-				d += (h.temp-ef.temp)**2
-			if qwind:
-				d += (h.wind-ef.wind)**2
-			if qsun:
-				d += (h.sun-ef.sun)**2
-			d = d**(p*0.5)
-			if d < 0.001: # close enough
-				return ef.factor
-			sum_f += ef.factor/d
-			sum_w += 1/d
-		if not sum_w:
-			return None
-		return sum_f / sum_w
+	def env_factor_one(self, tws, h):
+		return self.env_factors.factor_one(tws,h)
 
 	def env_factor(self, h, logger=None):
 		"""Calculate a weighted factor for history entry @h, based on the given environmental parameters"""
-		ql=(
-			(6,(True,True,True)),
-			(4,(False,True,True)),
-			(4,(True,False,True)),
-			(4,(True,True,False)),
-			(1,(True,False,False)),
-			(1,(False,True,False)),
-			(1,(False,False,True)),
-			)
-		sum_f = 1 # if there are no data, return 1
-		sum_w = 1
-		n = 1
-		for weight,tws in ql:
-			f = self.env_factor_one(tws,h)
-			if f is not None:
-				if logger:
-					logger("Simple factor %s%s%s: %f" % ("T" if tws[0] else "-", "W" if tws[1] else "-", "S" if tws[2] else "-", f))
-				sum_f *= f**weight
-				sum_w += weight
-				n += 1
-		return sum_f ** (n/sum_w)
-	
+		return self.env_factors.factor(h,logger)
+
+	def env_factor_list(self, hs):
+		"""Calculate the factors for a sequence of history entries"""
+		return self.env_factors.factors(hs)
+
 	@property
 	def schedules(self):
 		from rainman.models.schedule import Schedule
@@ -134,3 +87,8 @@ class EnvItem(Model):
 	temp = m.FloatField(blank=True,null=True, help_text="average temperature (°C)")
 	wind = m.FloatField(blank=True,null=True, help_text="wind speed (m/s or whatever)")
 	sun = m.FloatField(blank=True,null=True, help_text="how much sunshine was there (0-1)") # measured value
+
+def _items_changed(sender, instance, **kwargs):
+	invalidate(instance.group_id)
+post_save.connect(_items_changed, sender=EnvItem)
+post_delete.connect(_items_changed, sender=EnvItem)
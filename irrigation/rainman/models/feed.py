@@ -48,7 +48,7 @@ class Feed(Meter,RangeMixin):
 		self.db_max_flow_wait = val.total_seconds()
 	max_flow_wait = property(_get_max_flow_wait,_set_max_flow_wait)
 
-	def _range(self,start,end,plusflow,add=0):
+	def _range(self,start,end,plusflow,add=0,plan=None):
 		"""Return a range of times which accept this additional flow"""
 		if not isinstance(add,timedelta):
 			add = timedelta(0,add)
@@ -64,7 +64,11 @@ class Feed(Meter,RangeMixin):
 			if flow < 0:
 				flow = None # single valve mode
 
-		for s in Schedule.objects.filter(valve__feed=self,start__lt=end,start__gte=start-timedelta(1,0)).order_by("start"):
+		if plan is not None:
+			ss = plan.schedules("feed",self.id,start-timedelta(1,0),end)
+		else:
+			ss = Schedule.objects.filter(valve__feed=self,start__lt=end,start__gte=start-timedelta(1,0)).order_by("start")
+		for s in ss:
 			if s.start+s.duration <= start:
 				continue
 			while stops and stops[0][0] < s.start:
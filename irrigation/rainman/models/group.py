@@ -28,9 +28,11 @@ import six
 from rainman.models import Model
 from rainman.models.site import Site
 from rainman.models.valve import Valve
-from rainman.models.day import DayRange
+from rainman.models.day import Day,DayTime,DayRange
 from rainman.utils import now,RangeMixin, range_union,range_intersection,range_invert, str_tz
+from rainman.intervals import IntervalSet, cached, invalidate
 from django.db import models as m
+from django.db.models.signals import post_save,post_delete,m2m_changed
 from datetime import timedelta
 
 @six.python_2_unicode_compatible
@@ -85,14 +87,24 @@ class Group(Model,RangeMixin):
 		return super(Group,self).list_range()
 
 	def _range(self,start,end):
-		r = []
-		r.append(self._days_range(start,end))
-		r.append(self._no_xdays_range(start,end))
-		r = range_intersection(*r)
-		if self.overrides.count():
-			r = range_union(r,self._allowed_range(start,end))
-		r = range_intersection(r,self._not_blocked_range(start,end))
-		return r
+		return iter(self.range_set(start,end))
+
+	def range_set(self,start,end):
+		"""The times when this group may run, as an IntervalSet"""
+		r = self.days_set(start,end) & self.no_xdays_set(start,end)
+		r = r | self.allowed_set(start,end)
+		return r & self.not_blocked_set(start,end)
+
+	# Cached versions of the _*_range methods below.
+	# Don't modify the results.
+	def days_set(self,start,end):
+		return cached(("days",self.id,start,end), self._days_range,start,end)
+	def no_xdays_set(self,start,end):
+		return cached(("xdays",self.id,start,end), self._no_xdays_range,start,end)
+	def allowed_set(self,start,end):
+		return cached(("allowed",self.id,start,end), self._allowed_range,start,end)
+	def not_blocked_set(self,start,end):
+		return cached(("blocked",self.id,start,end), self._not_blocked_range,start,end)
 
 	valves = m.ManyToManyField(Valve,through=Valve.groups.through)
 	def list_valves(self):
@@ -131,3 +143,8 @@ class Group(Model,RangeMixin):
 		from rainman.models.schedule import Schedule
 		return Schedule.objects.filter(valve__groups__id = self.id)
 
+for _m in (Group,Day,DayTime,DayRange):
+	post_save.connect(invalidate, sender=_m)
+	post_delete.connect(invalidate, sender=_m)
+for _m in (Group.days.through,Group.xdays.through,DayRange.days.through):
+	m2m_changed.connect(invalidate, sender=_m)
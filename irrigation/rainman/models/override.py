@@ -31,6 +31,8 @@ from rainman.models.valve import Valve
 from django.db import models as m
 from datetime import timedelta
 from rainman.utils import str_tz
+from rainman.intervals import invalidate
+from django.db.models.signals import post_save,post_delete
 
 @six.python_2_unicode_compatible
 class GroupOverride(Model):
@@ -102,3 +104,5 @@ class GroupAdjust(Model):
 	start = m.DateTimeField(db_index=True)
 	factor = m.FloatField()
 
+post_save.connect(invalidate, sender=GroupOverride)
+post_delete.connect(invalidate, sender=GroupOverride)
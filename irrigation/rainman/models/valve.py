@@ -31,6 +31,7 @@ from rainman.models.feed import Feed
 from rainman.models.env import EnvGroup
 from django.db import models as m
 from rainman.utils import now, range_intersection,range_union,range_invert, RangeMixin
+from rainman.intervals import IntervalSet
 from datetime import timedelta
 
 @six.python_2_unicode_compatible
@@ -114,44 +115,45 @@ class Valve(Model,RangeMixin):
 				f *= g.adj
 		return f
 
-	def _range(self,start,end, forced=False, add=0):
+	def _range(self,start,end, forced=False, add=0, plan=None):
+		"""\
+			@plan: a rainman.plan.Plan with prefetched (and planned)
+			schedules and overrides, instead of asking the database
+			"""
 		if start is None:
 			start = now()
-		r = []
 
 		if forced:
 			# If this pass considers force-open times, only this matters
-			r.append(self._forced_range(start,end))
+			r = IntervalSet(self._forced_range(start,end,plan))
 		else:
+			groups = list(self.groups.all())
 			# Apply groups' times 
-			r.append(self._group_range(start,end))
-			r.append(self._group_xrange(start,end))
+			r = IntervalSet().union(*(g.days_set(start,end) for g in groups))
+			r = r.intersection(IntervalSet(((start,end-start),)), *(g.no_xdays_set(start,end) for g in groups))
 
-			# First step finished.
-			r = [range_intersection(*r)]
 			# Now add any group "allowed" one-shots.
-			for g in self.groups.all():
-				r.append(g._allowed_range(start,end))
-			r = [range_union(*r)]
+			r = r.union(*(g.allowed_set(start,end) for g in groups))
 
 			# Now add any group "not-allowed" one-shots.
-			for g in self.groups.all():
-				r.append(g._not_blocked_range(start,end))
+			r = r.intersection(*(g.not_blocked_set(start,end) for g in groups))
 
 			# Also apply my own exclusion times
-			r.append(self._not_blocked_range(start,end))
+			r = r.intersection(self._not_blocked_range(start,end,plan))
 
 		# Exclude times when this valve is already scheduled
-		r.append(self._not_scheduled(start,end))
-
 		# Only consider times when the controller can open the valve and
 		# there's enough water for it to run
-		r.append(self.controller._range(start,end,add=add))
-		r.append(self.feed._range(start,end,self.flow,add=add))
-		return range_intersection(*r)
+		r = r.intersection(self._not_scheduled(start,end,plan), self.controller._range(start,end,add=add,plan=plan), self.feed._range(start,end,self.flow,add=add,plan=plan))
+		return iter(r)
 	
-	def _not_blocked_range(self,start,end):
-		for x in self.overrides.filter(start__gte=start-timedelta(1,0),start__lt=end,running=False).order_by("start"):
+	def _overrides(self,start,end,running,plan=None):
+		if plan is not None:
+			return plan.overrides(self.id,running,start-timedelta(1,0),end)
+		return self.overrides.filter(start__gte=start-timedelta(1,0),start__lt=end,running=running).order_by("start")
+
+	def _not_blocked_range(self,start,end,plan=None):
+		for x in self._overrides(start,end,False,plan):
 			if x.end <= start:
 				continue
 			if x.start > start:
@@ -160,8 +162,12 @@ class Valve(Model,RangeMixin):
 		if end>start:
 			yield (start,end-start)
 				
-	def _not_scheduled(self,start,end):
-		for x in self.schedules.filter(start__gte=start-timedelta(1,0),start__lt=end).order_by("start"):
+	def _not_scheduled(self,start,end,plan=None):
+		if plan is not None:
+			xs = plan.schedules("valve",self.id,start-timedelta(1,0),end)
+		else:
+			xs = self.schedules.filter(start__gte=start-timedelta(1,0),start__lt=end).order_by("start")
+		for x in xs:
 			if x.end <= start:
 				continue
 			if x.start > start:
@@ -170,28 +176,14 @@ class Valve(Model,RangeMixin):
 		if end>start:
 			yield (start,end-start)
 				
-	def _forced_range(self,start,end):
-		for x in self.overrides.filter(start__gte=start-timedelta(1,0),start__lt=end,running=True).order_by("start"):
+	def _forced_range(self,start,end,plan=None):
+		for x in self._overrides(start,end,True,plan):
 			if x.end <= start:
 				continue
 			if x.start > start:
 				yield (x.start,x.duration)
 				start = x.end
 
-	def _group_range(self,start,end):
-		gx = []
-		for g in self.groups.all():
-			for gd in g.days.all():
-				gx.append(gd._range(start,end))
-		return range_union(*gx)
-
-	def _group_xrange(self,start,end):
-		gx = []
-		for g in self.groups.all():
-			for gd in g.xdays.all():
-				gx.append(gd._range(start,end))
-		return range_invert(start,end-start,range_union(*gx))
-				
 	groups = m.ManyToManyField('Group',db_table='rainman_group_valves')
 	def list_groups(self):
 		return u" ¦ ".join((d.name for d in self.groups.all()))
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+	Prefetched state for schedule planning.
+
+	A Plan loads the schedules and valve overrides of a planning horizon
+	in a few queries. The range calculations of valves, controllers and
+	feeds read from it (pass plan=… to their _range methods) instead of
+	asking the database, and see schedules which have been planned but
+	not yet saved.
+	"""
+
+from bisect import bisect_left,insort
+from collections import defaultdict
+from datetime import timedelta
+from time import time
+from threading import Lock
+
+class _Sorted(object):
+	"""Objects with a .start attribute, sorted by it"""
+	def __init__(self):
+		self.keys = []
+		self.items = []
+
+	def add(self, x):
+		i = bisect_left(self.keys, x.start)
+		while i < len(self.keys) and self.keys[i] == x.start:
+			i += 1
+		self.keys.insert(i, x.start)
+		self.items.insert(i, x)
+
+	def range(self, start, end):
+		"""Items with start <= item.start < end"""
+		return self.items[bisect_left(self.keys,start):bisect_left(self.keys,end)]
+
+class Plan(object):
+	def __init__(self, valves, start):
+		self.valves = valves
+		self._sched = defaultdict(_Sorted) # (kind,id) => schedules
+		self._over = defaultdict(_Sorted) # (valve,running) => overrides
+		self.new = []
+		self.priority = {} # valve id => flag
+		self.logs = []
+		self._lock = Lock()
+
+		if not valves:
+			return
+		from rainman.models import Schedule,ValveOverride
+		from django.db.models import Q
+
+		cids = set(v.controller_id for v in valves)
+		fids = set(v.feed_id for v in valves)
+		start = start-timedelta(1,0)
+
+		for s in Schedule.objects.filter(Q(valve__controller__in=cids)|Q(valve__feed__in=fids), start__gte=start).select_related("valve").order_by("start"):
+			self._add(s)
+		for o in ValveOverride.objects.filter(valve__in=[v.id for v in valves], start__gte=start).order_by("start"):
+			self._over[(o.valve_id,o.running)].add(o)
+
+	def _add(self, s):
+		v = s.valve
+		self._sched[("valve",v.id)].add(s)
+		self._sched[("controller",v.controller_id)].add(s)
+		self._sched[("feed",v.feed_id)].add(s)
+
+	def schedules(self, kind, id, start, end=None):
+		"""Schedules of this valve/controller/feed which start in [start,end["""
+		s = self._sched.get((kind,id),None)
+		if s is None:
+			return []
+		if end is None:
+			return s.items[bisect_left(s.keys,start):]
+		return s.range(start,end)
+
+	def overrides(self, valve, running, start, end):
+		o = self._over.get((valve,running),None)
+		if o is None:
+			return []
+		return o.range(start,end)
+
+	def add(self, s):
+		"""A new schedule, to be saved by save()"""
+		self._add(s)
+		with self._lock:
+			self.new.append(s)
+
+	def set_priority(self, v, flag):
+		self.priority[v.id] = flag
+
+	def log(self, dev, text):
+		from rainman.logging import log_entry
+		e = log_entry(dev,text)
+		with self._lock:
+			self.logs.append(e)
+
+	def components(self):
+		"""\
+			Split the valves into groups which may be planned
+			independently, i.e. which don't share a feed or a controller.
+			Their order is retained.
+			"""
+		parent = {}
+		def find(x):
+			while parent.setdefault(x,x) != x:
+				parent[x] = parent[parent[x]]
+				x = parent[x]
+			return x
+		for v in self.valves:
+			a,b = find(("c",v.controller_id)),find(("f",v.feed_id))
+			if a != b:
+				parent[a] = b
+		res = {}
+		for v in self.valves:
+			res.setdefault(find(("c",v.controller_id)),[]).append(v)
+		return list(res.values())
+
+	def save(self):
+		"""Write new schedules, priority changes and log entries"""
+		from rainman.models import Schedule,Valve,Log
+		if self.new:
+			Schedule.objects.bulk_create(self.new)
+		for flag in (False,True):
+			ids = [k for k,v in self.priority.items() if v == flag]
+			if ids:
+				Valve.objects.filter(id__in=ids).update(priority=flag)
+		if self.logs:
+			Log.objects.bulk_create(self.logs)
+		n = len(self.new)
+		self.new = []
+		self.priority = {}
+		self.logs = []
+		return n
+
+class Profile(object):
+	"""Accumulate time spent per phase"""
+	def __init__(self):
+		self.times = defaultdict(float)
+		self.order = []
+
+	def __call__(self, name):
+		return _Phase(self,name)
+
+	def report(self, file=None):
+		total = sum(self.times.values())
+		for k in self.order:
+			print("%-10s %8.3f sec %5.1f%%" % (k,self.times[k],100*self.times[k]/total if total else 0), file=file)
+		print("%-10s %8.3f sec" % ("total",total), file=file)
+
+class _Phase(object):
+	def __init__(self, profile, name):
+		self.p = profile
+		self.name = name
+	def __enter__(self):
+		if self.name not in self.p.times:
+			self.p.order.append(self.name)
+		self.t = time()
+		return self
+	def __exit__(self, *tb):
+		self.p.times[self.name] += time()-self.t
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+	Run a site's valve schedules.
+
+	All upcoming schedules of a site are kept in one time-ordered heap of
+	start and end events; the caller arms a single timer for the next one.
+	The number of open valves per controller is tracked in memory.
+
+	refresh() reads the schedules within the horizon with one query and
+	only pushes events for entries which are new or have changed. Stale
+	heap entries are skipped when they come up.
+	"""
+
+from heapq import heappush,heappop
+from itertools import count
+from collections import defaultdict,namedtuple
+from datetime import timedelta
+from rainman.utils import now
+
+RETRY = timedelta(0,60) # locked valves
+
+Entry = namedtuple('Entry','valve start end seen forced')
+
+class SiteScheduler(object):
+	"""\
+		@send_command: called like SchedSite.send_command
+		@log: log(valve,text)
+		@locked: locked(valve_id): don't touch this valve now
+		"""
+	def __init__(self, site, send_command, log=None, locked=None, horizon=timedelta(1,0)):
+		self.site = site
+		self.send_command = send_command
+		self._log = log
+		self.locked = locked or (lambda vid: False)
+		self.horizon = horizon
+
+		self.heap = [] # (time, seq, kind, schedule id, entry)
+		self._seq = count()
+		self.known = {} # schedule id => Entry
+		self.running = {} # valve id => schedule id
+		self.open = defaultdict(set) # controller id => open valve ids
+		self.waiting = defaultdict(list) # controller id => schedule ids
+		self.valves = {}
+
+	def log(self, v, txt):
+		if self._log is not None:
+			self._log(v,txt)
+
+	def load_valves(self):
+		from rainman.models import Valve
+		self.valves = dict((v.id,v) for v in Valve.objects.filter(controller__site=self.site).select_related("controller"))
+
+	def _push(self, t, kind, id, e):
+		heappush(self.heap, (t, next(self._seq), kind, id, e))
+
+	def _set(self, id, e):
+		self.known[id] = e
+		self._push(e.start,"start",id,e)
+		self._push(e.end,"end",id,e)
+
+	def refresh(self, n=None):
+		"""Read the schedules, push events for new and changed ones"""
+		from rainman.models import Schedule
+		if n is None:
+			n = now()
+		if not self.valves:
+			self.load_valves()
+		found = set()
+		for id,vid,start,dur,seen,forced in Schedule.objects.filter(valve__controller__site=self.site, start__gte=n-timedelta(1,0), start__lt=n+self.horizon).values_list("id","valve_id","start","db_duration","seen","forced"):
+			end = start+timedelta(0,dur)
+			if end <= n and id not in self.known:
+				continue
+			if vid not in self.valves:
+				self.load_valves()
+				if vid not in self.valves:
+					continue
+			found.add(id)
+			old = self.known.get(id,None)
+			if old is None or old[:3] != (vid,start,end):
+				self._set(id, Entry(vid,start,end,seen,forced))
+
+		for id in [id for id in self.known if id not in found]:
+			vid = self.known.pop(id).valve
+			if self.running.get(vid,None) == id:
+				self._close(vid,n)
+
+	def current(self, vid):
+		"""The Entry this valve is running for, or None"""
+		id = self.running.get(vid,None)
+		if id is None:
+			return None
+		return self.known.get(id,None)
+
+	def next_time(self):
+		"""When run() needs to be called next, or None"""
+		while self.heap:
+			t,_,_,id,e = self.heap[0]
+			if self.known.get(id,None) is e:
+				return t
+			heappop(self.heap)
+		return None
+
+	def run(self, n=None):
+		"""Process all events which are due. Returns next_time()."""
+		if n is None:
+			n = now()
+		while self.heap and self.heap[0][0] <= n:
+			t,_,kind,id,e = heappop(self.heap)
+			if self.known.get(id,None) is not e:
+				continue # stale
+			if kind == "start":
+				self._start(id,e,n)
+			else:
+				self._end(id,e,n)
+		return self.next_time()
+
+	def has_max_on(self, controller):
+		return bool(controller.max_on) and len(self.open[controller.id]) >= controller.max_on
+
+	def _start(self, id, e, n):
+		from rainman.models import Schedule
+		vid,start,end,seen,_ = e
+		if end <= n:
+			return
+		v = self.valves[vid]
+		c = v.controller
+		if self.locked(vid):
+			self._push(n+RETRY,"start",id,e)
+			return
+		cur = self.running.get(vid,None)
+		if cur is not None and cur != id:
+			# still busy with the previous entry
+			self._push(self.known[cur].end,"start",id,e)
+			return
+		if vid not in self.open[c.id] and self.has_max_on(c):
+			self.log(v,"NOT running %s for %s: too many" % (v,end-start))
+			Schedule.objects.filter(id=id).update(seen=False)
+			self.waiting[c.id].append(id)
+			return
+
+		if seen:
+			duration = end-n
+		else:
+			duration = end-start
+			Schedule.objects.filter(id=id).update(start=n,seen=True)
+			e = e._replace(start=n,end=n+duration,seen=True)
+			self.known[id] = e
+			self._push(e.end,"end",id,e)
+		self.log(v,"Run for %s" % (duration,))
+		try:
+			self.send_command("set","output","on",*(v.var.split()), sub=(("for",duration.total_seconds()),("async",)))
+		except Exception as exc:
+			self.log(v,"Could not schedule: %s" % (exc,))
+			try:
+				self.send_command("set","output","off",*(v.var.split()))
+			except Exception:
+				pass
+			return
+		self.running[vid] = id
+		self.open[c.id].add(vid)
+
+	def _end(self, id, e, n):
+		vid = e.valve
+		if self.running.get(vid,None) == id:
+			self._close(vid,n)
+
+	def _close(self, vid, n):
+		v = self.valves[vid]
+		del self.running[vid]
+		try:
+			self.send_command("set","output","off",*(v.var.split()))
+		except Exception as exc:
+			self.log(v,"Could not turn off: %s" % (exc,))
+		self.valve_state(vid,False,n)
+
+	def valve_state(self, vid, on, n=None):
+		"""\
+			A valve reports its state.
+
+			Returns True if starts which waited for this valve's controller
+			have been queued; the caller needs to call run() soon.
+			"""
+		v = self.valves.get(vid,None)
+		if v is None:
+			return False
+		c = v.controller
+		if on:
+			self.open[c.id].add(vid)
+			return False
+		self.open[c.id].discard(vid)
+		if n is None:
+			n = now()
+		id = self.running.get(vid,None)
+		if id is not None and not self.locked(vid):
+			# turned off early, by whatever: record how long it ran
+			from rainman.models import Schedule
+			del self.running[vid]
+			e = self.known[id]
+			if n < e.end:
+				Schedule.objects.filter(id=id).update(db_duration=int((n-e.start).total_seconds()))
+				self.known[id] = e._replace(end=n)
+
+		# Somebody may be waiting for this controller
+		woken = False
+		for id in self.waiting.pop(c.id,()):
+			e = self.known.get(id,None)
+			if e is not None:
+				self._push(n,"start",id,e)
+				woken = True
+		return woken
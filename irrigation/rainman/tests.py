@@ -38,3 +38,280 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+from django.test import SimpleTestCase
+
+class EnvFactorTest(SimpleTestCase):
+    def test_env_factors(self):
+        from rainman.envfactor import EnvFactors
+        from rainman.management.commands.benchenv import synthetic, old_factor, Hist
+        its,hs = synthetic(2,12)
+        ef = EnvFactors(its)
+        for h in hs:
+            self.assertAlmostEqual(ef.factor(h), old_factor(its,h))
+        self.assertEqual(ef.misses, len(hs))
+        ef.factors(hs)
+        self.assertEqual(ef.hits, len(hs))
+
+        # a changed history entry is recalculated
+        h = hs[0]
+        ef.factor(Hist(h.id,h.temp+1,h.wind,h.sun))
+        self.assertEqual(ef.misses, len(hs)+1)
+
+        # exact match
+        it = its[0]
+        self.assertAlmostEqual(ef.factor_one((True,True,True), Hist(None,it.temp,it.wind,it.sun)), it.factor)
+        # missing data
+        self.assertIsNone(ef.factor_one((True,False,False), Hist(None,None,1,1)))
+
+class IntervalSetTest(SimpleTestCase):
+    def _random(self, r, n):
+        res = []
+        t = r.randint(0,50)
+        for i in range(n):
+            l = r.randint(1,60)
+            res.append((t,l))
+            t += l+r.randint(0,60) # may touch
+        return res
+
+    def test_against_range_functions(self):
+        from random import Random
+        from rainman.intervals import IntervalSet
+        from rainman.utils import range_union,range_intersection,range_invert,range_coalesce
+        r = Random(42)
+        for k in range(1000):
+            a,b,c = (self._random(r,r.randint(0,8)) for i in range(3))
+            A,B,C = IntervalSet(a),IntervalSet(b),IntervalSet(c)
+            self.assertEqual(list(range_union(a,b,c)), list(A|B|C))
+            self.assertEqual(list(range_intersection(a,b,c)), list(A&B&C))
+            self.assertEqual(list(range_coalesce(sorted(a+b))), list(A|B))
+            s,l = r.randint(0,300),r.randint(1,400)
+            self.assertEqual(list(range_invert(s,l,a)), list(A.invert(s,l)))
+
+    def test_ops(self):
+        from datetime import datetime,timedelta
+        from rainman.intervals import IntervalSet, cached, invalidate
+        s = IntervalSet(((10,5),(30,10),(15,5)))
+        self.assertEqual(list(s), [(10,10),(30,10)])
+        self.assertIn(19, s)
+        self.assertNotIn(20, s)
+        self.assertEqual(s.find(35), (30,10))
+        s.remove(12,20)
+        self.assertEqual(list(s), [(10,2),(32,8)])
+        self.assertEqual(list(s.clip(11,35)), [(11,1),(32,3)])
+
+        t = datetime(2016,1,1)
+        h = timedelta(0,3600)
+        d = IntervalSet(((t,h),(t+2*h,h)))
+        self.assertEqual(list(d.invert(t,4*h)), [(t+h,h),(t+3*h,h)])
+
+        n = []
+        def fill():
+            n.append(1)
+            return ((1,2),)
+        self.assertEqual(list(cached("x",fill)), [(1,2)])
+        cached("x",fill)
+        self.assertEqual(len(n), 1)
+        invalidate()
+        cached("x",fill)
+        self.assertEqual(len(n), 2)
+
+class PlanTest(SimpleTestCase):
+    def test_plan(self):
+        from collections import namedtuple
+        from rainman.plan import Plan
+        V = namedtuple("V","id controller_id feed_id")
+        S = namedtuple("S","valve start")
+        plan = Plan([], None)
+        plan.valves = [V(1,1,1),V(2,2,2),V(3,1,3),V(4,3,3),V(5,4,4)]
+        self.assertEqual([[v.id for v in c] for c in plan.components()], [[1,3,4],[2],[5]])
+
+        v = plan.valves[0]
+        for t in (5,1,3):
+            plan.add(S(v,t))
+        self.assertEqual([s.start for s in plan.schedules("valve",1,2)], [3,5])
+        self.assertEqual([s.start for s in plan.schedules("controller",1,0,5)], [1,3])
+        self.assertEqual(plan.schedules("feed",2,0), [])
+        self.assertEqual(len(plan.new), 3)
+
+from datetime import timedelta
+from rainman.utils import now
+
+class SiteSchedulerTest(TestCase):
+    def setUp(self):
+        from rainman.models import Site,Controller,Feed,EnvGroup,Valve
+        from rainman.scheduler import SiteScheduler
+        self.site = Site.objects.create(name="test", var="test")
+        self.c = Controller.objects.create(name="c", var="c", site=self.site, location="here", max_on=1)
+        f = Feed.objects.create(name="f", site=self.site)
+        eg = EnvGroup.objects.create(name="e", site=self.site)
+        self.v1 = Valve.objects.create(name="v1", var="out one", feed=f, controller=self.c, envgroup=eg, location="1", flow=1, area=1)
+        self.v2 = Valve.objects.create(name="v2", var="out two", feed=f, controller=self.c, envgroup=eg, location="2", flow=1, area=1)
+        self.calls = []
+        self.sched = SiteScheduler(self.site, self.send_command)
+
+    def send_command(self, *a, **k):
+        t = None
+        for x in k.get('sub',()):
+            if x[0] == "for":
+                t = x[1]
+        self.calls.append(a[2:] + (t,))
+
+    def add(self, v, start, duration):
+        from rainman.models import Schedule
+        return Schedule.objects.create(valve=v, start=self.n+timedelta(0,start), db_duration=duration)
+
+    def at(self, t):
+        return self.sched.run(self.n+timedelta(0,t))
+
+    def test_run(self):
+        from rainman.models import Schedule
+        self.n = now()
+        self.add(self.v1, 10,60)
+        s2 = self.add(self.v2, 20,60)
+        s3 = self.add(self.v1, 3600,30)
+        self.sched.refresh(self.n)
+        self.assertEqual(self.at(0), self.n+timedelta(0,10))
+
+        self.assertEqual(self.at(10), self.n+timedelta(0,20))
+        self.assertEqual(self.calls, [("on","out","one",60)])
+        self.assertEqual(self.sched.open[self.c.id], set((self.v1.id,)))
+
+        # max_on is 1: v2 has to wait for v1
+        self.at(20)
+        self.assertEqual(len(self.calls), 1)
+        self.assertFalse(Schedule.objects.get(id=s2.id).seen)
+        self.at(70)
+        self.assertEqual(self.calls[1:], [("off","out","one",None),("on","out","two",60)])
+        s2 = Schedule.objects.get(id=s2.id)
+        self.assertTrue(s2.seen)
+        self.assertEqual(s2.start, self.n+timedelta(0,70))
+
+        # Changes are picked up with a single query
+        s3.delete()
+        self.add(self.v1, 7200,30)
+        with self.assertNumQueries(1):
+            self.sched.refresh(self.n+timedelta(0,80))
+        self.assertEqual(self.at(130), self.n+timedelta(0,7200))
+        self.assertEqual(self.calls[3:], [("off","out","two",None)])
+
+        # turned off early
+        self.at(7200)
+        self.sched.valve_state(self.v1.id, False, self.n+timedelta(0,7210))
+        self.assertEqual(self.sched.current(self.v1.id), None)
+        self.assertEqual(self.sched.open[self.c.id], set())
+        self.assertEqual(Schedule.objects.get(valve=self.v1, start=self.n+timedelta(0,7200)).db_duration, 10)
+
+    def test_wake(self):
+        self.n = now()
+        self.add(self.v1, 10,60)
+        self.add(self.v2, 20,60)
+        self.sched.refresh(self.n)
+        self.at(10)
+        self.assertEqual(self.at(20), self.n+timedelta(0,70))
+        self.assertEqual(len(self.calls), 1)
+
+        # v1 is closed early: the waiting start is due now, not at v1's end
+        self.assertFalse(self.sched.valve_state(self.v1.id, True, self.n+timedelta(0,25)))
+        self.assertTrue(self.sched.valve_state(self.v1.id, False, self.n+timedelta(0,30)))
+        self.assertEqual(self.sched.next_time(), self.n+timedelta(0,30))
+        self.at(30)
+        self.assertEqual(self.calls[1:], [("on","out","two",60)])
+
+class LevelTest(TestCase):
+    def setUp(self):
+        from rainman.models import Site,Controller,Feed,EnvGroup,EnvItem,Valve,Level,History
+        from rainman.envfactor import invalidate
+        invalidate()
+        self.n = n = now()
+        self.site = Site.objects.create(name="test", var="test")
+        c = Controller.objects.create(name="c", var="c", site=self.site, location="here")
+        f = Feed.objects.create(name="f", site=self.site)
+        eg = EnvGroup.objects.create(name="e", site=self.site, factor=1.2)
+        EnvItem.objects.create(group=eg, factor=0.5, temp=10)
+        EnvItem.objects.create(group=eg, factor=2, temp=30)
+        t = n-timedelta(0,3600)
+        for i,(temp,rain) in enumerate(((12,0),(25,0.5),(None,0),(31,0))):
+            History.objects.create(site=self.site, time=t+timedelta(0,600*(i+1)), temp=temp, rain=rain)
+        self.valves = []
+        for i,(level,shade,runoff,last) in enumerate(((5,1,1,1800),(-2,0.5,0.8,None),(12,1,1,3000))):
+            v = Valve.objects.create(name="v%d"%i, var="out %d"%i, feed=f, controller=c, envgroup=eg, location=str(i), flow=1, area=2, level=level, shade=shade, runoff=runoff, time=n-timedelta(0,4000))
+            if last is not None:
+                Level.objects.create(valve=v, time=n-timedelta(0,last), level=level)
+            self.valves.append(v)
+        self.flows = {self.valves[0].id:10, self.valves[2].id:4}
+
+    def old_levels(self):
+        """per-valve calculation, as runschedule did it"""
+        from django.db.models import F
+        from rainman.models import Level
+        res = {}
+        for v in self.valves:
+            v.refresh()
+            flow = self.flows.get(v.id,0)
+            try:
+                ts = v.levels.order_by("-time")[0].time
+            except IndexError:
+                ts = self.n-timedelta(1,0)
+            sum_f = sum_r = 0
+            for h in self.site.history.filter(time__gt=ts).order_by("time"):
+                f = v.envgroup.env_factor(h)*v.adj
+                sum_f += self.site.db_rate * v.do_shade(v.envgroup.factor*f) * (h.time-ts).total_seconds()
+                sum_r += v.runoff*h.rain
+                ts = h.time
+            if v.time == ts:
+                continue
+            level = 0 if v.level < 0 else F('level')
+            level += sum_f
+            if (flow > 0 or sum_r > 0) and v.level > v.max_level:
+                level = v.max_level
+            level -= flow/v.area+sum_r
+            v.update(time=ts, level=level)
+            v.refresh()
+            Level(valve=v,time=ts,level=v.level,flow=flow).save()
+            res[v.id] = (ts,v.level)
+        return res
+
+    def state(self):
+        from rainman.models import Valve,Level
+        return (list(Valve.objects.order_by("id").values_list("id","time","level")),
+            list(Level.objects.order_by("valve","time").values_list("valve","time","level","flow")))
+
+    def test_levels(self):
+        from django.db import transaction
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        from rainman.levels import update_levels
+        ids = [v.id for v in self.valves]
+
+        with transaction.atomic():
+            sid = transaction.savepoint()
+            old = self.old_levels()
+            old_state = self.state()
+            transaction.savepoint_rollback(sid)
+
+        with CaptureQueriesContext(connection) as q:
+            new = update_levels(self.site, ids, lambda vid: self.flows.get(vid,0), n=self.n)
+        self.assertEqual(len(new), 3)
+        self.assertEqual(sorted(new), sorted(old))
+        # the history actually changed something
+        for v,level in zip(self.valves,(5,-2,12)):
+            self.assertNotAlmostEqual(new[v.id][1], level)
+        for id in new:
+            self.assertEqual(new[id][0], old[id][0])
+            self.assertAlmostEqual(new[id][1], old[id][1])
+        st = self.state()
+        self.assertEqual(len(st[1]), len(old_state[1]))
+        for a,b in zip(st[0]+st[1], old_state[0]+old_state[1]):
+            self.assertEqual(a[:2], b[:2])
+            self.assertAlmostEqual(a[2], b[2])
+        n_queries = len(q)
+
+        # more valves don't need more queries
+        from rainman.models import Valve
+        v = self.valves[0]
+        for i in range(3):
+            Valve.objects.create(name="w%d"%i, var="more %d"%i, feed=v.feed, controller=v.controller, envgroup=v.envgroup, location="w", flow=1, area=1, time=self.n-timedelta(0,4000))
+        with CaptureQueriesContext(connection) as q:
+            update_levels(self.site, Valve.objects.values_list("id",flat=True), lambda vid: 0, n=self.n)
+        self.assertEqual(len(q), n_queries)
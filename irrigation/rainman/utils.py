@@ -117,7 +117,10 @@ class StoredIter(object):
 def range_coalesce(it):
 	"""Returns an iterator which returns the union of overlapping (start,length) pairs."""
 	it = iter(it)
-	ra,rl = six.next(it)
+	try:
+		ra,rl = six.next(it)
+	except StopIteration:
+		return
 	while True:
 		try:
 			sa,sl = six.next(it)
@@ -185,49 +188,51 @@ def _range_intersection(*a):
 		which are the intersection of all the start+length tuples in a.
 		"""
 	head = [StoredIter(range_coalesce(ax)) for ax in a]
+	try:
+		ra,rl = head[0].stored
 
-	ra,rl = head[0].stored
-
-	while True:
-		found=True
-		for ax in head:
-			sa,sl = ax.stored
-			while sa+sl <= ra:
-				sa,sl = ax.next
-			if rl is not None and ra+rl <= sa:
-				ra,rl=sa,sl
-				found=False
-				break
-			if ra<sa:
-				if rl is None:
-					rl=sl
-				else:
-					rl-=sa-ra
-				ra=sa
-			elif rl is None:
-				rl=sl-(ra-sa)
-			if ra+rl>sa+sl:
-				rl=sa+sl-ra
+		while True:
+			found=True
+			for ax in head:
+				sa,sl = ax.stored
+				while sa+sl <= ra:
+					sa,sl = ax.next
+				if rl is not None and ra+rl <= sa:
+					ra,rl=sa,sl
+					found=False
+					break
+				if ra<sa:
+					if rl is None:
+						rl=sl
+					else:
+						rl-=sa-ra
+					ra=sa
+				elif rl is None:
+					rl=sl-(ra-sa)
+				if ra+rl>sa+sl:
+					rl=sa+sl-ra
 
-			# test for rl<=0, except we don't know this type's zero
-			# so restart at sa/sl
-			if ra+rl<=ra:
-				if sa < ra:
-					rl = sl+sa-ra
-				else:
-					rl = sl
-				ra = sa
-				found=False
-				break
-		if found:
-			yield (ra,rl)
-			ra += rl
-			rl = None
+				# test for rl<=0, except we don't know this type's zero
+				# so restart at sa/sl
+				if ra+rl<=ra:
+					if sa < ra:
+						rl = sl+sa-ra
+					else:
+						rl = sl
+					ra = sa
+					found=False
+					break
+			if found:
+				yield (ra,rl)
+				ra += rl
+				rl = None
+	except StopIteration: # some input has ended
+		return
 
 def range_invert(ra,rl,a):
 	for sa,sl in a:
-		if sa > ra+rl:
-			return
+		if sa >= ra+rl:
+			break
 		if sa+sl <= ra:
 			continue
 		if sa>ra:
@@ -29,6 +29,7 @@ import os
 import sys
 from moat.script import Command, CommandError
 from moat.util import r_dict
+from moat.types.etcd import load_all
 from moat.dev import DEV_DIR,DEV
 from moat.dev.base import Device
 from etcd_tree import EtcTypes,EtcInteger
@@ -75,7 +76,7 @@ Device ID: detailed information about the device.
 				s = [x for x in arg.split('/') if x != '']
 				t = await tree.subdir(arg, recursive=False)
 				async for dev in t.tagged(DEV):
-					self.do_entry(dev)
+					await self.do_entry(dev)
 			return
 
 		for arg in args:
@@ -99,11 +100,12 @@ Device ID: detailed information about the device.
 						continue
 					print('/'.join(rr.path[len(DEV_DIR):]), len(rr.keys()), sep='\t',file=self.stdout)
 				if dev:	
-					self.do_entry(res[DEV], not looped)
+					await self.do_entry(res[DEV], not looped)
 
-	def do_entry(self,dev, do_verbose=False):
+	async def do_entry(self,dev, do_verbose=False):
 		path = '/'.join(dev.path[len(DEV_DIR):-1])
 		if do_verbose or self.root.verbose > 2:
+			dev = await load_all(dev)
 			safe_dump({path: r_dict(dev)}, stream=self.stdout)
 		else:
 			print(path, dev.__class__.name, dev.get('location','-'), sep='\t',file=self.stdout)
@@ -39,6 +39,7 @@ from collections.abc import Mapping
 from moat.script import Command, SubCommand, CommandError
 from moat.infra import INFRA_DIR, INFRA, LinkExistsError
 from moat.util import r_dict, r_show
+from moat.types.etcd import load_all
 from moat.cmd.task import _ParamCommand
 
 import logging
@@ -100,6 +101,8 @@ a one-line summary, human-readable detailed state, or details as YAML.
                         pass
                     if n:
                         continue
+                if self.root.verbose > 1:
+                    await load_all(item)
                 if self.root.verbose == 2:
                     print('*','.'.join(path[::-1]), sep='\t',file=self.stdout)
                     for k,v in r_show(item,''):
@@ -507,76 +510,6 @@ Links are bidirectional.
                 else:
                     print("Port %s:%s is linked to %s:%s. Use '-r'." % (port.host.dnsname, port.name, rem.host.dnsname,rem.name), file=sys.stderr)
 
-def VL(x):
-    if x == '-':
-        return set()
-    elif x == '*':
-        return set(('*',))
-    return set(int(v) for v in x.split(','))
-
-class NoVlanError(RuntimeError):
-    pass
-
-class CDict(dict):
-    def add(self,k):
-        self[k] = self.get(k,0)+1
-    def keys(self):
-        for k,v in self.items():
-            if v > 1:
-                yield k
-    def __ior__(self, kk):
-        for k in kk:
-            self.add(k)
-        return self
-
-class VlanInfo:
-    def __init__(self, host, t, verbose=1, seen=None):
-        self.t = t
-        self.verbose = verbose
-        self.host = host
-        self.ports = dict()  # name > vli
-        self.vlans = CDict()
-
-    def __repr__(self):
-        return "<vli:%s>" % (self.host.dnsname,)
-
-    async def extend(self, seen=None):
-        sn = self.host.dnsname
-        if seen is None:
-            seen = set()
-        elif sn in seen:
-            return
-        seen.add(sn)
-        try:
-            v = VL(self.host['vlan'])
-        except KeyError:
-            raise NoVlanError(self.host.dnsname)
-        if not v:
-            return
-        self.vlans |= v
-        try:
-            pp = self.host['ports']
-        except KeyError:
-            return
-        for n,p in pp.items():
-            if 'vlan' in p:
-                v = VL(p['vlan'])
-                try:
-                    h = p['host']
-                except KeyError:
-                    h = None
-            else:
-                try:
-                    h = p['host']
-                except KeyError:
-                    continue
-                hv = await self.t.host(h, create=False)
-                hv = VlanInfo(hv, self.t, verbose=self.verbose)
-                await hv.extend(seen)
-                v = hv.vlans
-            self.ports[n] = (v,h)
-            self.vlans |= v
-
 class VlanCommand(DefSetup,Command):
     name = "vlan"
     summary = "Show per-port VLAN configuration"
@@ -608,8 +541,7 @@ Special VLANs (only on hosts) are
             raise SyntaxError("You need to specify host+port of both sides.") 
         elif len(args) == 1:
             h = await t.host(args[0],create=False)
-            vli = VlanInfo(h,t)
-            await vli.extend()
+            vli = (await t.graph()).vlan_info(h.dnsname)
             if self.options.vlans:
                 for vl in sorted(-1 if v == '*' else v for v in vli.vlans.keys()):
                     print('*' if vl==-1 else vl, ' '.join(sorted(str(p) for p,v in vli.ports.items() if ('*' if vl==-1 else vl) in v[0])))
@@ -649,58 +581,19 @@ Links are unidirectional.
             raise SyntaxError("Usage: … link HOST_A [HOST_B]")
 
         elif len(args) == 1: ## list unreachables
-            hosts = [t.host(args[0])]
-            known = set()
-            while hosts:
-                h = await hosts.pop()
-                known.add(h.dnsname)
-                try:
-                    x = h['ports'].values()
-                except KeyError:
-                    pass
-                else:
-                    for v in x:
-                        try:
-                            v = v.get('host', raw=True)
-                        except KeyError:
-                            pass
-                        else:
-                            if v.value not in known:
-                                hosts.append(v.host)
-            async for h in t.tagged(INFRA):
-                name = h.dnsname
-                if name not in known:
-                    print(name)
+            h = await t.host(args[0])
+            for name in (await t.graph()).unreachable(h.dnsname):
+                print(name)
 
         else: ## list links
+            src = await t.host(args[0])
             dest = await t.host(args[1])
-            dname = dest.dnsname
-            hosts = [t.host(args[0])]
-            prevs = {args[0]: None}
-            while hosts:
-                h = await hosts.pop(0)
-                try:
-                    hp = h['ports']
-                except KeyError:
-                    continue
-                for v in hp.values():
-                    try:
-                        v = v.get('host', raw=True)
-                    except KeyError:
-                        continue
-                    if v.value == dname:
-                        def prev_p(name):
-                            if name is None:
-                                return
-                            prev_p(prevs[name])
-                            print(name)
-                        prev_p(h.dnsname)
-                        print(v.value)
-                        return
-                    if v.value not in prevs:
-                        prevs[v.value] = h.dnsname
-                        hosts.append(v.host)
-            print("Unreachable.", file=sys.stderr)
+            path = (await t.graph()).path(src.dnsname, dest.dnsname)
+            if path is None:
+                print("Unreachable.", file=sys.stderr)
+                return
+            for name in path:
+                print(name)
 
 class InfraCommand(SubCommand):
         name = "infra"
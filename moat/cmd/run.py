@@ -29,14 +29,15 @@ import asyncio
 import os
 import signal
 import sys
+from collections import deque
 from contextlib import suppress
+from time import time
 
 from ..script import Command, CommandError
 from ..script.task import TaskMaster, JobIsRunningError, JobMarkGoneError
 from ..task import TASK_DIR,TASK, TASKSTATE_DIR,TASKSTATE
 from etcd_tree.node import EtcDir
 from functools import partial
-from itertools import chain
 import traceback
 
 import logging
@@ -113,12 +114,11 @@ Run MoaT tasks.
 				args = [TASK_DIR+(self.root.app,)]
 		self.args = args
 		self.paths = []
-		self._monitors = []
-		self.tasks = []
 		self.jobs = {}
-		amqp.debug_env(jobs=self.jobs)
+		self._setup()
+		amqp.debug_env(jobs=self.jobs, run_state=self.state)
 		self.old_jobs = set()
-		self.rescan = asyncio.Future(loop=self.root.loop)
+		self.tilt.add_done_callback(self._done.put_nowait)
 		for t in self.args:
 			try:
 				tx = await tree.subdir(t, create=False)
@@ -127,9 +127,10 @@ Run MoaT tasks.
 				res = 2
 			else:
 				self.paths.append(tx)
-				self._monitors.append(tx.add_monitor(self._rescan))
 		if res:
 			return res
+		for tx in self.paths:
+			self._watch(tx, self.options.this-1)
 		await self._scan()
 		if not self.tasks:
 			if self.root.verbose:
@@ -143,7 +144,10 @@ Run MoaT tasks.
 		try:
 			res = await self._loop()
 		finally:
-			amqp.debug_env(jobs=None)
+			amqp.debug_env(jobs=None, run_state=None)
+			for mon in self._dirs.values():
+				mon.cancel()
+			self._dirs = {}
 
 		return res
 
@@ -152,12 +156,17 @@ Run MoaT tasks.
 		try:
 			while self.jobs or self.options.run:
 				logger.debug("Task Jobs %s",dict(self.jobs))
-				done,pending = await asyncio.wait(chain((self.tilt,self.rescan),self.jobs.values()), loop=self.root.loop, return_when=asyncio.FIRST_COMPLETED)
-				logger.debug("Task DP %s %s",done,pending)
+				done = [await self._done.get()]
+				while not self._done.empty():
+					done.append(self._done.get_nowait())
+				logger.debug("Task Done %s",done)
 				for j in done:
-					if j in (self.tilt,self.rescan):
+					if j is None or j is self.tilt:
+						continue
+					if self.jobs.get(j.name,None) is not j:
 						continue
 					del self.jobs[j.name]
+					self.state['ended'] += 1
 					try:
 						r = j.result()
 					except asyncio.CancelledError:
@@ -167,8 +176,10 @@ Run MoaT tasks.
 							print(j.name,'*CANCELLED*', sep='\t', file=self.stdout)
 					except JobIsRunningError as exc:
 						errs += 1
+						self.state['errors'] += 1
 					except Exception as exc:
 						errs += 1
+						self.state['errors'] += 1
 						logger.exception("Running %s", j.name)
 						if self.root.verbose:
 							print(j.name,'*ERROR*', exc, sep='\t', file=self.stdout)
@@ -182,12 +193,13 @@ Run MoaT tasks.
 							print(j.name,r, sep='\t', file=self.stdout)
 						if self.options.oneshot:
 							self.old_jobs.add(j.name)
+				self.state['jobs'] = len(self.jobs)
 				if self.tilt.done():
 					self.tilt.result() # re-raises any exception
 					break
-				if self.rescan.done():
+				if self.rescan:
 					logger.debug("rescanning %s",self)
-					self.rescan = asyncio.Future(loop=self.root.loop)
+					self.rescan = False
 					await self._scan()
 					await self._start()
 
@@ -214,33 +226,87 @@ Run MoaT tasks.
 		return errs
 
 		
+	def _setup(self):
+		"""\
+			Set up the task index.
+
+			Every directory below the given paths has a monitor which
+			queues the names of added entries and drops deleted ones from
+			the index right away. _scan() only looks at the queued names,
+			so a change doesn't re-walk the whole task tree.
+			"""
+		self.tasks = [] # newly-found tasks, to be started
+		self.index = {} # path => task node
+		self.gone = set() # names of vanished tasks, to be stopped
+		self._dirs = {} # path => monitor
+		self._pending = deque() # (dir,depth,names) to look at
+		self._done = asyncio.Queue(loop=self.root.loop) # finished jobs; None: rescan
+		self.rescan = False
+		self.state = dict(tasks=0, jobs=0, started=0, ended=0, errors=0, scans=0, scan_time=0.0)
+
 	def _rescan(self,_=None):
-		if not self.rescan.done():
+		if not self.rescan:
 			logger.debug("rescanning2")
-			self.rescan.set_result(None)
+			self.rescan = True
+			self._done.put_nowait(None)
 		else:
 			logger.debug("NOT rescanning")
 
+	def _watch(self, t, depth):
+		"""Index directory @t, which may contain tasks if @depth < 2"""
+		if t.path in self._dirs:
+			return
+		if not t.is_ready:
+			# the monitor will report the initial content when it's ready
+			self._pending.append((t,depth,set(t.keys())))
+		self._dirs[t.path] = t.add_monitor(partial(self._changed,depth))
+
+	def _changed(self, depth, t):
+		"""Monitor callback for an indexed directory"""
+		if t.is_new is None:
+			self._drop(t.path)
+		elif t.added or t.deleted:
+			for k in t.deleted:
+				self._drop(t.path+(k,))
+			if t.added:
+				self._pending.append((t,depth,set(t.added)))
+		else:
+			return
+		self._rescan()
+
+	def _drop(self, path):
+		"""Forget about everything at or below @path"""
+		n = len(path)
+		for p in [p for p in self._dirs if p[:n] == path]:
+			self._dirs.pop(p).cancel()
+		for p in [p for p in self.index if p[:n] == path]:
+			del self.index[p]
+			self.gone.add('/'.join(p[len(TASK_DIR):-1]))
+
 	async def _scan(self):
-		depth = self.options.this
-		p = self.paths
-		while p:
-			depth -= 1
-			n_p = []
-			for t in p:
-				for k,v in t.items():
-					v = await v
-					if k == TASK:
-						if depth < 2:
-							self.tasks.append(v)
-					elif k.startswith(':'):
-						continue
-					elif isinstance(v,EtcDir):
-						n_p.append(v)
-			logger.debug("SCANned %d %s %s",depth,p,n_p)
-			p = n_p
-			if not depth:
-				break
+		t1 = time()
+		while self._pending:
+			t,depth,names = self._pending.popleft()
+			if t.is_new is None:
+				continue
+			for k in names:
+				if k.startswith(':') and k != TASK:
+					continue
+				try:
+					v = await t[k]
+				except KeyError:
+					continue # deleted already
+				if k == TASK:
+					if depth < 2 and v.path not in self.index:
+						self.index[v.path] = v
+						self.tasks.append(v)
+						self.gone.discard('/'.join(v.path[len(TASK_DIR):-1]))
+				elif isinstance(v,EtcDir) and depth != 0:
+					self._watch(v, depth-1)
+		self.state['tasks'] = len(self.index)
+		self.state['scans'] += 1
+		self.state['scan_time'] += time()-t1
+		logger.debug("SCANned: %s",self.state)
 
 	async def _start(self):
 		logger.debug("START")
@@ -261,7 +327,7 @@ Run MoaT tasks.
 					print('/'.join(path),state, *value, sep='\t', file=self.stdout)
 
 		js = {}
-		old = set(self.jobs)
+		old,self.gone = self.gone,set()
 		logger.debug("OLD %s",old)
 
 		args = {}
@@ -274,11 +340,11 @@ Run MoaT tasks.
 
 		while self.tasks:
 			t = self.tasks.pop()
+			if t.path not in self.index:
+				continue # vanished in the meantime
 			path = t.path[len(TASK_DIR):-1]
 			name = '/'.join(path)
-			if name in old:
-				old.remove(name)
-				continue
+			old.discard(name)
 			if name in self.jobs:
 				continue
 			if name in self.old_jobs:
@@ -292,7 +358,7 @@ Run MoaT tasks.
 				f = asyncio.Future(loop=self.root.loop)
 				f.set_exception(exc)
 				f.name = f.path = path
-				self.jobs[name] = f
+				self._add_job(f)
 				if self.options.oneshot:
 					return
 			else:
@@ -314,18 +380,25 @@ Run MoaT tasks.
 				f.set_exception(exc)
 				f.path = j.path
 				f.name = j.name
-				self.jobs[j.name] = f
+				self._add_job(f)
 
 				if self.options.oneshot or isinstance(exc,asyncio.CancelledError):
 					return
 			else:
 				logger.debug("AddJob TM %s",j.name)
-				self.jobs[j.name] = j
+				self._add_job(j)
+		self.state['jobs'] = len(self.jobs)
 
 		for path in old:
-			j = self.jobs[path]
+			j = self.jobs.get(path,None)
+			if j is None:
+				continue
 			logger.info('CANCEL 3 %s',j)
 			j.cancel()
 			with suppress(asyncio.CancelledError):
 				await j
 
+	def _add_job(self, j):
+		self.jobs[j.name] = j
+		self.state['started'] += 1
+		j.add_done_callback(self._done.put_nowait)
@@ -28,6 +28,7 @@ from __future__ import absolute_import, print_function, division, unicode_litera
 import asyncio
 import os
 import sys
+import json
 import time
 import types as py_types
 from contextlib import suppress
@@ -40,6 +41,7 @@ from moat.script.task import Task
 from moat.task import TASK,TASK_DIR, TASKDEF,TASKDEF_DIR, TASKSTATE,TASKSTATE_DIR, TASKSCAN_DIR, task_types
 from moat.types.module import BaseModule
 from moat.util import r_dict,r_show
+from moat.types.etcd import load_all
 
 import aio_etcd as etcd
 
@@ -141,6 +143,7 @@ details are shown in YAML format, else a short list of names is shown.
 			async for task in tt.tagged(TASKDEF):
 				path = task.path[len(TASKDEF_DIR):-1]
 				if verbose:
+					await load_all(task)
 					dump({path: r_dict(dict(task))}, stream=self.stdout)
 				else:
 					print('/'.join(path),task.get('summary',task.get('descr','??')), sep='\t',file=self.stdout)
@@ -386,6 +389,8 @@ a one-line summary, human-readable detailed state, or details as YAML.
 		for tt in dirs:
 			async for task in tt.tagged(TASK, depth=self.options.this):
 				path = task.path[len(TASK_DIR):-1]
+				if self.root.verbose > 1:
+					await load_all(task)
 				if self.root.verbose == 2:
 					print('*','/'.join(path), sep='\t',file=self.stdout)
 					for k,v in r_show(task,''):
@@ -568,6 +573,8 @@ class StateCommand(Command):
 The status of running tasks is stored in etcd at /status/run/task/**/:task.
 
 This command shows that information.
+
+With --perf, the tasks which used the most CPU time are listed instead.
 """
 
 	def addOptions(self):
@@ -583,6 +590,12 @@ This command shows that information.
 		self.parser.add_option('-c','--completed',
 			action="store_true", dest="completed",
 			help="Only list completed jobs")
+		self.parser.add_option('-p','--perf',
+			action="store_true", dest="perf",
+			help="List the jobs' run-time statistics, most expensive first")
+		self.parser.add_option('-n','--top',
+			action="store", dest="top", type="int", default=10,
+			help="Number of jobs to list with --perf (default: 10)")
 
 	async def do(self,args):
 		await self.root.setup()
@@ -605,6 +618,7 @@ This command shows that information.
 		sel_completed = self.options.completed
 		if not (self.options.completed or self.options.running or self.options.error):
 			sel_running = sel_error = sel_completed = True
+		perf = []
 
 		for tt in dirs:
 			async for task in tt.tagged(TASKSTATE, depth=self.options.this):
@@ -624,7 +638,12 @@ This command shows that information.
 					date = datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M:%S')
 
 				if sel_running if state == 'run' else (sel_completed if state == 'ok' else sel_error):
-					if self.root.verbose == 2:
+					if self.options.perf or self.root.verbose > 1:
+						await load_all(task)
+					if self.options.perf:
+						if 'perf' in task:
+							perf.append(('/'.join(path),state,json.loads(task['perf'])))
+					elif self.root.verbose == 2:
 						print('*','/'.join(path), sep='\t', file=self.stdout)
 						for k,v in task.items():
 							if isinstance(v,(float,int)) and 1000000000 < v < 10000000000:
@@ -639,6 +658,18 @@ This command shows that information.
 					else:
 						print('/'.join(path),state,date,task.get('message','-'), sep='\t', file=self.stdout)
 
+		if self.options.perf:
+			perf.sort(key=lambda x: x[2].get('cpu',0), reverse=True)
+			if self.root.verbose:
+				print("job","state","cpu","load","iter","wall_avg","wall_max","io_avg","lag_max","overruns", sep='\t', file=self.stdout)
+			for path,state,p in perf[:self.options.top]:
+				if self.root.verbose > 1:
+					dump({path:p}, stream=self.stdout)
+					continue
+				print(path,state, "%.3f"%p.get('cpu',0), "%.1f%%"%(p.get('load',0)*100), int(p.get('iterations',0)),
+					*("%.3f"%p[k] if k in p else '-' for k in ('wall_avg','wall_max','io_avg','lag_max')),
+					int(p.get('overruns',0)), sep='\t', file=self.stdout)
+
 class TaskCommand(SubCommand):
 	name = "task"
 	summary = "Configure and define tasks"
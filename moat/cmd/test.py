@@ -337,6 +337,68 @@ exchanges and queues.
 	async def do(self,args):
 		pass
 
+class OnewireLoadCommand(Command):
+	name = "onewire-load"
+	summary = "Benchmark 1wire access against a simulated owserver"
+	description = """\
+Start a simulated owserver with a virtual topology, and measure
+throughput of bus scans, polls and temperature sweeps.
+
+This test is not run by default.
+"""
+	explicit = True
+
+	def addOptions(self):
+		self.parser.add_option('-b','--buses',
+			action="store", dest="buses", type="int", default=4,
+			help="number of root buses")
+		self.parser.add_option('-t','--thermo',
+			action="store", dest="thermo", type="int", default=1000,
+			help="number of DS18x20 thermometers")
+		self.parser.add_option('-s','--switches',
+			action="store", dest="switches", type="int", default=200,
+			help="number of DS2405 switches")
+		self.parser.add_option('-c','--couplers',
+			action="store", dest="couplers", type="int", default=20,
+			help="number of DS2409 couplers")
+		self.parser.add_option('-C','--per-coupler',
+			action="store", dest="per_coupler", type="int", default=10,
+			help="number of thermometers on each coupler branch")
+		self.parser.add_option('-d','--delay',
+			action="store", dest="delay", type="float", default=0,
+			help="server latency per request (seconds)")
+		self.parser.add_option('-e','--errors',
+			action="store", dest="errors", type="float", default=0,
+			help="fraction of requests which fail")
+		self.parser.add_option('-B','--busy',
+			action="store", dest="busy", type="float", default=0,
+			help="fraction of requests which get 'server busy' replies")
+		self.parser.add_option('-p','--parallel',
+			action="store", dest="parallel", type="int", default=10,
+			help="number of concurrent requests")
+		self.parser.add_option('-r','--rounds',
+			action="store", dest="rounds", type="int", default=3,
+			help="number of test rounds")
+
+	async def do(self,args):
+		from moat.ext.onewire.sim import OnewireSimServer, make_topology, run_load
+		o = self.options
+		loop = self.root.loop
+		root = make_topology(buses=o.buses, thermo=o.thermo, switches=o.switches,
+			couplers=o.couplers, per_coupler=o.per_coupler, seed=1)
+		srv = OnewireSimServer(root, delay=o.delay, error_rate=o.errors, busy_rate=o.busy, seed=2, loop=loop)
+		await srv.start()
+		ow = srv.client()
+		try:
+			res = await run_load(ow, rounds=o.rounds, concurrency=o.parallel, loop=loop)
+		finally:
+			await ow.close()
+			await srv.stop()
+		for r in res:
+			print(r, file=self.stdout)
+		if self.root.verbose > 1:
+			print("server\t%(requests)d req\t%(errors)d err\t%(busy)d busy" % srv.stats, file=self.stdout)
+
 class KillCommand(Command):
 	name = "Kill"
 	description = """\
@@ -372,6 +434,7 @@ Set some data.
 		ErrorsCommand,
 		WebCommand,
 		AmqpCommand,
+		OnewireLoadCommand,
 	]
 	fix = False
 
@@ -395,7 +458,7 @@ Set some data.
 
 		res = 0
 		for c in self.subCommandClasses:
-			if c.summary is None:
+			if c.summary is None or getattr(c,'explicit',False):
 				continue
 			if self.root.verbose > 1:
 				print("Checking:",c.name)
@@ -38,6 +38,7 @@ from moat.script import Command, SubCommand, CommandError
 from moat.web import WEBDEF_DIR,WEBDEF, WEBDATA_DIR,WEBDATA, WEBSERVER_DIR,WEBSERVER, webdefs, WEBCONFIG
 from moat.web.base import WebdefDir, DefaultConfig
 from moat.util import r_dict, r_show
+from moat.types.etcd import load_all
 from moat.cmd.task import _ParamCommand
 
 import logging
@@ -131,6 +132,7 @@ details are shown in YAML format, else a short list of names is shown.
             async for web in tt.tagged(WEBDEF):
                 path = web.path[len(WEBDEF_DIR):-1]
                 if verbose:
+                    await load_all(web)
                     dump({path: r_dict(dict(web))}, stream=self.stdout)
                 else:
                     print('/'.join(path),web.get('summary',web.get('descr','??')), sep='\t',file=self.stdout)
@@ -338,6 +340,7 @@ details are shown in YAML format, else a short list of names is shown.
             async for web in tt.tagged(WEBSERVER):
                 path = web.path[len(WEBSERVER_DIR):-1]
                 if verbose:
+                    await load_all(web)
                     dump({path: r_dict(dict(web))}, stream=self.stdout)
                 else:
                     print('/'.join(path), web.get('host','-'), web.get('port',80), web.get('default','default'), web.get('descr',''), sep='\t',file=self.stdout)
@@ -499,6 +502,8 @@ a one-line summary, human-readable detailed state, or details as YAML.
         for tt in dirs:
             async for web in tt.tagged(WEBDATA, depth=self.options.this):
                 path = web.path[len(WEBDATA_DIR):-1]
+                if self.root.verbose > 1:
+                    await load_all(web)
                 if self.root.verbose == 2:
                     print('*','/'.join(path), sep='\t',file=self.stdout)
                     for k,v in r_show(web,''):
@@ -31,9 +31,84 @@ from moat.base import Name,SName
 from moat.check import Check
 from moat.context import Context
 
-from weakref import WeakValueDictionary,proxy
+from weakref import WeakValueDictionary,proxy,ref
+
+_LEAF = object() # trie node key of the entry itself
+
+class NameIndex(object):
+	"""\
+		A word trie over multi-word names.
+
+		longest() finds the longest registered prefix of a name without
+		constructing intermediate Name objects.
+
+		With weak=True, entries are dropped when their value goes away.
+		"""
+	def __init__(self, weak=False):
+		self.root = {}
+		self.weak = weak
+
+	def add(self, name, value):
+		if not isinstance(name,tuple):
+			name = (name,)
+		node = self.root
+		for w in name:
+			n = node.get(w,None)
+			if n is None:
+				node[w] = n = {}
+			node = n
+		if self.weak:
+			value = ref(value, lambda r: self._gone(name,r))
+		node[_LEAF] = value
+
+	def _gone(self, name, r):
+		self.remove(name, r)
+
+	def remove(self, name, value=None):
+		"""Remove an entry; if @value is given, only if it matches"""
+		if not isinstance(name,tuple):
+			name = (name,)
+		path = []
+		node = self.root
+		for w in name:
+			path.append((node,w))
+			node = node.get(w,None)
+			if node is None:
+				return
+		if value is not None and node.get(_LEAF,None) is not value:
+			return
+		node.pop(_LEAF,None)
+		while path and not node:
+			node,w = path.pop()
+			del node[w]
+
+	def clear(self):
+		self.root = {}
+
+	def longest(self, name, pos=0):
+		"""\
+			Look up the longest prefix of name[pos:].
+			Returns (value, index after the prefix) or (None,pos).
+			"""
+		node = self.root
+		res = None
+		end = pos
+		for i in range(pos,len(name)):
+			node = node.get(name[i],None)
+			if node is None:
+				break
+			v = node.get(_LEAF,None)
+			if v is not None:
+				res = v
+				end = i+1
+		if res is not None and self.weak:
+			res = res()
+			if res is None:
+				end = pos
+		return res,end
 
 collections = WeakValueDictionary()
+_index = NameIndex(weak=True) # of collections
 
 class Collection(dict):
 	"""\
@@ -71,9 +146,11 @@ class Collection(dict):
 		self.name = name
 
 		self._can_do = set()
+		self._index = NameIndex()
 		self.does("list")
 
 		collections[name] = self
+		_index.add(name,self)
 		return self
 
 	def __init__(self):
@@ -101,6 +178,23 @@ class Collection(dict):
 		name = SName(name)
 		return name in self._can_do
 
+	def __setitem__(self,k,v):
+		super(Collection,self).__setitem__(k,v)
+		self._index.add(k,v)
+
+	def __delitem__(self,k):
+		super(Collection,self).__delitem__(k)
+		self._index.remove(k)
+
+	def pop(self,k,*a):
+		res = super(Collection,self).pop(k,*a)
+		self._index.remove(k)
+		return res
+
+	def clear(self):
+		super(Collection,self).clear()
+		self._index.clear()
+
 	def items(self):
 		for k in sorted(self.keys(), key=lambda x:self[x].name):
 			yield k,self[k]
@@ -201,36 +295,46 @@ class CCollError(KeyError):
 	def __str__(self):
 		return u"‹%s› is a group, not an item." % (SName(self.name),)
 
+def _get_item(coll, name, i):
+	"""Look up @name[i:] in @coll the slow way. Returns (item, next i)."""
+	if not hasattr(coll,'__getitem__'):
+		raise CKeyError(name[i:],coll)
+	for j in range(len(name),i,-1):
+		try:
+			return coll[Name(*name[i:j])],j
+		except KeyError:
+			pass
+	try:
+		return coll[name[i]],i+1
+	except KeyError:
+		raise CKeyError(name[i:],coll)
+
 def get_collect(name, allow_collection=False):
-	c = None
+	"""\
+		Find the object (or, with @allow_collection, the collection)
+		named by a word sequence, e.g. "output foo bar".
+
+		Each step uses the longest name registered at that level. If there
+		is none, the collection is asked directly, longest name first, so
+		that its __getitem__ may find entries by other keys (e.g. "on"
+		handlers by ID or arguments).
+		"""
 	if not len(name):
 		return None
-	coll = collections
 
 	if allow_collection and name[-1] == "*":
-		return coll[Name(*name[:-1])]
-	while len(name):
-		n = len(name)
-		while n > 0:
-			try:
-				coll = coll[Name(*name[:n])]
-			except KeyError:
-				n = n-1
-			else:
-				name = name[n:]
-				if c is None: c = coll
-				break
-
-		if n == 0:
-			try:
-				coll = coll[name[0]]
-			except KeyError:
-				from moat.logging import DEBUG,log
-				log(DEBUG,"Contents: "+", ".join(str(x) for x in coll.keys()))
-				raise CKeyError(name,coll)
-			else:
-				name = name[1:]
-				if c is None: c = coll
+		return collections[Name(*name[:-1])]
+	coll = collections
+	idx = _index
+	i = 0
+	while i < len(name):
+		c = None
+		if idx is not None:
+			c,j = idx.longest(name,i)
+		if c is None:
+			c,j = _get_item(coll,name,i)
+		coll,i = c,j
+		idx = coll._index if isinstance(coll,Collection) else None
 	if not allow_collection and not isinstance(coll,Collected):
 		raise CCollError(name)
 	return coll
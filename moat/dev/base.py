@@ -32,6 +32,7 @@ from weakref import ref
 
 from moat.types import TYPEDEF_DIR,TYPEDEF, type_names
 from moat.types.managed import ManagedEtcThing,ManagedEtcDir
+from moat.types.etcd import is_lazy
 from qbroker.unit import CC_DATA
 from . import devices, DEV
 
@@ -434,7 +435,7 @@ class Device(ManagedEtcDir, BaseDevice):
 
 	@classmethod
 	async def this_obj(cls, recursive, **kw):
-		if not recursive:
+		if not recursive and not is_lazy(kw.get('parent',None)):
 			raise ReloadRecursive
 		return (await super().this_obj(recursive=recursive, **kw))
 
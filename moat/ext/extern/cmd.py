@@ -36,6 +36,7 @@ from yaml import dump
 from moat.script import Command, SubCommand, CommandError
 from moat.dev import DEV_DIR, DEV
 from moat.util import r_dict, r_show
+from moat.types.etcd import load_all
 from moat.types import TYPEDEF_DIR, TYPEDEF
 from .dev import ExternDevice
 
@@ -82,6 +83,8 @@ a one-line summary, human-readable detailed state, or details as YAML.
         for tt in dirs:
             async for dev in tt.tagged(DEV, depth=self.options.this):
                 path = dev.path[len(DEV_DIR):-1]
+                if self.root.verbose > 1:
+                    await load_all(dev)
                 if self.root.verbose == 2:
                     print('*','/'.join(path), sep='\t',file=self.stdout)
                     for k,v in r_show(dev,''):
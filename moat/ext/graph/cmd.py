@@ -31,7 +31,7 @@ import aio_etcd as etcd
 import asyncio
 import time
 from pprint import pprint
-from sqlmix.async import Db,NoData
+from sqlmix.async import NoData
 from qbroker.unit import CC_MSG
 from qbroker.util import UTC
 from yaml import dump
@@ -41,6 +41,7 @@ from datetime import datetime
 from moat.script import Command, SubCommand, CommandError
 from moat.times import simple_time_delta, humandelta
 from . import modes,modenames
+from .storage import open_storage, log_value
 
 import logging
 logger = logging.getLogger(__name__)
@@ -62,8 +63,16 @@ def add_human(d):
 
 
 class _Command(Command):
+	db = None
+
 	async def setup(self):
-		self.db = Db(**self.root.cfg['config']['sql']['data_logger']['server'])
+		self.db = open_storage(self.root.cfg['config']['sql']['data_logger']['server'], loop=self.root.loop)
+
+	async def finish(self):
+		if self.db is not None:
+			await self.db.close()
+			self.db = None
+		await super().finish()
 
 class LogCommand(_Command):
 	name = "log"
@@ -85,7 +94,6 @@ Log the event stream from AMQP to SQL
 		await self.quitting.wait()
 
 	async def callback(self, msg):
-		import pdb;pdb.set_trace()
 		try:
 			body = msg.data
 
@@ -113,12 +121,7 @@ Log the event stream from AMQP to SQL
 
 			#print(dep,val,nam)
 			async with self.db() as d:
-				await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
-				try:
-					tid, = await d.DoFn("select id from %stype where tag=${name}"%(self.prefix,), name=nam,)
-				except NoData:
-					tid = await d.Do("insert into %stype set tag=${name}"%(self.prefix,), name=nam,)
-				f = await d.Do("insert into %slog set value=${value},data_type=${tid},timestamp=from_unixtime(${ts})"%(self.prefix,), value=val,tid=tid, ts=msg.timestamp)
+				await log_value(d, nam, val, msg.timestamp, prefix=self.prefix)
 				if self.root.verbose:
 					print(dep,val,nam)
 
@@ -157,7 +160,6 @@ This command shows the status of current graphing
 
 		try:
 			async with self.db() as db:
-				await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
 				if self.options.unassigned or self.options.method:
 					if self.options.layer >= 0:
 						raise SyntaxError("You can't use '-u'/'-m' with a specific layer")
@@ -213,7 +215,7 @@ This command shows the status of current graphing
 	async def _do_args(self,db, args):
 		seen = False
 
-		dtid, = await self.db.DoFn("select id from data_type where tag=${tag}", tag=' '.join(args))
+		dtid, = await db.DoFn("select id from data_type where tag=${tag}", tag=' '.join(args))
 		if self.options.last:
 			if self.options.layer < 0:
 				async for d in db.DoSelect("select * from data_log where data_log.data_type=${id} order by data_log.timestamp desc limit ${limit}", _dict=True, id=dtid, limit=self.options.last):
@@ -240,13 +242,13 @@ This command shows the status of current graphing
 
 		else:
 			if self.options.layer < 0: # display this type
-				d = await self.db.DoFn("select * from data_type where id=${id}", _dict=True, id=dtid)
+				d = await db.DoFn("select * from data_type where id=${id}", _dict=True, id=dtid)
 				if self.options.layer < -1:
 					await self.ext_layer(db,d)
 				add_human(d)
 				pprint(remap(d, lambda p, k, v: v is not None))
 			else: # display this layer
-				d = await self.db.DoFn("select * from data_agg_type where data_type=${id} and layer=${layer}", _dict=True, id=dtid, layer=self.options.layer)
+				d = await db.DoFn("select * from data_agg_type where data_type=${id} and layer=${layer}", _dict=True, id=dtid, layer=self.options.layer)
 				add_human(d)
 				pprint(remap(d, lambda p, k, v: v is not None))
 
@@ -339,6 +341,15 @@ Set data type and aggregation options for a logged event type
 		self.parser.add_option('-n','--name',
 			action="store", dest="name",
 			help="name the entry (for display)")
+		self.parser.add_option('-d','--deadband',
+			action="store", dest="deadband", type=float,
+			help="don't log changes smaller than this (0: off)")
+		self.parser.add_option('-D','--deviation',
+			action="store", dest="deviation", type=float,
+			help="don't log values within this deviation of a straight line (0: off)")
+		self.parser.add_option('-g','--max-gap',
+			action="store", dest="max_gap",
+			help="log a value at least this often (0: off)")
 		self.parser.epilog = "Methods:\n"+"\n".join("%s\t%s"%(a,b) for a,b in modes.values())
 
 	async def do(self,args):
@@ -347,7 +358,6 @@ Set data type and aggregation options for a logged event type
 		await self.setup()
 
 		async with self.db() as db:
-			await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
 			dtid, = await db.DoFn("select id from data_type where tag=${tag}", tag=' '.join(args))
 			if self.options.method:
 				try:
@@ -374,6 +384,13 @@ Set data type and aggregation options for a logged event type
 				upd['display_order'] = self.options.order
 			if self.options.cycle:
 				upd['cycle_max'] = self.options.cycle
+			# compression, for event2db
+			if self.options.deadband is not None:
+				upd['deadband'] = self.options.deadband or None
+			if self.options.deviation is not None:
+				upd['deviation'] = self.options.deviation or None
+			if self.options.max_gap is not None:
+				upd['max_gap'] = simple_time_delta(self.options.max_gap) or None
 
 			if upd:
 				try:
@@ -422,7 +439,6 @@ Set data type and aggregation options for a logged event type
 		await self.setup()
 
 		async with self.db() as db:
-			await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
 			tag=' '.join(args)
 			try:
 				dtid, = await db.DoFn("select id from data_type where tag=${tag}", tag=tag)
@@ -491,7 +507,6 @@ Create an aggregation layer and/or set options
 		if self.options.interval:
 			self.options.interval = simple_time_delta(self.options.interval)
 		async with self.db() as db:
-			await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
 			try:
 				dtid, = await db.DoFn("select id from data_type where tag=${tag}", tag=tag)
 			except NoData:
@@ -611,7 +626,6 @@ Process a layer (or all of them)
 		todo = []
 		dels = []
 		async with self.db() as db:
-			await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
 			filter = {}
 			if tag:
 				filter['data_type'], = await db.DoFn("select id from data_type where tag=${tag}", tag=tag)
@@ -654,7 +668,6 @@ Process a layer (or all of them)
 					dels.append((dtid,tag))
 		for d,t in dels:
 			async with self.db() as db:
-				await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
 				logger.info("deleting %s", t)
 				n = await db.Do("delete from data_log where data_type=${dtid}", _empty=True,dtid=d)
 				if n:
@@ -664,12 +677,170 @@ Process a layer (or all of them)
 
 		for d in todo:
 			async with self.db() as db:
-				await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
 				at = agg_type(self,db)
 				await at.set(d)
 				logger.info("Run %s:%d",at.tag,at.layer)
 				await at.run(cleanup=not self.options.noclean)
 
+		if not self.options.noclean and not tag and self.options.layer < 0 and not self.options.method:
+			await self._partitions()
+
+	async def _partitions(self):
+		"""Create future partitions and drop expired ones, if the tables are partitioned"""
+		from .partition import TABLES, AHEAD, NotPartitioned, partition_interval, create_partitions, expire_partitions
+		if self.db.dialect != "mysql":
+			return
+		for table in TABLES:
+			async with self.db() as db:
+				try:
+					# same size as the existing ones, see "partition --init -i"
+					interval = await partition_interval(db, table)
+					await create_partitions(db, table, interval, time.time()+AHEAD*interval)
+					for name,n in await expire_partitions(db, table):
+						logger.info("Dropped %s.%s: %d rows", table,name,n)
+				except NotPartitioned:
+					pass
+
+def _get_time(s, now):
+	"""Parse a time: either a date, or a (human) delta from now"""
+	for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+		try:
+			return datetime.strptime(s,fmt).replace(tzinfo=UTC).timestamp()
+		except ValueError:
+			pass
+	return now - simple_time_delta(s)
+
+class GetCommand(_Command):
+	name = "get"
+	summary = "Read graph data"
+	description = """\
+Read a time series for one or more data tags.
+
+The coarsest aggregation layer which delivers the requested number of
+points is used. Older data which that layer has already discarded are
+read from coarser layers.
+
+Times are either dates ('YYYY-MM-DD HH:MM:SS', UTC) or offsets from now
+('2 days').
+
+Output: tag, timestamp, average, minimum, maximum.
+"""
+
+	def addOptions(self):
+		self.parser.add_option('-s','--start',
+			action="store", dest="start", default="1 day",
+			help="start of the time range (default: 1 day ago)")
+		self.parser.add_option('-e','--end',
+			action="store", dest="end",
+			help="end of the time range (default: now)")
+		self.parser.add_option('-n','--points',
+			action="store", dest="points", type="int", default=500,
+			help="number of points to return, approximately")
+		self.parser.add_option('-D','--downsample',
+			action="store_true", dest="downsample",
+			help="downsample to the requested number of points (LTTB)")
+		self.parser.add_option('-t','--tag',
+			action="append", dest="tags",
+			help="read this tag (can be used multiple times)")
+
+	async def do(self,args):
+		from .query import GraphQuery
+		tags = self.options.tags or []
+		if args:
+			tags.append(' '.join(args))
+		if not tags:
+			raise SyntaxError("Usage: get [options] data_tag")
+		now = time.time()
+		start = _get_time(self.options.start, now)
+		end = _get_time(self.options.end, now) if self.options.end else now
+		if start >= end:
+			raise SyntaxError("The start must be before the end")
+		await self.setup()
+
+		async with self.db() as db:
+			q = GraphQuery(db)
+			try:
+				res = await q.get_many(tags, start,end, points=self.options.points, downsample=self.options.downsample)
+			except KeyError as err:
+				raise CommandError("Tag '%s' unknown" % (err.args[0],))
+		for tag,series in res.items():
+			if self.root.verbose > 1:
+				print("# %s: %d points" % (tag,len(series)), file=self.stdout)
+				for l,s,e in series.layers:
+					print("#  layer %d: %s … %s" % (l, datetime.utcfromtimestamp(s), datetime.utcfromtimestamp(e)), file=self.stdout)
+			for ts,v,mn,mx in series.rows():
+				print(tag, datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), v,mn,mx, sep='\t', file=self.stdout)
+
+class PartitionCommand(_Command):
+	name = "partition"
+	summary = "Manage time partitions"
+	description = """\
+Manage the time-based partitions of the data tables.
+
+Without options, list the partitions.
+
+Partitions whose data have all expired are dropped instead of deleting
+their rows one by one. "moat graph run" does this automatically
+for tables which are partitioned. See scripts/graph.sql for the
+schema changes which are required before you can use --init.
+"""
+
+	def addOptions(self):
+		self.parser.add_option('-t','--table',
+			action="store", dest="table", default="data_log",
+			help="table to work on (data_log, data_agg)")
+		self.parser.add_option('-I','--init',
+			action="store_true", dest="init",
+			help="convert the table to a partitioned one")
+		self.parser.add_option('-i','--interval',
+			action="store", dest="interval",
+			help="size of new partitions (default: 1 day, or the size of the existing ones)")
+		self.parser.add_option('-a','--ahead',
+			action="store", dest="ahead", type="int",
+			help="create partitions for this many intervals in advance")
+		self.parser.add_option('-x','--expire',
+			action="store_true", dest="expire",
+			help="drop partitions whose data have expired")
+		self.parser.add_option('-n','--dry-run',
+			action="store_true", dest="dry_run",
+			help="with --expire: only report what would be dropped")
+
+	async def do(self,args):
+		from .partition import TABLES, INTERVAL, NotPartitioned, list_partitions, init_partitions, partition_interval, create_partitions, expire_partitions
+		if args:
+			raise SyntaxError("Usage: partition [options]")
+		table = self.options.table
+		if table not in TABLES:
+			raise SyntaxError("Table '%s' unknown, use one of %s" % (table, ' '.join(TABLES)))
+		interval = simple_time_delta(self.options.interval) if self.options.interval else None
+		now = time.time()
+		await self.setup()
+		if self.db.dialect != "mysql":
+			raise CommandError("Partitions require MySQL")
+
+		async with self.db() as db:
+			try:
+				if self.options.init:
+					if interval is None:
+						interval = INTERVAL
+					await init_partitions(db, table, interval, now)
+					if self.options.ahead is None:
+						self.options.ahead = 1
+				if self.options.ahead is not None:
+					if interval is None:
+						interval = await partition_interval(db, table)
+					for name in await create_partitions(db, table, interval, now+self.options.ahead*interval):
+						print("created", name, file=self.stdout)
+				if self.options.expire:
+					for name,n in await expire_partitions(db, table, dry_run=self.options.dry_run):
+						print("dropped", name, n, file=self.stdout)
+				if self.options.ahead is not None or self.options.expire:
+					return
+				for name,bound,rows in await list_partitions(db, table):
+					print(name, datetime.utcfromtimestamp(bound).strftime('%Y-%m-%d %H:%M:%S') if bound is not None else "-", rows, sep='\t', file=self.stdout)
+			except NotPartitioned:
+				raise CommandError("Table '%s' is not partitioned" % (table,))
+
 class GraphCommand(SubCommand):
 	name = "graph"
 	summary = "Handle event logging and aggregation for graphs"
@@ -680,11 +851,13 @@ Commands to manipulate logging events for graphing etc.
 	# process in order
 	subCommandClasses = [
 		ListCommand,
+		GetCommand,
 		LogCommand,
 		SetCommand,
 		ResetCommand,
 		LayerCommand,
 		RunCommand,
+		PartitionCommand,
 	]
 
 
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+Lossy compression of incoming values, before they are logged.
+
+Two methods are supported:
+
+* deadband: a value is dropped if it differs from the last stored one
+  by no more than the deadband.
+
+* swinging door: a value is dropped if a straight line from the last
+  stored value to the next one passes within the deviation of it.
+
+Either way, a value is stored at least every max_gap seconds, as long
+as values arrive, or flush_stale() is called periodically.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Compressor(object):
+    """\
+        Decide which values of a single data type to store.
+
+        >>> c = Compressor(deviation=0.1, max_gap=900)
+        >>> for ts,val in c.add(ts, val):
+        ...     store(ts,val)
+
+        On shutdown, call flush() to store the last pending value.
+        """
+    def __init__(self, deadband=None, deviation=None, max_gap=None):
+        self.deadband = deadband
+        self.deviation = deviation
+        self.max_gap = max_gap
+        self.stored = None # last stored (ts,value)
+        self.pending = None # last seen but not stored (ts,value)
+        self.n_in = 0
+        self.n_out = 0
+        self._up = None # slopes of the door
+        self._lo = None
+
+    @property
+    def active(self):
+        return bool(self.deadband) or bool(self.deviation)
+
+    def add(self, ts, value, *extra):
+        """\
+            Feed a value. Returns a list of (ts,value,*extra) to store.
+
+            @extra is passed through; it does not affect the decision.
+            """
+        self.n_in += 1
+        p = (ts,value)+extra
+        s = self.stored
+        if s is None or not self.active or ts <= s[0]:
+            return self._store(p)
+        if self.max_gap and ts-s[0] >= self.max_gap:
+            if not self.deviation and abs(value-s[1]) <= self.deadband:
+                self.pending = None # no step, thus not interesting
+            return self._store(p)
+
+        if self.deviation:
+            dt = ts-s[0]
+            up = (value+self.deviation-s[1])/dt
+            lo = (value-self.deviation-s[1])/dt
+            if self._up is not None:
+                up = min(up,self._up)
+                lo = max(lo,self._lo)
+            if lo <= up:
+                # the door is still open
+                self._up,self._lo = up,lo
+                self.pending = p
+                return []
+            # Closed. The previous value starts a new door.
+            res = self._store(None)
+            s = self.stored
+            dt = ts-s[0]
+            if dt <= 0:
+                # Same timestamp: a vertical step. Store it too.
+                return res + self._store(p)
+            self._up = (value+self.deviation-s[1])/dt
+            self._lo = (value-self.deviation-s[1])/dt
+            self.pending = p
+            return res
+
+        if abs(value-s[1]) <= self.deadband:
+            self.pending = p
+            return []
+        return self._store(p)
+
+    def _store(self, p):
+        """\
+            Store the pending value, if any, and @p.
+
+            Storing the pending value shows a step as a step instead of
+            a slow ramp from the last stored value.
+            """
+        res = []
+        if self.pending is not None:
+            res.append(self.pending)
+            self.pending = None
+        if p is not None:
+            res.append(p)
+        self._up = self._lo = None
+        if res:
+            self.stored = res[-1]
+        self.n_out += len(res)
+        return res
+
+    def flush(self):
+        """Returns the pending value, if any, for storing."""
+        return self._store(None)
+
+    def flush_stale(self, now):
+        """\
+            Returns the pending value for storing if the last stored one
+            is more than max_gap seconds older than @now.
+
+            Call this periodically so that the last value of a type which
+            stopped sending is not held back indefinitely.
+            """
+        s = self.stored
+        if self.pending is None or not self.max_gap or s is None or now-s[0] < self.max_gap:
+            return []
+        return self._store(None)
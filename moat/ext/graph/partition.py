@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+
+"""\
+Manage time-range partitions of data_log and data_agg.
+
+Partitions are created ahead of time. A partition is dropped as soon as
+all data in it are past their type's retention time; per-type deletion
+(see process._proc_clean) handles the rest.
+
+The tables need to be converted before they can be partitioned; see
+scripts/graph.sql.
+"""
+
+from datetime import datetime
+from qbroker.util import UTC
+
+import logging
+logger = logging.getLogger(__name__)
+
+class NotPartitioned(RuntimeError):
+    pass
+
+# table => column which selects the retention rules
+TABLES = {
+    'data_log': 'data_type',
+    'data_agg': 'data_agg_type',
+}
+
+MAXNAME = "pmax"
+INTERVAL = 24*3600 # size of a partition
+AHEAD = 7 # partitions to create in advance
+
+def _ts(t):
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=UTC)
+    return t.timestamp()
+
+PART_FMT = 'p%Y%m%d_%H%M'
+
+def part_name(ts):
+    """Name of the partition starting at @ts"""
+    return datetime.utcfromtimestamp(ts).strftime(PART_FMT)
+
+def part_start(name):
+    """Start of the partition named @name, see part_name()"""
+    return datetime.strptime(name, PART_FMT).replace(tzinfo=UTC).timestamp()
+
+async def list_partitions(db, table):
+    """\
+        Return a list of (name, upper bound, approx. rows) for this table,
+        oldest first. The bound is None for the catch-all partition.
+        """
+    res = []
+    async for name,desc,rows in db.DoSelect("select partition_name,partition_description,table_rows from information_schema.partitions where table_schema=database() and table_name=${table} and partition_name is not null order by partition_ordinal_position", table=table, _empty=True):
+        res.append((name, None if desc == 'MAXVALUE' else int(desc), rows))
+    return res
+
+async def init_partitions(db, table, interval, start):
+    """\
+        Convert @table to a partitioned table.
+
+        The first partition holds everything before @start, which should
+        be aligned to @interval.
+        """
+    if await list_partitions(db, table):
+        raise RuntimeError("Table '%s' is already partitioned" % (table,))
+    start -= start % interval
+    await db.Do("alter table `%s` partition by range (unix_timestamp(`timestamp`)) (partition %s values less than (%d), partition %s values less than maxvalue)" % (table, part_name(start-interval),start, MAXNAME), _empty=True)
+
+async def partition_interval(db, table):
+    """\
+        The size of the newest partition of @table, i.e. the interval
+        which it has been set up with.
+        """
+    parts = [(n,b) for n,b,_ in await list_partitions(db, table) if b is not None]
+    if not parts:
+        raise NotPartitioned(table)
+    name,bound = max(parts, key=lambda nb: nb[1])
+    return int(bound - part_start(name))
+
+async def create_partitions(db, table, interval, until):
+    """\
+        Split the catch-all partition so that partitions of @interval
+        seconds exist up to @until.
+
+        Returns the names of the new partitions.
+        """
+    parts = await list_partitions(db, table)
+    if not parts:
+        raise NotPartitioned(table)
+    last = max(b for _,b,_ in parts if b is not None)
+    new = []
+    while last < until:
+        new.append((part_name(last), last+interval))
+        last += interval
+    if not new:
+        return []
+    defs = ', '.join("partition %s values less than (%d)" % nb for nb in new)
+    await db.Do("alter table `%s` reorganize partition %s into (%s, partition %s values less than maxvalue)" % (table, MAXNAME, defs, MAXNAME), _empty=True)
+    return [n for n,_ in new]
+
+async def retention(db, table):
+    """\
+        Return a dict: key => (cutoff, last_id).
+
+        Data of that key which are older than `cutoff` (Unix seconds) and
+        whose id is below `last_id` may be discarded. Keys not in the
+        dict must be kept.
+
+        For data_log the key is the data_type; the rules come from its
+        layer 0. For data_agg it is the data_agg_type; the rules come from
+        the next-higher layer.
+        """
+    res = {}
+    if table == 'data_log':
+        async for id,ts,max_age,last_id in db.DoSelect("select data_type,timestamp,max_age,last_id from data_agg_type where layer=0", _empty=True):
+            if max_age and ts is not None and last_id is not None:
+                res[id] = (_ts(ts)-max_age, last_id)
+    elif table == 'data_agg':
+        async for id,ts,max_age,last_id in db.DoSelect("select lo.id,hi.timestamp,hi.max_age,hi.last_id from data_agg_type lo join data_agg_type hi on hi.data_type=lo.data_type and hi.layer=lo.layer+1", _empty=True):
+            if max_age and ts is not None and last_id is not None:
+                res[id] = (_ts(ts)-max_age, last_id)
+    else:
+        raise KeyError(table)
+    return res
+
+async def expire_partitions(db, table, dry_run=False):
+    """\
+        Drop all partitions whose data have expired.
+
+        Partitions whose upper bound is past the newest retention cutoff
+        cannot qualify and are not examined; rows are only counted in
+        partitions which will be dropped.
+
+        Returns a list of (name, rows) of the partitions dropped.
+        """
+    col = TABLES[table]
+    parts = await list_partitions(db, table)
+    if not parts:
+        raise NotPartitioned(table)
+    keep = await retention(db, table)
+    if not keep:
+        return []
+    newest = max(cutoff for cutoff,_ in keep.values())
+    res = []
+    for name,bound,_ in parts:
+        if bound is None or bound > newest:
+            # partitions are sorted, so all the rest are newer
+            break
+        ok = True
+        async for key,max_id in db.DoSelect("select `%s`,max(id) from `%s` partition (%s) group by `%s`" % (col,table,name,col), _empty=True):
+            try:
+                cutoff,last_id = keep[key]
+            except KeyError:
+                ok = False
+                break
+            if bound > cutoff or max_id >= last_id:
+                ok = False
+                break
+        if not ok:
+            logger.debug("Keeping partition %s.%s",table,name)
+            continue
+        counts = {}
+        if table == 'data_log':
+            async for key,n in db.DoSelect("select `%s`,count(*) from `%s` partition (%s) group by `%s`" % (col,table,name,col), _empty=True):
+                counts[key] = n
+            n = sum(counts.values())
+        else:
+            n, = await db.DoFn("select count(*) from `%s` partition (%s)" % (table,name))
+        logger.info("Dropping partition %s.%s: %d rows",table,name,n)
+        res.append((name,n))
+        if dry_run:
+            continue
+        await db.Do("alter table `%s` drop partition %s" % (table,name), _empty=True)
+        for key,n in counts.items():
+            await db.Do("update data_type set n_values=greatest(n_values-${n},0) where id=${id}", n=n, id=key, _empty=True)
+    return res
@@ -24,6 +24,7 @@ from __future__ import absolute_import, print_function, division, unicode_litera
 ##BP
 
 from sqlmix.async import NoData
+from .storage import delete_limit
 from datetime import datetime,timedelta
 import attr
 import sys
@@ -33,6 +34,9 @@ from qbroker.util import UTC
 import logging
 logger = logging.getLogger(__name__)
 
+CLEAN_CHUNK = 10000 # rows per DELETE
+CLEAN_CHUNKS = 100 # max DELETEs per cleanup run
+
 ### types for "raw" data
 
 class DoNothing(Exception):
@@ -279,6 +283,20 @@ class _proc:
 
 class _proc_clean(object):
     """Mix-in to clean up entries before our min date"""
+    async def _delete(self, table, where, **kw):
+        """\
+            Delete in chunks, so that a large backlog doesn't lock the table
+            for a long time. If there are more than CLEAN_CHUNKS chunks,
+            the rest is deleted by the next run.
+            """
+        n = 0
+        for _ in range(CLEAN_CHUNKS):
+            nn = await delete_limit(self.db, table, where, CLEAN_CHUNK, **kw)
+            n += nn
+            if nn < CLEAN_CHUNK:
+                break
+        return n
+
     async def cleanup(self):
         if not self.typ.max_age:
             return
@@ -287,14 +305,16 @@ class _proc_clean(object):
             ts = ts.replace(tzinfo=UTC)
         ts = ts-timedelta(0,self.typ.max_age) # how long to keep
 
+        # Partitioned tables: expired partitions are dropped as a whole,
+        # thus this only catches the rows that don't line up.
         if self.typ.layer == 0:
-            n = await self.db.Do("delete from data_log where data_type=${typ} and timestamp < ${ts} and id < ${last_id}", typ=self.typ.data_type, ts=ts, last_id=self.typ.last_id, _empty=True)
+            n = await self._delete("data_log", "data_type=${typ} and timestamp < ${ts} and id < ${last_id}", typ=self.typ.data_type, ts=ts, last_id=self.typ.last_id)
             logger.debug("Deleted %d log entries since %d:%s",n,self.typ.last_id,ts)
-            await self.db.Do("update data_type set n_values=n_values-${n} where id=${typ}", n=n, typ=self.typ.data_type, _empty=True)
-            await self.db.Do("update data_type set n_values=0 where id=${typ} and n_values<0", typ=self.typ.data_type, _empty=True)
+            if n:
+                await self.db.Do("update data_type set n_values=case when n_values>${n} then n_values-${n} else 0 end where id=${typ}", n=n, typ=self.typ.data_type, _empty=True)
         else:
             agg, = await self.db.DoFn("select id from data_agg_type where data_type=${typ} and layer=${layer}", typ=self.typ.data_type, layer=self.typ.layer-1, )
-            n = await self.db.Do("delete from data_agg where data_agg_type=${agg} and timestamp < ${ts} and id < ${last_id}", ts=ts, agg=agg, last_id=self.typ.last_id, _empty=True)
+            n = await self._delete("data_agg", "data_agg_type=${agg} and timestamp < ${ts} and id < ${last_id}", ts=ts, agg=agg, last_id=self.typ.last_id)
             logger.debug("Deleted %d summary/%d entries since %d:%s",n,self.typ.layer,self.typ.last_id,ts)
 
 class proc_noop(_proc):
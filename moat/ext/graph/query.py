@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+
+"""\
+Read graph data.
+
+This module selects the aggregation layer which best fits a requested
+resolution, stitches in coarser layers where the finer data have already
+been expired, and returns avg/min/max series.
+"""
+
+import attr
+from collections import OrderedDict
+from datetime import datetime
+from qbroker.util import UTC
+
+from . import modenames
+
+import logging
+logger = logging.getLogger(__name__)
+
+BUCKET_POINTS = 256 # size of a cache bucket, in intervals of its layer
+CACHE_SIZE = 1000 # number of buckets to cache
+
+@attr.s
+class Series(object):
+    """\
+        Result of a query.
+
+        @ts: timestamps (Unix seconds, start of the interval)
+        @avg, @min, @max: the values
+        @layers: (layer, start, end) of the segments the data came from;
+            layer -1 is the raw data_log.
+        """
+    tag = attr.ib()
+    ts = attr.ib(default=attr.Factory(list))
+    avg = attr.ib(default=attr.Factory(list))
+    min = attr.ib(default=attr.Factory(list))
+    max = attr.ib(default=attr.Factory(list))
+    layers = attr.ib(default=attr.Factory(list))
+
+    def __len__(self):
+        return len(self.ts)
+
+    def extend(self, rows):
+        for ts,avg,mn,mx in rows:
+            self.ts.append(ts)
+            self.avg.append(avg)
+            self.min.append(mn)
+            self.max.append(mx)
+
+    def rows(self):
+        return zip(self.ts,self.avg,self.min,self.max)
+
+@attr.s
+class _layer(object):
+    """One aggregation layer of a data type; id=None and layer=-1 is the raw log"""
+    id = attr.ib()
+    layer = attr.ib()
+    interval = attr.ib()
+    max_age = attr.ib()
+    timestamp = attr.ib()
+    cutoff = attr.ib(default=None) # data before this may have been expired
+
+def _ts(t):
+    """datetime => Unix seconds"""
+    if isinstance(t,datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=UTC)
+        return t.timestamp()
+    return t
+
+def _dt(t):
+    """Unix seconds => datetime, as understood by the database"""
+    return datetime.utcfromtimestamp(t)
+
+def plan(layers, start, end, points):
+    """\
+        Decide which layers to read.
+
+        @layers: list of _layer, finest first, with cutoff set.
+        Returns a list of (layer, start, end) segments, newest first.
+
+        The coarsest layer whose interval does not exceed the requested
+        resolution is used. Older data which this layer no longer has are
+        read from the next coarser layer(s).
+        """
+    if not layers or end <= start:
+        return []
+    res = (end-start)/max(points,1)
+    i = 0
+    for j,l in enumerate(layers):
+        if l.interval <= res:
+            i = j
+    segs = []
+    cur = end
+    for l in layers[i:]:
+        if l.cutoff is None or l.cutoff <= start:
+            segs.append((l,start,cur))
+            break
+        if l.cutoff < cur:
+            segs.append((l,l.cutoff,cur))
+            cur = l.cutoff
+    return segs
+
+def lttb(series, points):
+    """\
+        Downsample a series with the Largest-Triangle-Three-Buckets
+        algorithm, applied to the averages.
+
+        Min and max of each output point cover the whole bucket it
+        represents, so that peaks don't get lost.
+        """
+    n = len(series)
+    if points >= n or points < 3:
+        return series
+    ts,av,mn,mx = series.ts,series.avg,series.min,series.max
+    res = Series(tag=series.tag, layers=series.layers)
+    every = (n-2)/(points-2)
+
+    res.extend(((ts[0],av[0],mn[0],mx[0]),))
+    a = 0
+    for i in range(points-2):
+        b_start = int(i*every)+1
+        b_end = int((i+1)*every)+1
+        # average of the next bucket
+        n_start = b_end
+        n_end = min(int((i+2)*every)+1, n)
+        if n_start >= n_end:
+            n_start,n_end = n-1,n
+        avg_t = sum(ts[n_start:n_end])/(n_end-n_start)
+        avg_v = sum(av[n_start:n_end])/(n_end-n_start)
+
+        best = -1
+        sel = b_start
+        for k in range(b_start,b_end):
+            area = abs((ts[a]-avg_t)*(av[k]-av[a]) - (ts[a]-ts[k])*(avg_v-av[a]))
+            if area > best:
+                best = area
+                sel = k
+        res.extend(((ts[sel],av[sel],min(mn[b_start:b_end]),max(mx[b_start:b_end])),))
+        a = sel
+    res.extend(((ts[-1],av[-1],mn[-1],mx[-1]),))
+    return res
+
+class GraphQuery(object):
+    """\
+        Read downsampled time series.
+
+        >>> q = GraphQuery(db)
+        >>> s = await q.get("temp outside", start, end, points=500)
+
+        Completed buckets of BUCKET_POINTS intervals per layer are
+        cached. Use one instance per database connection.
+        """
+    def __init__(self, db, cache_size=CACHE_SIZE):
+        self.db = db
+        self.cache = OrderedDict() # (data_type,layer,bucket) => rows
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    async def layers(self, tag):
+        """\
+            Return the data type's ID and method, and its layers, finest first.
+            """
+        dt = None
+        async for d in self.db.DoSelect("select id,method from data_type where tag=${tag}", tag=tag, _dict=True, _empty=True):
+            dt = d
+        if dt is None:
+            raise KeyError(tag)
+        res = []
+        if dt['method'] == modenames['store']:
+            # The raw data have the same meaning as the aggregates
+            res.append(_layer(id=None, layer=-1, interval=0, max_age=None, timestamp=None))
+        async for d in self.db.DoSelect("select id,layer,`interval`,max_age,timestamp from data_agg_type where data_type=${dtid} order by layer", dtid=dt['id'], _dict=True, _empty=True):
+            res.append(_layer(id=d['id'], layer=d['layer'], interval=d['interval'], max_age=d['max_age'], timestamp=_ts(d['timestamp'])))
+
+        # Layer N's cleanup expires the data of layer N-1.
+        for lo,hi in zip(res,res[1:]):
+            if hi.max_age:
+                lo.cutoff = hi.timestamp-hi.max_age
+        return dt['id'],res
+
+    async def get(self, tag, start, end, points=500, downsample=False):
+        """\
+            Fetch data for this tag.
+
+            @start, @end: datetime or Unix seconds
+            @points: the number of points the caller wants, approximately
+            @downsample: if set, reduce the result to @points with LTTB
+            """
+        start = _ts(start)
+        end = _ts(end)
+        dtid,layers = await self.layers(tag)
+        segs = plan(layers, start,end, points)
+        res = Series(tag=tag)
+        for l,s,e in reversed(segs):
+            res.extend(await self._read(dtid,l,s,e))
+            res.layers.append((l.layer,s,e))
+        if downsample:
+            res = lttb(res, points)
+        return res
+
+    async def get_many(self, tags, start, end, **kw):
+        """Fetch data for multiple tags; returns a tag=>Series dict"""
+        res = {}
+        for tag in tags:
+            res[tag] = await self.get(tag, start,end, **kw)
+        return res
+
+    async def _read(self, dtid, l, start, end):
+        """Read the rows of layer @l in [start,end[, through the cache"""
+        if l.interval == 0:
+            # raw data: not cached
+            return [r async for r in self._fetch(dtid,l, start,end)]
+        size = l.interval*BUCKET_POINTS
+        rows = []
+        b = int(start//size)
+        while b*size < end:
+            key = (dtid,l.layer,b)
+            data = self.cache.get(key,None)
+            if data is not None:
+                self.hits += 1
+                self.cache.move_to_end(key)
+            else:
+                self.misses += 1
+                data = [r async for r in self._fetch(dtid,l, b*size,(b+1)*size)]
+                # Only completed buckets may be cached.
+                if l.timestamp is not None and (b+1)*size <= l.timestamp:
+                    self.cache[key] = data
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+            rows.extend(r for r in data if start <= r[0] < end)
+            b += 1
+        return rows
+
+    async def _fetch(self, dtid, l, start, end):
+        if l.id is None:
+            async for ts,v in self.db.DoSelect("select timestamp,value from data_log where data_type=${dtid} and timestamp >= ${start} and timestamp < ${end} order by timestamp", dtid=dtid, start=_dt(start), end=_dt(end), _empty=True):
+                yield (_ts(ts),v,v,v)
+        else:
+            async for ts,v,mn,mx in self.db.DoSelect("select timestamp,value,min_value,max_value from data_agg where data_agg_type=${atid} and timestamp >= ${start} and timestamp < ${end} order by tsc", atid=l.id, start=_dt(start), end=_dt(end), _empty=True):
+                yield (_ts(ts),v,mn,mx)
+
+    def invalidate(self, dtid=None):
+        """Drop cached data, for a single data type or everything"""
+        if dtid is None:
+            self.cache.clear()
+        else:
+            for k in [k for k in self.cache if k[0] == dtid]:
+                del self.cache[k]
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+Storage back-ends for graph data.
+
+The back-end is selected by the "backend" entry of
+config.sql.data_logger.server:
+
+* mysql (default): a pool of MySQL connections, via sqlmix.async. All
+  other entries are passed to its Db.
+
+* sqlite: an embedded database in the file named by "path", in WAL mode.
+  The tables are created if they don't exist yet.
+
+Both are used the same way:
+
+    >>> storage = open_storage(cfg)
+    >>> async with storage() as db:
+    ...     n, = await db.DoFn("select count(*) from data_log")
+    >>> await storage.close()
+
+SQLite transactions are batched: every "async with" block is a savepoint
+of a transaction which is committed after "batch" seconds, or when the
+storage is closed. Thus logging single values doesn't cost a disk sync
+each. Blocks are serialized; an error rolls back its own block only.
+"""
+
+import asyncio
+import re
+import sqlite3
+from datetime import datetime, timezone
+from sqlmix.async import NoData, ManyData
+from time import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+__all__ = ['open_storage', 'MySQL', 'SQLite', 'delete_limit', 'log_value']
+
+BATCH = 1 # seconds until an SQLite transaction is committed
+
+def open_storage(cfg, loop=None):
+    """Return the storage back-end for this config"""
+    cfg = dict(cfg)
+    backend = cfg.pop('backend', 'mysql')
+    if backend == 'mysql':
+        return MySQL(loop=loop, **cfg)
+    if backend == 'sqlite':
+        return SQLite(loop=loop, **cfg)
+    raise ValueError("Unknown storage backend: %s" % (backend,))
+
+async def delete_limit(db, table, where, limit, **kw):
+    """\
+        Delete at most @limit rows of @table which match @where.
+        Returns the number of rows deleted.
+        """
+    if db.dialect == "sqlite":
+        # DELETE … LIMIT is a compile-time option of SQLite
+        sql = "delete from %s where id in (select id from %s where %s limit ${chunk})" % (table,table,where)
+    else:
+        sql = "delete from %s where %s limit ${chunk}" % (table,where)
+    return await db.Do(sql, chunk=limit, _empty=True, **kw)
+
+async def log_value(db, tag, value, ts, aux_value=0, prefix="data_"):
+    """\
+        Store a raw value. The data type is created if it's new.
+        @ts is in Unix seconds.
+
+        Returns the data type's ID.
+        """
+    try:
+        tid, = await db.DoFn("select id from %stype where tag=${tag}"%(prefix,), tag=tag)
+    except NoData:
+        tid = await db.Do("insert into %stype(tag) values(${tag})"%(prefix,), tag=tag)
+    await db.Do("insert into %slog(value,aux_value,data_type,timestamp) values(${value},${aux_value},${tid},${ts})"%(prefix,), value=value,aux_value=aux_value,tid=tid, ts=datetime.utcfromtimestamp(ts))
+    return tid
+
+class MySQL(object):
+    """The MySQL back-end. Connections use UTC."""
+    dialect = "mysql"
+
+    def __init__(self, loop=None, **cfg):
+        from sqlmix.async import Db
+        self.db = Db(_loop=loop, **cfg)
+
+    def __call__(self):
+        return _MySQLConn(self.db)
+
+    async def close(self):
+        self.db.close()
+
+class _MySQLConn(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        self.ctx = self.pool()
+        db = await self.ctx.__aenter__()
+        try:
+            await db.Do("SET TIME_ZONE='+00:00'", _empty=True)
+        except BaseException as exc:
+            await self.ctx.__aexit__(type(exc),exc,exc.__traceback__)
+            raise
+        db.dialect = MySQL.dialect
+        return db
+
+    async def __aexit__(self, *tb):
+        return await self.ctx.__aexit__(*tb)
+
+## SQLite
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS data_type (
+  id integer PRIMARY KEY AUTOINCREMENT,
+  tag text UNIQUE,
+  method integer NULL,
+  cycle_max double DEFAULT NULL,
+  unit text NOT NULL DEFAULT '',
+  value double DEFAULT NULL,
+  aux_value double DEFAULT NULL,
+  display_order integer NOT NULL DEFAULT 0,
+  display_name text NULL,
+  display_unit text NULL,
+  display_factor double NOT NULL DEFAULT 1,
+  n_values integer NOT NULL DEFAULT 0,
+  deadband double DEFAULT NULL,
+  deviation double DEFAULT NULL,
+  max_gap integer DEFAULT NULL,
+  rate integer NOT NULL DEFAULT 0,
+  timestamp timestamp NOT NULL DEFAULT '1999-01-01 00:00:00'
+);
+CREATE TABLE IF NOT EXISTS data_log (
+  id integer PRIMARY KEY AUTOINCREMENT,
+  data_type integer NOT NULL REFERENCES data_type(id),
+  value double DEFAULT NULL,
+  aux_value double DEFAULT NULL,
+  timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS data_log_type ON data_log(data_type,timestamp);
+CREATE INDEX IF NOT EXISTS data_log_timestamp ON data_log(timestamp);
+CREATE TABLE IF NOT EXISTS data_agg_type (
+  id integer PRIMARY KEY AUTOINCREMENT,
+  data_type integer NOT NULL REFERENCES data_type(id),
+  layer integer NOT NULL DEFAULT 0,
+  interval integer NOT NULL,
+  max_age integer NOT NULL,
+  timestamp timestamp NOT NULL DEFAULT '2000-01-01 00:00:00',
+  last_id integer NOT NULL DEFAULT 0,
+  UNIQUE (data_type,layer)
+);
+CREATE TABLE IF NOT EXISTS data_agg (
+  id integer PRIMARY KEY AUTOINCREMENT,
+  data_agg_type integer NOT NULL REFERENCES data_agg_type(id),
+  value double NOT NULL,
+  aux_value double DEFAULT NULL,
+  min_value double NOT NULL,
+  max_value double NOT NULL,
+  n_values integer NOT NULL DEFAULT 0,
+  tsc integer NOT NULL,
+  timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (data_agg_type,tsc)
+);
+CREATE INDEX IF NOT EXISTS data_agg_timestamp ON data_agg(timestamp);
+"""
+
+_param = re.compile(r"\$\{([a-zA-Z_][a-zA-Z_0-9]*)\}")
+
+def _conv_ts(s):
+    """Read a timestamp. Unlike sqlite3's default, this accepts plain dates."""
+    s = s.decode("ascii")
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(s,fmt)
+        except ValueError:
+            pass
+    raise ValueError(s)
+sqlite3.register_converter("timestamp", _conv_ts)
+
+def _arg(v):
+    """Timestamps are stored as naive UTC, like MySQL does with TIME_ZONE='+00:00'"""
+    if isinstance(v,datetime):
+        if v.tzinfo is not None:
+            v = v.astimezone(timezone.utc).replace(tzinfo=None)
+        return v.isoformat(' ')
+    return v
+
+class SQLite(object):
+    """The embedded back-end"""
+    dialect = "sqlite"
+    _timer = None
+    _error = None # a delayed commit failed
+
+    def __init__(self, path, batch=BATCH, loop=None):
+        self.path = path
+        self.batch = batch
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._lock = asyncio.Lock(loop=self._loop)
+        self._begun = None # start of the current transaction
+        self._sp = 0 # savepoint counter
+        self.n_commits = 0
+
+        self.conn = sqlite3.connect(path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def __call__(self):
+        return _SQLiteConn(self)
+
+    def _exec(self, sql, kw):
+        sql = _param.sub(r":\1", sql)
+        args = { k:_arg(v) for k,v in kw.items() if k[0] != '_' }
+        return self.conn.execute(sql, args)
+
+    def _commit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._begun is not None:
+            self.conn.execute("COMMIT")
+            self._begun = None
+            self.n_commits += 1
+
+    async def _flush(self):
+        async with self._lock:
+            self._commit()
+
+    async def _flush_later(self):
+        """Called by the batch timer. Nobody waits for this, so an error
+            is logged and raised by the next transaction."""
+        try:
+            await self._flush()
+        except Exception as exc:
+            logger.exception("%s: commit failed", self.path)
+            self._error = exc
+
+    async def flush(self):
+        """Commit the current transaction now"""
+        await self._flush()
+
+    async def close(self):
+        if self.conn is None:
+            return
+        await self._flush()
+        self.conn.close()
+        self.conn = None
+
+    async def _enter(self):
+        await self._lock.acquire()
+        try:
+            err,self._error = self._error,None
+            if err is not None:
+                raise err
+            if self._begun is None:
+                self.conn.execute("BEGIN")
+                self._begun = time()
+            self._sp += 1
+            self.conn.execute("SAVEPOINT s%d" % self._sp)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    async def _exit(self, ok):
+        try:
+            sp = self._sp
+            self._sp -= 1
+            if not ok:
+                self.conn.execute("ROLLBACK TO s%d" % sp)
+            self.conn.execute("RELEASE s%d" % sp)
+            t = self._begun+self.batch-time()
+            if t <= 0:
+                self._commit()
+            elif self._timer is None:
+                self._timer = self._loop.call_later(t, lambda: asyncio.ensure_future(self._flush_later(), loop=self._loop))
+        finally:
+            self._lock.release()
+
+class _SQLiteConn(object):
+    """\
+        A transaction on an SQLite database.
+        The interface is that of a sqlmix.async connection.
+        """
+    dialect = SQLite.dialect
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __aenter__(self):
+        await self.storage._enter()
+        return self
+
+    async def __aexit__(self, a,b,c):
+        await self.storage._exit(b is None)
+
+    async def Do(self, sql, **kw):
+        curs = self.storage._exec(sql, kw)
+        if sql.lstrip()[:6].lower() == "insert":
+            r = curs.lastrowid
+        else:
+            r = curs.rowcount
+        if r == 0 and not kw.get('_empty', False):
+            raise NoData(sql)
+        return r
+
+    async def DoFn(self, sql, **kw):
+        curs = self.storage._exec(sql, kw)
+        val = curs.fetchone()
+        if val is None:
+            raise NoData(sql)
+        if curs.fetchone() is not None:
+            raise ManyData(sql)
+        if kw.get('_dict', False):
+            val = dict(zip((d[0] for d in curs.description), val))
+        return val
+
+    async def DoSelect(self, sql, **kw):
+        curs = self.storage._exec(sql, kw)
+        names = None
+        if kw.get('_dict', False):
+            names = [d[0] for d in curs.description]
+        # Like MySQL's default cursor, this buffers the result, thus
+        # the caller may modify the tables while iterating.
+        rows = curs.fetchall()
+        if not rows and not kw.get('_empty', False):
+            raise NoData(sql)
+        for val in rows:
+            if names is not None:
+                val = dict(zip(names,val))
+            yield val
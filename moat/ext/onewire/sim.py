@@ -0,0 +1,648 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+
+"""\
+	This code implements a simulated owserver.
+
+	The simulator speaks the same wire format as `moat.ext.onewire.proto`
+	and serves a virtual tree of buses and devices. Latency, errors and
+	"server busy" replies can be injected, so that the 1wire code can be
+	tested and load-tested without a real owserver.
+	"""
+
+import asyncio
+import struct
+import random
+from time import time
+
+from .proto import OWMsg, OnewireServer
+
+import logging
+logger = logging.getLogger(__name__)
+
+ENOENT = 2
+EIO = 5
+EINVAL = 22
+
+class SimError(RuntimeError):
+	"""A request to the simulator failed. The arg is a (positive) errno."""
+	pass
+
+class SimDevice:
+	"""Base class for simulated 1wire devices"""
+	family = None
+
+	def __init__(self, id):
+		self.id = id
+		self.alarm = False
+		self.bus = None
+
+	@property
+	def name(self):
+		return "%s.%s" % (self.family, self.id)
+
+	def __repr__(self):
+		return "<%s %s>" % (self.__class__.__name__, self.name)
+
+	def dir(self):
+		return ["address","family","id","type"]+self._attrs()
+
+	def _attrs(self):
+		return []
+
+	def lookup(self, name):
+		raise SimError(ENOENT)
+
+	def read(self, name):
+		if name == "address":
+			return self.name.replace('.','').upper()
+		if name == "family":
+			return self.family
+		if name == "id":
+			return self.id.upper()
+		if name == "type":
+			return self.type
+		raise SimError(ENOENT)
+
+	def write(self, name, data):
+		raise SimError(EINVAL)
+
+class SimThermo(SimDevice):
+	"""A DS18S20 (10) or DS18B20 (28) thermometer"""
+	family = "10"
+	type = "DS18S20"
+
+	def __init__(self, id, temperature=20.0, family=None, drift=0):
+		super().__init__(id)
+		if family is not None:
+			self.family = family
+			if family == "28":
+				self.type = "DS18B20"
+		self.temperature = temperature
+		self.drift = drift
+		self.temphigh = 75
+		self.templow = -55
+		self.latched = None
+
+	def _attrs(self):
+		return ["temperature","temphigh","templow"]
+
+	def convert(self):
+		"""Latch a new temperature value"""
+		if self.drift:
+			self.temperature += random.uniform(-self.drift,self.drift)
+		self.latched = self.temperature
+
+	def read(self, name):
+		if name == "temperature":
+			if self.latched is None:
+				self.convert()
+			return "%.4f" % (self.latched,)
+		if name == "temphigh":
+			return str(self.temphigh)
+		if name == "templow":
+			return str(self.templow)
+		return super().read(name)
+
+	def write(self, name, data):
+		if name in ("temphigh","templow"):
+			try:
+				setattr(self,name,int(data))
+			except ValueError:
+				raise SimError(EINVAL)
+			return
+		super().write(name, data)
+
+class SimSwitch(SimDevice):
+	"""A DS2405 addressable switch"""
+	family = "05"
+	type = "DS2405"
+
+	def __init__(self, id):
+		super().__init__(id)
+		self.val = False
+
+	def _attrs(self):
+		return ["PIO","sensed"]
+
+	def read(self, name):
+		if name == "sensed":
+			return "1" if self.val else "0"
+		if name.lower() == "pio":
+			return "0" if self.val else "1"
+		return super().read(name)
+
+	def write(self, name, data):
+		if name.lower() == "pio":
+			if data == "1":
+				self.val = False
+			elif data == "0":
+				self.val = True
+			else:
+				raise SimError(EINVAL)
+			return
+		super().write(name, data)
+
+class SimCoupler(SimDevice):
+	"""A DS2409 microlan coupler, with a main and an aux branch"""
+	family = "1f"
+	type = "DS2409"
+
+	def __init__(self, id):
+		super().__init__(id)
+		self.main = SimBus()
+		self.aux = SimBus()
+
+	def _attrs(self):
+		return ["aux","main"]
+
+	def lookup(self, name):
+		if name == "main":
+			return self.main
+		if name == "aux":
+			return self.aux
+		return super().lookup(name)
+
+	def read(self, name):
+		if name in ("main","aux"):
+			raise SimError(EINVAL) # pragma: no cover
+		return super().read(name)
+
+class SimBus:
+	"""\
+		A simulated bus, with its devices.
+
+		Writing to "simultaneous/temperature" triggers a conversion on all
+		thermometers on this bus.
+		"""
+	def __init__(self):
+		self.devices = {}
+		self.n_converts = 0
+
+	def __repr__(self):
+		return "<SimBus %d>" % (len(self.devices),)
+
+	def add(self, dev):
+		self.devices[dev.name] = dev
+		dev.bus = self
+		return dev
+
+	def remove(self, dev):
+		del self.devices[dev.name]
+		dev.bus = None
+
+	def dir(self):
+		return sorted(self.devices.keys()) + ["alarm","simultaneous"]
+
+	def lookup(self, name):
+		if name == "alarm":
+			return _SimAlarm(self)
+		if name == "simultaneous":
+			return _SimSimul(self)
+		try:
+			return self.devices[name.lower()]
+		except KeyError:
+			raise SimError(ENOENT)
+
+	def read(self, name):
+		raise SimError(EINVAL)
+
+	def write(self, name, data):
+		raise SimError(EINVAL)
+
+	def thermometers(self):
+		for d in self.devices.values():
+			if isinstance(d, SimThermo):
+				yield d
+
+	def all_devices(self):
+		"""Yield all devices on this bus and its sub-buses"""
+		for d in self.devices.values():
+			yield d
+			if isinstance(d, SimCoupler):
+				yield from d.main.all_devices()
+				yield from d.aux.all_devices()
+
+class _SimAlarm:
+	"""The 'alarm' directory of a bus"""
+	def __init__(self, bus):
+		self.bus = bus
+	def dir(self):
+		return sorted(d.name for d in self.bus.devices.values() if d.alarm)
+	def lookup(self, name):
+		d = self.bus.lookup(name)
+		if not d.alarm:
+			raise SimError(ENOENT)
+		return d
+	def read(self, name):
+		raise SimError(EINVAL)
+	def write(self, name, data):
+		raise SimError(EINVAL)
+
+class _SimSimul:
+	"""The 'simultaneous' directory of a bus"""
+	def __init__(self, bus):
+		self.bus = bus
+	def dir(self):
+		return ["present","temperature"]
+	def lookup(self, name):
+		raise SimError(ENOENT)
+	def read(self, name):
+		if name == "present":
+			return "1" if self.bus.devices else "0"
+		if name == "temperature":
+			return str(self.bus.n_converts)
+		raise SimError(ENOENT)
+	def write(self, name, data):
+		if name != "temperature":
+			raise SimError(EINVAL)
+		self.bus.n_converts += 1
+		for d in self.bus.thermometers():
+			d.convert()
+
+class SimRoot:
+	"""\
+		The root of a simulated owserver's tree: a couple of buses.
+
+		"uncached" is accepted as a path prefix anywhere it's legal for
+		owserver. Bus names are "bus.N".
+		"""
+	def __init__(self):
+		self.buses = {}
+		self._id = 0
+
+	def new_id(self):
+		self._id += 1
+		return "%012x" % (self._id,)
+
+	def bus(self, n=None):
+		"""Return bus N, creating it if necessary"""
+		if n is None:
+			n = len(self.buses)
+		name = "bus.%d" % (n,)
+		try:
+			return self.buses[name]
+		except KeyError:
+			b = self.buses[name] = SimBus()
+			return b
+
+	def dir(self):
+		return sorted(self.buses.keys()) + ["uncached"]
+
+	def lookup(self, name):
+		try:
+			return self.buses[name]
+		except KeyError:
+			raise SimError(ENOENT)
+
+	def read(self, name):
+		raise SimError(EINVAL)
+
+	def write(self, name, data):
+		raise SimError(EINVAL)
+
+	def all_devices(self):
+		for b in self.buses.values():
+			yield from b.all_devices()
+
+	def walk(self, path):
+		"""\
+			Resolve a path (list of names) to a (node, attribute) tuple.
+			The attribute is None if the path refers to a directory.
+			"""
+		node = self
+		path = [p for p in path if p and p != "uncached"]
+		for i,p in enumerate(path):
+			try:
+				node = node.lookup(p)
+			except SimError:
+				if i < len(path)-1:
+					raise
+				return node,p
+		return node,None
+
+def make_topology(buses=1, thermo=0, switches=0, couplers=0, per_coupler=0, temperature=20.0, drift=0, seed=None):
+	"""\
+		Build a virtual topology.
+
+		@buses: the number of root buses.
+		@thermo, @switches: the number of DS18x20 and DS2405 devices,
+		    distributed round-robin across the root buses.
+		@couplers: the number of DS2409 couplers, likewise.
+		@per_coupler: the number of thermometers on each coupler branch.
+		"""
+	rnd = random.Random(seed)
+	root = SimRoot()
+	bl = [root.bus(i) for i in range(buses)]
+	for i in range(thermo):
+		bl[i % buses].add(SimThermo(root.new_id(), family=rnd.choice(("10","28")),
+			temperature=temperature+rnd.uniform(-5,5), drift=drift))
+	for i in range(switches):
+		bl[i % buses].add(SimSwitch(root.new_id()))
+	for i in range(couplers):
+		c = bl[i % buses].add(SimCoupler(root.new_id()))
+		for b in (c.main,c.aux):
+			for j in range(per_coupler):
+				b.add(SimThermo(root.new_id(), family=rnd.choice(("10","28")),
+					temperature=temperature+rnd.uniform(-5,5), drift=drift))
+	return root
+
+class OnewireSimProtocol(asyncio.Protocol):
+	"""Server side of the owserver protocol, for the simulator"""
+	MAX_LENGTH=10*1024
+
+	def __init__(self, server):
+		self.server = server
+		self._loop = server._loop
+		self.data = b""
+		self.queue = asyncio.Queue(loop=self._loop)
+		self.job = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.job = asyncio.ensure_future(self._worker(), loop=self._loop)
+		self.server.conns.add(self)
+
+	def connection_lost(self, exc):
+		self.server.conns.discard(self)
+		if self.job is not None:
+			self.job.cancel()
+			self.job = None
+
+	def close(self):
+		self.transport.close()
+
+	def data_received(self, data):
+		self.data += data
+		while len(self.data) >= 24:
+			version, payload_len, typ, flags, size, offset = struct.unpack('!6i', self.data[:24])
+			if version != 0 or payload_len < 0 or payload_len > self.MAX_LENGTH:
+				logger.warning("SIM bad header %s %s", version,payload_len)
+				self.transport.close()
+				return
+			if len(self.data) < 24+payload_len:
+				break
+			payload = self.data[24:24+payload_len]
+			self.data = self.data[24+payload_len:]
+			self.queue.put_nowait((typ,flags,size,payload))
+
+	async def _worker(self):
+		while True:
+			typ,flags,size,payload = await self.queue.get()
+			try:
+				await self.server.handle(self, typ,flags,size,payload)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				logger.exception("SIM handling %s %s",typ,payload)
+				self.reply(flags, -EIO)
+
+	def reply(self, flags, ret, data=b""):
+		self.transport.write(struct.pack('!6i', 0, len(data), ret, flags, len(data), 0) + data)
+
+	def busy(self, flags):
+		self.transport.write(struct.pack('!6i', 0, -1, 0, flags, 0, 0))
+
+class OnewireSimServer:
+	"""\
+		A simulated owserver.
+
+		@root: the tree to serve, typically built with `make_topology`.
+		@delay: time to process a request; @jitter is added randomly.
+		@error_rate: fraction of requests which fail with EIO.
+		@busy_rate: fraction of requests which get @busy_count "server
+		    busy" keepalives, @busy_delay seconds apart, before the reply.
+		@conv_delay: time for a temperature conversion. An uncached
+		    temperature read pays that, unless a simultaneous conversion
+		    happened on the bus within the last @conv_delay seconds.
+
+		Usage:
+			srv = OnewireSimServer(make_topology(thermo=10))
+			port = await srv.start()
+			…
+			await srv.stop()
+		"""
+	def __init__(self, root, delay=0, jitter=0, error_rate=0, busy_rate=0, busy_count=1, busy_delay=0.01,
+			conv_delay=0, seed=None, loop=None):
+		self._loop = loop if loop is not None else asyncio.get_event_loop()
+		self.root = root
+		self.delay = delay
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.busy_rate = busy_rate
+		self.busy_count = busy_count
+		self.busy_delay = busy_delay
+		self.conv_delay = conv_delay
+		self.rnd = random.Random(seed)
+		self.conns = set()
+		self.server = None
+		self.port = None
+		self.stats = {'requests':0, 'errors':0, 'busy':0}
+		self.msg_stats = {} # OWMsg type => count
+		self._converted = {} # bus id => timestamp
+
+	async def start(self, host="127.0.0.1", port=0):
+		"""Start listening. Returns the port number."""
+		self.server = await self._loop.create_server(lambda: OnewireSimProtocol(self), host,port)
+		self.port = self.server.sockets[0].getsockname()[1]
+		logger.debug("SIM listening on %s:%d", host,self.port)
+		return self.port
+
+	async def stop(self):
+		if self.server is None:
+			return
+		self.server.close()
+		for c in list(self.conns):
+			c.close()
+		await self.server.wait_closed()
+		self.server = None
+
+	def client(self, host="127.0.0.1"):
+		"""Return an `OnewireServer` connected to this simulator"""
+		return OnewireServer(host,self.port, loop=self._loop)
+
+	async def handle(self, conn, typ,flags,size,payload):
+		self.stats['requests'] += 1
+		self.msg_stats[typ] = self.msg_stats.get(typ,0)+1
+
+		t = self.delay
+		if self.jitter:
+			t += self.rnd.uniform(0,self.jitter)
+		if self.busy_rate and self.rnd.random() < self.busy_rate:
+			for _ in range(self.busy_count):
+				self.stats['busy'] += 1
+				conn.busy(flags)
+				await asyncio.sleep(self.busy_delay, loop=self._loop)
+		if t > 0:
+			await asyncio.sleep(t, loop=self._loop)
+
+		if self.error_rate and self.rnd.random() < self.error_rate:
+			self.stats['errors'] += 1
+			conn.reply(flags, -EIO)
+			return
+
+		path,_,data = payload.partition(b'\0')
+		path = path.decode('utf-8').split('/')
+		uncached = 'uncached' in path
+		try:
+			node,attr = self.root.walk(path)
+			if typ == OWMsg.nop:
+				conn.reply(flags, 0)
+			elif typ == OWMsg.presence:
+				conn.reply(flags, 0)
+			elif typ in (OWMsg.dir, OWMsg.dirall) or (typ == OWMsg.get and attr is None and not data):
+				if attr is not None:
+					node = node.lookup(attr) # raises
+				pre = '/'.join(p for p in path if p)
+				if pre:
+					pre = '/'+pre
+				names = [pre+'/'+n for n in node.dir()]
+				if typ == OWMsg.dir:
+					for n in names:
+						conn.reply(flags, 0, n.encode('utf-8')+b'\0')
+					conn.reply(flags, 0)
+				else:
+					conn.reply(flags, 0, ','.join(names).encode('utf-8'))
+			elif data and typ in (OWMsg.write, OWMsg.get):
+				# the client in .proto writes with OWMsg.get
+				if attr is None:
+					raise SimError(EINVAL)
+				data = data[:size].decode('utf-8') if size else data.decode('utf-8')
+				if isinstance(node,_SimSimul) and attr == "temperature":
+					await self._conv_wait()
+					self._converted[id(node.bus)] = time()
+				node.write(attr, data)
+				conn.reply(flags, len(data))
+			elif typ in (OWMsg.read, OWMsg.get, OWMsg.size):
+				if attr is None:
+					raise SimError(EINVAL)
+				if uncached and isinstance(node,SimThermo) and attr == "temperature":
+					ts = self._converted.get(id(node.bus),0)
+					if ts < time()-max(self.conv_delay,1):
+						await self._conv_wait()
+						node.convert()
+				res = node.read(attr).encode('utf-8')
+				if typ == OWMsg.size:
+					conn.reply(flags, len(res))
+				else:
+					conn.reply(flags, len(res), res)
+			else:
+				raise SimError(EINVAL)
+		except SimError as err:
+			self.stats['errors'] += 1
+			conn.reply(flags, -err.args[0])
+
+	async def _conv_wait(self):
+		if self.conv_delay > 0:
+			await asyncio.sleep(self.conv_delay, loop=self._loop)
+
+class _LoadStats:
+	def __init__(self, name):
+		self.name = name
+		self.ops = 0
+		self.errors = 0
+		self.time = 0
+
+	def __str__(self):
+		rate = self.ops/self.time if self.time else 0
+		return "%s\t%d ops\t%d err\t%.3f sec\t%.1f ops/sec" % (self.name, self.ops,self.errors, self.time, rate)
+
+async def run_load(ow, rounds=1, concurrency=10, loop=None):
+	"""\
+		Exercise a 1wire server like MoaT's scanner tasks do.
+
+		@ow is an OnewireServer, typically pointing at a simulator.
+
+		This runs, @rounds times:
+		* scan: enumerate all buses and devices, including coupler branches
+		* poll: read the alarm directory of each bus and every DS2405
+		* temperature: one simultaneous conversion per bus, then read all
+		  thermometers
+
+		Returns a list of _LoadStats objects.
+		"""
+	if loop is None:
+		loop = asyncio.get_event_loop()
+	sem = asyncio.Semaphore(concurrency, loop=loop)
+
+	async def op(st, proc, *path, **kw):
+		async with sem:
+			try:
+				res = await proc(*path, **kw)
+			except Exception as exc:
+				st.errors += 1
+				logger.debug("Load %s %s: %r", st.name,path,exc)
+				return None
+			else:
+				st.ops += 1
+				return res
+
+	buses = {}
+	async def scan(st, path):
+		res = await op(st, ow.dir, 'uncached', *path)
+		if res is None:
+			return
+		devs = buses[path] = []
+		subs = []
+		for f in res:
+			if '.' not in f or f.startswith('bus.'):
+				continue
+			devs.append(f)
+			if f.startswith('1f.'):
+				subs.append(path+(f,'main'))
+				subs.append(path+(f,'aux'))
+		if subs:
+			await asyncio.gather(*(scan(st,p) for p in subs), loop=loop)
+
+	async def poll(st, path):
+		await op(st, ow.dir, 'uncached',*path,'alarm')
+		await asyncio.gather(*(op(st, ow.read, 'uncached',*path,d,'sensed') for d in buses[path] if d.startswith('05.')), loop=loop)
+
+	async def temperature(st, path):
+		devs = [d for d in buses[path] if d[:3] in ('10.','28.')]
+		if not devs:
+			return
+		await op(st, ow.write, *path,'simultaneous','temperature', data="1")
+		await asyncio.gather(*(op(st, ow.read, *path,d,'temperature') for d in devs), loop=loop)
+
+	res = []
+	for _ in range(rounds):
+		st = _LoadStats("scan")
+		t1 = time()
+		roots = await op(st, ow.dir, 'uncached')
+		buses.clear()
+		if roots is not None:
+			await asyncio.gather(*(scan(st,(b,)) for b in roots if b.startswith('bus.')), loop=loop)
+		st.time = time()-t1
+		res.append(st)
+
+		for name,proc in (("poll",poll),("temperature",temperature)):
+			st = _LoadStats(name)
+			t1 = time()
+			await asyncio.gather(*(proc(st,p) for p in list(buses.keys())), loop=loop)
+			st.time = time()-t1
+			res.append(st)
+	return res
@@ -150,7 +150,8 @@ class ScanTask(TimeoutHandler, _BusTask, metaclass=_ScanMeta):
 		while True:
 			logger.debug("taskBeg %d %s", id(self),self)
 			try:
-				warned = await self.task_()
+				with self.perf.iteration():
+					warned = await self.task_()
 			except Exception as exc:
 				logger.exception("tasking %d %s", id(self),self)
 				raise
@@ -164,6 +165,7 @@ class ScanTask(TimeoutHandler, _BusTask, metaclass=_ScanMeta):
 			nts = time()
 			delay = ts - nts
 			if delay < 0:
+				self.perf.overruns += 1
 				if not long_warned:
 					long_warned = int(100/t)+1
 					# thus we get at most one warning every two minutes, more or less
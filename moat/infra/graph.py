@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+An in-memory model of /infra.
+
+Tracing VLANs or paths through the etcd tree means looking up hosts over
+and over. This module reads the hosts, their ports and VLANs once; VLAN
+closures and shortest paths are computed on demand and remembered until
+something below /infra changes.
+
+Use `await tree.lookup(INFRA_DIR).graph()` to get the current model.
+"""
+
+from collections import deque
+
+from . import INFRA
+
+import logging
+logger = logging.getLogger(__name__)
+
+def VL(x):
+    if x == '-':
+        return set()
+    elif x == '*':
+        return set(('*',))
+    return set(int(v) for v in x.split(','))
+
+class NoVlanError(RuntimeError):
+    pass
+
+class CDict(dict):
+    def add(self,k):
+        self[k] = self.get(k,0)+1
+    def keys(self):
+        for k,v in self.items():
+            if v > 1:
+                yield k
+    def __ior__(self, kk):
+        for k in kk:
+            self.add(k)
+        return self
+
+class VlanInfo:
+    """The VLANs reachable from a host, in total and per port"""
+    def __init__(self, host):
+        self.host = host
+        self.ports = dict()  # name > (vlans,remote host)
+        self.vlans = CDict()
+
+    def __repr__(self):
+        return "<vli:%s>" % (self.host,)
+
+class InfraGraph:
+    """\
+        Hosts and links below /infra.
+
+        @hosts: dnsname => (vlan, {port: (vlan, remote dnsname)}).
+        The VLANs are the strings from etcd, or None if not set;
+        ports are kept in etcd's order.
+        """
+    stale = False
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self._vlans = {} # dnsname => VlanInfo
+        self._prevs = {} # dnsname => {dnsname: predecessor}
+        self._mon = None
+
+    @classmethod
+    async def build(cls, tree):
+        """Read the model from the /infra tree and watch it for changes."""
+        hosts = {}
+        async for h in tree.tagged(INFRA):
+            ports = {}
+            for n,p in h.get('ports',{}).items():
+                ports[n] = (p.get('vlan',None), p.get('host',None))
+            hosts[h.dnsname] = (h.get('vlan',None), ports)
+        self = cls(hosts)
+        self._mon = tree.add_monitor(self._updated)
+        return self
+
+    def _updated(self, tree):
+        if self._mon is None:
+            return # initial call from add_monitor()
+        if not self.stale:
+            logger.debug("infra graph: stale")
+            self.stale = True
+            self._mon.cancel()
+
+    def vlan_info(self, host):
+        """\
+            Trace which VLANs are connected to each port of this host,
+            directly or indirectly, without going through a host twice.
+
+            Ports with a VLAN setting are not followed.
+            """
+        res = self._vlans.get(host,None)
+        if res is None:
+            self._vlans[host] = res = self._trace(host)
+        return res
+
+    def _trace(self, host):
+        # depth-first, but without recursion: a long chain of
+        # switches would exceed Python's stack
+        seen = set()
+        todo = [] # [VlanInfo, port iterator, (port,remote) waiting for a result]
+
+        def visit(name):
+            res = VlanInfo(name)
+            if name in seen:
+                return res,None
+            seen.add(name)
+            vlan,ports = self.hosts[name]
+            if vlan is None:
+                raise NoVlanError(name)
+            v = VL(vlan)
+            if not v:
+                return res,None
+            res.vlans |= v
+            return res,iter(ports.items())
+
+        res,it = visit(host)
+        if it is not None:
+            todo.append([res,it,None])
+        while todo:
+            t = todo[-1]
+            vli,it,_ = t
+            for n,vh in it:
+                v,h = vh
+                if v is not None:
+                    v = VL(v)
+                elif h is None:
+                    continue
+                else:
+                    if h not in self.hosts:
+                        raise KeyError(h)
+                    hv,hit = visit(h)
+                    if hit is not None:
+                        t[2] = (n,h)
+                        todo.append([hv,hit,None])
+                        break
+                    v = hv.vlans
+                vli.ports[n] = (v,h)
+                vli.vlans |= v
+            else:
+                todo.pop()
+                if todo:
+                    t = todo[-1]
+                    (n,h),t[2] = t[2],None
+                    t[0].ports[n] = (vli.vlans,h)
+                    t[0].vlans |= vli.vlans
+        return res
+
+    def prevs(self, host):
+        """\
+            Breadth-first search from @host.
+            Returns a dict: dnsname => the host it's reached from.
+            """
+        res = self._prevs.get(host,None)
+        if res is not None:
+            return res
+        res = {host: None}
+        todo = deque((host,))
+        while todo:
+            h = todo.popleft()
+            try:
+                ports = self.hosts[h][1]
+            except KeyError:
+                continue
+            for v,r in ports.values():
+                if r is not None and r not in res:
+                    res[r] = h
+                    todo.append(r)
+        self._prevs[host] = res
+        return res
+
+    def path(self, src, dest):
+        """A shortest list of hosts from @src to @dest, or None"""
+        prevs = self.prevs(src)
+        if dest not in prevs:
+            return None
+        res = []
+        while dest is not None:
+            res.append(dest)
+            dest = prevs[dest]
+        return res[::-1]
+
+    def unreachable(self, src):
+        """All hosts which can't be reached from @src"""
+        prevs = self.prevs(src)
+        return [h for h in self.hosts if h not in prevs]
@@ -102,6 +102,14 @@ def log_level(cls, level=None):
 		levels[cls] = level
 	return ret
 
+def log_wanted(cls, level):
+	"""Check whether log(cls,level,…) would do anything, so that callers
+	can skip building expensive messages."""
+	lim = levels.get(cls,None)
+	if lim is None:
+		lim = TRACE if TESTING else INFO
+	return lim <= level
+
 logger_nr = 0
 
 class FlushMe(object):
@@ -49,6 +49,8 @@ import os
 import sys
 import socket
 
+from collections import deque
+
 import gevent
 from gevent.queue import PriorityQueue,Empty
 from gevent.event import AsyncResult
@@ -104,6 +106,7 @@ class SEND_LATER(object):
 _gid = 0
 class MsgInfo(object):
 	prio = PRIO_STANDARD
+	ordered = False # replies arrive in the order of sending; see MsgQueue.window
 
 	def list(self):
 		yield (repr(self),)
@@ -181,8 +184,12 @@ class MsgBase(MsgSender,MsgReceiver):
 	"""A message which expects a reply."""
 	timeout = None
 	blocking = False # True if the message needs a reply before sending more
+	retries = 0 # how often to re-send an ordered message after a timeout
 
 	_timer = None
+	_tries = 0
+	_window = None # the queue whose window this (ordered) message is in
+	_answered = False # (ordered) the reply has started to arrive
 	_last_channel = None
 	_send_err = None
 	_recv_err = None
@@ -239,6 +246,9 @@ class MsgBase(MsgSender,MsgReceiver):
 			raise RuntimeError("Did not trigger the result in %s.dataReceived()"%(self.__class__.__name__,))
 
 	def do_timeout(self):
+		if self._window is not None:
+			self._window.timed_out(self)
+			return
 		if self._last_channel is not None:
 			self._last_channel.close()
 			self._last_channel = None
@@ -327,6 +337,12 @@ class MsgReOpen(object):
 	prio = PRIO_CONNECT
 	pass
 
+class MsgTimedOut(object):
+	"""Signal that an ordered message did not get its reply in time"""
+	prio = PRIO_CONNECT
+	def __init__(self,msg):
+		self.msg = msg
+
 class MsgOpenMarker(object):
 	"""Signal which notes that the connection is fully open"""
 	# This is used to re-enable ReOpen messages
@@ -397,6 +413,28 @@ class MsgFactory(object):
 		
 		
 
+class _StaleReply(object):
+	"""\
+		Holds the window slot of an ordered message which timed out, so
+		that its late reply does not get mistaken for the next message's.
+		If that reply does not arrive either, the channel is restarted.
+		"""
+	blocking = False
+
+	def __init__(self,queue,msg):
+		self.msg = msg
+		self.timer = callLater(True, msg.timeout or STALE_TIMEOUT, queue.timed_out,self)
+
+	def __repr__(self):
+		return u"‹%s %s›" % (self.__class__.__name__,repr(self.msg))
+
+	def cancel(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+
+STALE_TIMEOUT = 5
+
 class BadResult(RuntimeError):
 	"""a message receiver returned something inconclusive"""
 	pass
@@ -416,6 +454,7 @@ class MsgQueue(Collected,Jobber):
 		"""
 	#storage = Nets.storage
 	max_send = None # messages to send until the channel is restarted
+	window = 1 # ordered messages that may wait for their reply; None: no limit
 	attempts = 0
 	initial_connect_timeout = 3 # initial delay between attempts, seconds
 	max_connect_timeout = 300 if not TESTING else 5 # max delay between attempts
@@ -437,6 +476,9 @@ class MsgQueue(Collected,Jobber):
 	n_sent_now = 0
 	n_rcvd_now = 0
 	n_processed_now = 0
+	n_timeouts = 0
+	n_retries = 0
+	n_late = 0
 	last_sent = None
 	last_sent_at = None
 	last_rcvd = None
@@ -448,6 +490,7 @@ class MsgQueue(Collected,Jobber):
 		self.senders = [] # to send
 		self.delayed = []
 		self.receivers = []
+		self.inflight = deque() # ordered messages, waiting for their reply
 		self.connect_timeout = self.initial_connect_timeout
 		for _ in range(N_PRIO):
 			self.senders.append([])
@@ -515,6 +558,8 @@ class MsgQueue(Collected,Jobber):
 		yield("conn attempts",self.attempts)
 		yield("conn timer",self.connect_timeout)
 		yield ("out_queued",self.n_outq)
+		yield ("window",(self.n_inflight,self.window))
+		yield ("timeouts",(self.n_timeouts,self.n_retries,self.n_late))
 		for d in self.delayed:
 			yield ("delayed",str(d))
 		if self.channel:
@@ -535,6 +580,111 @@ class MsgQueue(Collected,Jobber):
 				j += 1
 				yield("msg recv %s %s"%(i,j),m)
 			i += 1
+		j = 0
+		for m in self.inflight:
+			j += 1
+			yield("msg wait %s"%(j,),m)
+
+	def is_reply(self,msg):
+		"""\
+			Check whether an incoming message is the reply to some ordered
+			message, as opposed to an unsolicited one.
+			This is used to skip the late replies of timed-out messages.
+			"""
+		return True
+
+	def timed_out(self,msg):
+		"""Called (from a timer) when an ordered message did not get its reply"""
+		if self.q is not None:
+			self.q.put(MsgTimedOut(msg), block=False)
+
+	def _timed_out(self,msg):
+		if isinstance(msg,_StaleReply):
+			if msg.timer is None:
+				return # cancelled, but the timer had already fired
+			msg.timer = None
+			if msg in self.inflight:
+				log("conn",WARN,"no reply",self.name,str(msg.msg))
+				for m in self.inflight:
+					if isinstance(m,_StaleReply):
+						m.cancel()
+				if self.channel is not None:
+					self.channel.close()
+			return
+		if msg not in self.inflight:
+			return # the reply arrived in the meantime
+		log("msg",DEBUG,"timeout",self.name,str(msg))
+		self.n_timeouts += 1
+		self.inflight[self.inflight.index(msg)] = _StaleReply(self,msg)
+		msg._window = None
+		if msg._tries < msg.retries:
+			msg._tries += 1
+			self.n_retries += 1
+			self.senders[msg.prio].insert(0,msg)
+		elif not msg.result.ready():
+			msg.result.set(NoAnswer(self))
+
+	def _incoming_ordered(self,msg):
+		"""\
+			Offer an incoming message to the oldest ordered message that's
+			waiting for a reply. Returns True if it has been handled.
+
+			A message which returns RECV_AGAIN stays at the head of the
+			window: the rest of its reply arrives before the replies to
+			the messages sent after it. It moves to the receivers when it
+			declines a reply, which then is for the next message.
+			"""
+		m = self.inflight[0]
+		if isinstance(m,_StaleReply):
+			if not self.is_reply(msg):
+				return False
+			self.inflight.popleft()
+			m.cancel()
+			self.n_late += 1
+			log("msg",DEBUG,"late reply",self.name,str(m.msg),str(msg))
+			return True
+		try:
+			r = m.recv(msg)
+			log("msg",TRACE,"recv=",r,repr(m))
+			if r is NOT_MINE:
+				if m._answered and self.is_reply(msg):
+					# m's reply is complete
+					self.inflight.popleft()
+					m._window = None
+					self.receivers[m.prio].append(m)
+					if self.inflight:
+						return self._incoming_ordered(msg)
+				return False
+			if r is RECV_AGAIN:
+				# got the reply, but more may be to come
+				m._clear_timeout()
+				m._answered = True
+				return True
+			self.inflight.popleft()
+			m._window = None
+			if r is MINE:
+				m.done()
+				self.n_processed_now += 1
+			elif r is SEND_AGAIN:
+				self.senders[m.prio].insert(0,m)
+			elif r is ABORT:
+				self.channel.close(False)
+				self.channel = None
+			elif isinstance(r,MSG_ERROR):
+				raise r
+			else:
+				raise BadResult(m)
+		except Exception as ex:
+			if self.inflight and self.inflight[0] is m:
+				self.inflight.popleft()
+			fix_exception(ex)
+			process_failure(ex)
+
+			if self.channel is not None:
+				self.channel.close(False)
+				self.channel = None
+			simple_event("msg","error",*self.name, msg=msg)
+		return True
 
 	def _incoming(self,msg):
 		"""Process an incoming message."""
@@ -546,6 +696,8 @@ class MsgQueue(Collected,Jobber):
 		# i is an optimization for receiver lists that don't change in mid-action
 		handled = False
 		log("msg",TRACE,"recv",self.name,str(msg))
+		if self.inflight and self._incoming_ordered(msg):
+			return
 		for mq in self.receivers:
 			i = 0
 			for m in mq:
@@ -618,14 +770,27 @@ class MsgQueue(Collected,Jobber):
 		for mq in self.receivers:
 			for m in mq:
 				m.abort()
+		for m in self.inflight:
+			if isinstance(m,_StaleReply):
+				m.cancel()
+			else:
+				m.abort()
+		self.inflight.clear()
 
 	def _setup(self):
 		sends,self.senders = self.senders,[]
 		recvs,self.receivers = self.receivers,[]
+		inflight,self.inflight = self.inflight,deque()
 		for mq in recvs:
 			self.senders.append([])
 			self.receivers.append([])
-		for mq in sends+recvs:
+		for m in inflight:
+			if isinstance(m,_StaleReply):
+				m.cancel()
+			else:
+				m._window = None
+		inflight = [m for m in inflight if not isinstance(m,_StaleReply)]
+		for mq in sends+recvs+[inflight]:
 			for msg in mq:
 				try:
 					r = msg.retry()
@@ -687,8 +852,19 @@ class MsgQueue(Collected,Jobber):
 			for m in mq:
 				if isinstance(m,MsgBase):
 					res += 1
+		for m in self.inflight:
+			if isinstance(m,MsgBase):
+				res += 1
 		return res
 
+	@property
+	def n_inflight(self):
+		"""Ordered messages which wait for their reply"""
+		n = len(self.inflight)
+		if n and getattr(self.inflight[0],'_answered',False):
+			n -= 1
+		return n
+
 	@property
 	def n_outq(self):
 		n=0
@@ -752,6 +928,8 @@ class MsgQueue(Collected,Jobber):
 					callLater(True,self.connect_timeout,doReOpen)
 					self._up_timeout()
 
+			elif isinstance(msg,MsgTimedOut):
+				self._timed_out(msg.msg)
 			elif isinstance(msg,MsgError):
 				self._error(msg.error)
 			else:
@@ -775,6 +953,10 @@ class MsgQueue(Collected,Jobber):
 					if m.blocking:
 						log("msg",TRACE,"blocked by",str(m))
 						done = True
+			for m in self.inflight:
+				if m.blocking:
+					log("msg",TRACE,"blocked by",str(m))
+					done = True
 			if done: continue
 
 			for mq in self.senders:
@@ -784,6 +966,10 @@ class MsgQueue(Collected,Jobber):
 						break
 					if self.channel is None:
 						break
+					if mq[0].ordered and self.window is not None and self.n_inflight >= self.window:
+						log("msg",TRACE,"window full",len(self.inflight))
+						done = True
+						break
 
 					msg = mq.pop(0)
 					log("msg",TRACE,"send",str(msg))
@@ -798,7 +984,11 @@ class MsgQueue(Collected,Jobber):
 						self.n_sent_now += 1
 					log("msg",TRACE,"send result",r)
 					if r is RECV_AGAIN:
-						if msg.blocking:
+						if msg.ordered:
+							msg._window = self
+							msg._answered = False
+							self.inflight.append(msg)
+						elif msg.blocking:
 							self.receivers[msg.prio].insert(0,msg)
 						else:
 							self.receivers[msg.prio].append(msg)
@@ -87,11 +87,119 @@ class NetError(EnvironmentError):
 	def __repr__(self):
 		return "NetError(%d)" % (self.typ,)
 
+MAX_LINE = 65536 # bytes
+READ_SIZE = 4096
+
+class LineTooLong(RuntimeError):
+	no_backtrace = True
+	def __init__(self,dev,n):
+		self.dev = dev
+		self.n = n
+	def __str__(self):
+		return "%s: line too long, %d bytes discarded" % (self.dev,self.n)
+
+class LineBuffer(object):
+	"""\
+		Split a byte stream into lines.
+
+		Data live in a bytearray which is only compacted when it runs
+		out of space. Searching for the delimiter resumes where the last
+		search stopped, so a long line which arrives in many pieces is
+		not scanned repeatedly.
+
+		A partial line which exceeds @max_length is discarded, as is the
+		rest of it when it arrives; see .overflows and .dropped.
+		"""
+	def __init__(self, delimiter=b"\n", max_length=MAX_LINE, size=READ_SIZE):
+		self.delimiter = delimiter
+		self.max_length = max_length
+		self.buf = bytearray(size)
+		self.start = 0 # first unprocessed byte
+		self.scan = 0 # no delimiter before this
+		self.end = 0 # end of data
+		self.skipping = False
+		self.overflows = 0
+		self.dropped = 0
+
+	def __len__(self):
+		return self.end-self.start
+
+	def _reserve(self, n):
+		if len(self.buf)-self.end >= n:
+			return
+		if self.start:
+			# compact
+			k = self.end-self.start
+			self.buf[0:k] = self.buf[self.start:self.end]
+			self.end = k
+			self.scan -= self.start
+			self.start = 0
+		if len(self.buf)-self.end < n:
+			self.buf.extend(bytes(max(n,len(self.buf))))
+
+	def feed(self, data):
+		"""Add @data. Returns a list of complete lines."""
+		n = len(data)
+		self._reserve(n)
+		self.buf[self.end:self.end+n] = data
+		self.end += n
+		return self.lines()
+
+	def recv_into(self, sock, size=READ_SIZE):
+		"""\
+			Read from @sock directly into the buffer.
+			Returns the number of bytes read, i.e. zero on EOF.
+			Then call .lines().
+			"""
+		self._reserve(size)
+		with memoryview(self.buf) as mv:
+			n = sock.recv_into(mv[self.end:self.end+size])
+		self.end += n
+		return n
+
+	def lines(self):
+		"""Returns a list of the complete lines in the buffer."""
+		res = []
+		buf = self.buf
+		d = self.delimiter
+		dl = len(d)
+		with memoryview(buf) as mv:
+			while True:
+				i = buf.find(d, self.scan, self.end)
+				if i < 0:
+					break
+				if self.skipping:
+					self.skipping = False
+					self.dropped += i-self.start
+				else:
+					res.append(bytes(mv[self.start:i]))
+				self.start = self.scan = i+dl
+		if self.end-self.start > self.max_length:
+			if not self.skipping:
+				self.overflows += 1
+			self.skipping = True
+			self.dropped += self.end-self.start
+			self.start = self.scan = self.end
+		else:
+			self.scan = max(self.start, self.end-dl+1)
+		if self.start == self.end:
+			self.start = self.scan = self.end = 0
+		return res
+
 class LineReceiver(object):
 	"""A receiver mix-in for the basic line protocol."""
 
 	delimiter = b"\n"
-	buffer = b''
+	max_length = MAX_LINE
+	recv_into = True # read directly into the line buffer
+	_linebuf = None
+
+	@property
+	def linebuf(self):
+		lb = self._linebuf
+		if lb is None:
+			self._linebuf = lb = LineBuffer(self.delimiter, self.max_length)
+		return lb
 
 	def lineReceived(self, line):
 		"""Override this.
@@ -100,23 +208,29 @@ class LineReceiver(object):
 		raise NotImplementedError("You need to override NetReceiver.lineReceived")
 
 	def dataReceived(self,val):
-		buffer = self.buffer + val
-		data = []
+		self.linesReceived(self.linebuf.feed(val))
 
-		while True:
-			i = buffer.find(self.delimiter)
-			if i < 0:
-				break
-			data.append(buffer[:i])
-			buffer = buffer[i+len(self.delimiter):]
+	def _read(self):
+		if not self.recv_into:
+			return super(LineReceiver,self)._read()
+		return self.linebuf.recv_into(self.socket)
 
-		self.buffer = buffer
+	def _process(self,data):
+		if not self.recv_into:
+			return super(LineReceiver,self)._process(data)
+		self.linesReceived(self.linebuf.lines())
+
+	def linesReceived(self,data):
+		lb = self.linebuf
+		n = lb.overflows
 		for d in data:
 			try:
 				self.lineReceived(d.decode('utf-8'))
 			except Exception as e:
 				fix_exception(e)
 				process_failure(e)
+		if lb.overflows != n:
+			process_failure(LineTooLong(getattr(self,'name',self),lb.dropped))
 		
 	def write(self,val):
 		if isinstance(val,six.text_type):
@@ -137,6 +251,7 @@ class NetCommonConnector(Collected,Jobber):
 	typ = "???common"
 	job = None
 	socket = None
+	nodelay = False # set TCP_NODELAY, for protocols which pipeline small requests
 
 	def __init__(self, name, host,port, socket=None):
 		self.socket = socket
@@ -201,6 +316,8 @@ class NetCommonConnector(Collected,Jobber):
 			break
 		if s is None:
 			reraise(e)
+		if self.nodelay and af in (socket.AF_INET,socket.AF_INET6):
+			s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 		self.socket = s
 
 	def _reader(self):
@@ -209,7 +326,7 @@ class NetCommonConnector(Collected,Jobber):
 				try:
 					if self.socket.closed:
 						return
-					r = self.socket.recv(4096)
+					r = self._read()
 					if not r:
 						return
 				except Exception as e:
@@ -217,7 +334,7 @@ class NetCommonConnector(Collected,Jobber):
 					process_failure(e)
 					return
 				try:
-					self.dataReceived(r)
+					self._process(r)
 				except Exception as e:
 					fix_exception(e)
 					process_failure(e)
@@ -228,6 +345,14 @@ class NetCommonConnector(Collected,Jobber):
 				self.down_event(True)
 
 	
+	def _read(self):
+		"""Read some data. Returns something false on EOF."""
+		return self.socket.recv(READ_SIZE)
+
+	def _process(self,data):
+		"""Handle whatever _read() returned."""
+		self.dataReceived(data)
+
 	def dataReceived(self):
 		raise NotImplementedError("You need to override %s.dataReceived()" % (self.__class__.__name__,))
 
@@ -41,6 +41,7 @@ from moat.event import Event
 from moat.run import process_failure,simple_event
 from moat.twist import callLater, fix_exception, Jobber
 from moat.base import Name
+from moat.times import now,humandelta
 from moat.net import NetActiveConnector
 from moat.msg import MsgReceiver,MsgBase,MsgQueue,MsgFactory,\
 	PRIO_STANDARD,PRIO_URGENT,PRIO_BACKGROUND,\
@@ -61,6 +62,13 @@ MAX_TRIES = 5 # retrying a message until failure
 
 PERSIST=True # Default
 
+FULL_SCAN = 12 # every Nth bus scan re-lists all branches
+
+# Families which understand "simultaneous/temperature" and "latesttemp":
+# DS18S20, DS1822, DS18B20, DS1825, DS28EA00
+TEMP_FAMILIES = ("10.","22.","28.","3b.","42.")
+CONVERSION_TIME = 0.75 # seconds, at 12 bits
+
 @six.python_2_unicode_compatible
 class DisconnectedDeviceError(RuntimeError):
 	"""A devince has vanished."""
@@ -367,6 +375,107 @@ class DIRmsg(OWFScall):
 	def __repr__(self):
 		return "‹"+self.__class__.__name__+" "+"/".join(self.path)+"›"
 		
+class OWFSconverter(object):
+	"""\
+		Coordinates temperature reads on one bus segment.
+
+		Reading "temperature" makes each sensor run its own conversion.
+		Instead, all requests which arrive within @gather seconds share
+		a single write to "simultaneous/temperature"; after the conversion
+		time, the sensors' "latesttemp" values are read in one burst.
+		Requests which arrive while this is going on start the next round.
+		"""
+	gather = 0.1 # seconds to wait for more requests
+	conv_time = CONVERSION_TIME
+
+	def __init__(self, bus,path):
+		self.bus = bus
+		self.path = tuple(path)
+		self.waiting = {} # device => [AsyncResult]
+		self.job = None
+		self.n_conv = 0
+		self.n_read = 0
+		self.last_conv = None
+
+	def __repr__(self):
+		return u"‹%s %s›" % (self.__class__.__name__,"/".join(self.path))
+
+	def list(self):
+		yield ("path",self.path)
+		yield ("conversions",self.n_conv)
+		yield ("reads",self.n_read)
+		if self.last_conv is not None:
+			yield ("last conversion",self.last_conv)
+		yield ("waiting",len(self.waiting))
+
+	@staticmethod
+	def handles(dev,key):
+		"""Check whether reading @key from @dev may be coordinated"""
+		return key == "temperature" and dev.id.startswith(TEMP_FAMILIES)
+
+	def get(self, dev):
+		"""Return the temperature of @dev, which must be on this segment."""
+		res = AsyncResult()
+		self.waiting.setdefault(dev,[]).append(res)
+		if self.job is None:
+			self.job = gevent.spawn(self._run)
+		return res.get()
+
+	def _run(self):
+		try:
+			while self.waiting:
+				gevent.sleep(self.gather)
+				waiting,self.waiting = self.waiting,{}
+				self._convert(waiting)
+		finally:
+			self.job = None
+
+	def _convert(self, waiting):
+		"""Run one conversion for @waiting. All of them get a result."""
+		try:
+			self._do_convert(waiting)
+		except Exception as ex:
+			fix_exception(ex)
+			for rs in waiting.values():
+				for r in rs:
+					if not r.ready():
+						r.set_exception(ex)
+
+	def _do_convert(self, waiting):
+		msg = ATTRsetmsg(self.path+('simultaneous','temperature'),1)
+		msg.queue(self.bus)
+		res = msg.result.get()
+		if isinstance(res,Exception):
+			raise res
+		self.n_conv += 1
+		self.last_conv = now()
+		gevent.sleep(self.conv_time)
+
+		msgs = []
+		for dev in waiting.keys():
+			try:
+				msg = ATTRgetmsg(dev._attr('latesttemp'))
+			except Exception as ex:
+				fix_exception(ex)
+				msg = ex
+			else:
+				msg.queue(self.bus)
+			msgs.append((dev,msg))
+		for dev,msg in msgs:
+			if not isinstance(msg,Exception):
+				try:
+					msg = dev._result(msg)
+				except Exception as ex:
+					fix_exception(ex)
+					msg = ex
+			if isinstance(msg,Exception):
+				for r in waiting[dev]:
+					r.set_exception(msg)
+			else:
+				self.n_read += 1
+				for r in waiting[dev]:
+					r.set(msg)
+
 class OWbuses(Collection):
        name = "onewire bus"
 OWbuses = OWbuses()
@@ -393,6 +502,14 @@ class OWFSqueue(MsgQueue,Jobber):
 			self.max_send = 1
 		self.nop = None
 		self.bus_paths = {}
+		self.converters = {}
+		self.branches = {} # path => names last listed there
+		self.dirty = set() # paths to re-list on the next scan
+		self.n_scans = 0
+		self.last_full = None
+		self.scan_time = None
+		self.n_listed = 0
+		self.n_cached = 0
 
 	### Bus scanning support
 
@@ -415,6 +532,19 @@ class OWFSqueue(MsgQueue,Jobber):
 				yield ("wire",b.path)
 			else:
 				yield ("wire",b.list(short_dev=True))
+		if not short_buspath:
+			for c in self.converters.values():
+				yield ("conversion",c.list())
+			yield ("scan",self._scan_list())
+
+	def converter(self, path):
+		"""Return the conversion coordinator for this bus segment"""
+		path = tuple(path)
+		try:
+			return self.converters[path]
+		except KeyError:
+			c = self.converters[path] = OWFSconverter(self,path)
+			return c
 
 	def _clean_watched(self):
 		while True:
@@ -426,7 +556,33 @@ class OWFSqueue(MsgQueue,Jobber):
 				q.set_exception(RuntimeError("Stopped"))
 		self.watch_q = None
 
-	def all_devices(self, bus_cb=None):
+	def _scan_list(self):
+		yield ("scans",self.n_scans)
+		if self.scan_time is not None:
+			yield ("last scan",humandelta(self.scan_time))
+		if self.last_full is not None:
+			yield ("last full scan",self.last_full)
+		yield ("branches",len(self.branches))
+		yield ("listed",self.n_listed)
+		yield ("cached",self.n_cached)
+		yield ("dirty",len(self.dirty))
+
+	def invalidate(self, path=()):
+		"""Re-list this branch, and everything below it, on the next scan"""
+		path = tuple(path)
+		n = len(path)
+		for p in self.branches.keys():
+			if p[:n] == path:
+				self.dirty.add(p)
+
+	def all_devices(self, bus_cb=None, full=True):
+		"""\
+			Enumerate the devices on this bus.
+
+			Unless @full is set, branches which have been listed before and
+			not been invalidated since are not listed again; their cached
+			contents are used instead. The top level is always listed.
+			"""
 		seen_mplex = set()
 		def doit(dev,path=(),key=None):
 			buses = []
@@ -439,7 +595,26 @@ class OWFSqueue(MsgQueue,Jobber):
 				else:
 					log("onewire",TRACE,"got unrecognized name %s" % (name,))
 
-			dev.dir(key=key,proc=got_entry,path=path)
+			bp = dev.path
+			if dev.bus_id:
+				bp += (dev.bus_id,)
+			bp += path
+			if key:
+				bp += (key,)
+			names = self.branches.get(bp,None)
+			if full or not bp or names is None or bp in self.dirty:
+				names = []
+				if dev.dir(key=key,proc=names.append,path=path) is None:
+					# error: try again next time
+					self.branches.pop(bp,None)
+				else:
+					self.branches[bp] = names
+					self.dirty.discard(bp)
+				self.n_listed += 1
+			else:
+				self.n_cached += 1
+			for name in names:
+				got_entry(name)
 
 			if buses:
 				for b in buses:
@@ -449,13 +624,7 @@ class OWFSqueue(MsgQueue,Jobber):
 						yield res
 				return
 
-			p = dev.path
-			if dev.bus_id:
-				p += (dev.bus_id,)
-			p += path
-			if key:
-				p += (key,)
-
+			p = bp
 			for b in entries:
 				dn = OWFSdevice(id=b,bus=self,path=p)
 				yield dn
@@ -473,11 +642,11 @@ class OWFSqueue(MsgQueue,Jobber):
 
 		return doit(self.root)
 
-	def update_all(self):
+	def update_all(self, full=False):
 		try:
 			simple_event("onewire","scanning",*self.name, deprecated=True)
 			simple_event("onewire","scan",*self.name, run="running")
-			self._update_all()
+			self._update_all(full=full)
 		except Exception as e:
 			fix_exception(e)
 			process_failure(e)
@@ -485,8 +654,17 @@ class OWFSqueue(MsgQueue,Jobber):
 			# error only; success below
 			simple_event("onewire","scan",*self.name, run="error", error=str(e))
 
-	def _update_all(self):
+	def _update_all(self, full=False):
 		log("onewire",TRACE,"start bus update")
+		start = now()
+		if self.last_full is None or not self.n_scans % FULL_SCAN:
+			full = True
+		self.n_scans += 1
+		self.n_listed = 0
+		self.n_cached = 0
+		if full:
+			self.branches = {}
+			self.dirty = set()
 		old_ids = devices.copy()
 		new_ids = {}
 		seen_ids = {}
@@ -499,7 +677,7 @@ class OWFSqueue(MsgQueue,Jobber):
 			else:
 				new_bus.add(path)
 
-		for dev in self.all_devices(bus_cb):
+		for dev in self.all_devices(bus_cb, full=full):
 			if dev.id in seen_ids:
 				continue
 			seen_ids[dev.id] = dev
@@ -525,6 +703,10 @@ class OWFSqueue(MsgQueue,Jobber):
 		for dev in old_bus:
 			bp = self.bus_paths.pop(dev)
 			bp.stop()
+			self.converters.pop(dev,None)
+			for p in list(self.branches.keys()):
+				if p[:len(dev)] == dev:
+					del self.branches[p]
 			simple_event("onewire","bus","down", bus=self.name,path=dev)
 			simple_event("onewire","bus","state",self.name,"/".join(dev), bus=self.name,path=dev, state="down")
 		for dev in new_bus:
@@ -532,6 +714,11 @@ class OWFSqueue(MsgQueue,Jobber):
 			simple_event("onewire","bus","up", bus=self.name,path=dev)
 			simple_event("onewire","bus","state",self.name,"/".join(dev), bus=self.name,path=dev, state="up")
 
+		self.scan_time = now()-start
+		if full:
+			self.last_full = start
+		log("onewire",DEBUG,"bus scan",self.name,"full" if full else "partial", self.n_listed,self.n_cached, self.scan_time)
+
 		# success only, error above
 		simple_event("onewire","scanned",*self.name, old=n_old, new=len(new_ids), num=n_dev, deprecated=True)
 		simple_event("onewire","scan",*self.name, run="done", old=n_old, new=len(new_ids), num=n_dev)
@@ -541,7 +728,8 @@ class OWFSqueue(MsgQueue,Jobber):
 		while True:
 			if self.scan or res:
 				try:
-					self.update_all()
+					# an explicit request re-lists everything
+					self.update_all(full=bool(res))
 				except Exception as ex:
 					fix_exception(ex)
 					process_failure(ex)
@@ -733,12 +921,15 @@ class OWFSdevice(Collected):
 		if not self.is_up:
 			return
 		self.is_up = False
+		if hasattr(self.bus,'invalidate'):
+			self.bus.invalidate(self.path)
 		if _ is not None:
 			process_failure(_)
 		simple_event("onewire","down",typ=self.typ,id=self.id,bus=self.bus.name,path=self.path, deprecated=True)
 		simple_event("onewire","device","state",self.id, typ=self.typ,id=self.id,bus=self.bus.name,path=self.path, state="down")
 
-	def get(self,key):
+	def _attr(self,key):
+		"""Build the path to one of this device's attributes"""
 		if not self.bus:
 			raise DisconnectedDeviceError(self.id)
 		if not isinstance(key,tuple):
@@ -747,11 +938,15 @@ class OWFSdevice(Collected):
 		p = self.path
 		if self.bus_id is not None:
 			p += (self.bus_id,)
-		p += key
+		return p+key
 
-		msg = ATTRgetmsg(p)
+	def get(self,key):
+		msg = ATTRgetmsg(self._attr(key))
 		msg.queue(self.bus)
+		return self._result(msg)
 
+	def _result(self,msg):
+		"""Wait for the result of an ATTRgetmsg and convert it"""
 		try:
 			res = msg.result.get()
 		except Exception as ex:
@@ -773,17 +968,7 @@ class OWFSdevice(Collected):
 		return res
 
 	def set(self,key,val):
-		if not self.bus:
-			raise DisconnectedDeviceError(self.id)
-		if not isinstance(key,tuple):
-			key = Name(key)
-
-		p = self.path
-		if self.bus_id is not None:
-			p += (self.bus_id,)
-		p += key
-
-		msg = ATTRsetmsg(p,val)
+		msg = ATTRsetmsg(self._attr(key),val)
 		msg.queue(self.bus)
 		try:
 			return msg.result.get()
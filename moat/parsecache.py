@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+This code caches the statement structure of configuration files.
+
+When a file has not changed, the statements the parser found in it are
+replayed to the interpreter without tokenizing and parsing it again.
+Looking up and running the statements still happens, in the same order.
+
+The cache is keyed by the file's content and the set of loaded modules.
+There is one entry per file name; a changed file simply replaces it.
+
+"""
+
+import six
+
+import os
+import json
+from hashlib import sha256
+
+from moat.logging import log,DEBUG
+
+FORMAT = 1
+
+class Recorder(object):
+	"""\
+		Wraps a processor and records the calls the parser makes to it.
+		"""
+	def __init__(self, proc, events=None):
+		self.proc = proc
+		self.events = [] if events is None else events
+
+	def __getattr__(self, k):
+		return getattr(self.proc,k)
+
+	def simple_statement(self,args):
+		self.events.append(("s",list(args)))
+		return self.proc.simple_statement(args)
+
+	def complex_statement(self,args):
+		self.events.append(("c",list(args)))
+		return Recorder(self.proc.complex_statement(args), self.events)
+
+	def done(self):
+		self.events.append(("d",))
+		return self.proc.done()
+
+class ParseCache(object):
+	"""Stores the recorded statements of configuration files in a directory."""
+	def __init__(self, dir):
+		self.dir = dir
+		self.hits = 0
+		self.misses = 0
+		if not os.path.isdir(dir):
+			os.makedirs(dir)
+
+	def __repr__(self):
+		return u"‹%s %s›" % (self.__class__.__name__,self.dir)
+
+	def key(self, lines):
+		"""Hash the file's content and the currently-loaded modules."""
+		from moat.module import Modules
+
+		h = sha256()
+		h.update(("%d\n" % (FORMAT,)).encode("utf-8"))
+		for m in sorted(six.text_type(m) for m in Modules):
+			h.update(("M %s\n" % (m,)).encode("utf-8"))
+		for l in lines:
+			h.update(l.encode("utf-8"))
+		return h.hexdigest()
+
+	def _path(self, filename):
+		h = sha256(os.path.abspath(filename).encode("utf-8")).hexdigest()
+		return os.path.join(self.dir, h[:32]+".json")
+
+	def get(self, filename, key):
+		"""Returns the recorded statements, or None."""
+		try:
+			with open(self._path(filename)) as f:
+				data = json.load(f)
+		except (EnvironmentError,ValueError):
+			data = None
+		if data is None or data.get("key") != key:
+			self.misses += 1
+			return None
+		self.hits += 1
+		log("parser",DEBUG,"cached",filename)
+		return data["events"]
+
+	def put(self, filename, key, events):
+		path = self._path(filename)
+		tmp = path+".tmp"
+		try:
+			with open(tmp,"w") as f:
+				json.dump({"file":filename, "key":key, "events":events}, f)
+		except TypeError: # some argument can't be stored
+			os.unlink(tmp)
+			return
+		os.rename(tmp,path)
+
+cache = None
+
+def set_cache(dir):
+	"""Use (or, with dir=None, stop using) a parse cache."""
+	global cache
+	cache = ParseCache(dir) if dir else None
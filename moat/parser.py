@@ -35,10 +35,12 @@ for typical usage.
 
 import six
 
-from moat.tokize import tokizer
+from moat.tokize import tokizer,tokenize_lines
 from tokenize import tok_name
 import sys
 import os
+import io
+import stat
 import errno
 
 import gevent
@@ -52,6 +54,7 @@ from moat.event import Event,StopParsing
 from moat.statement import global_words
 from moat.twist import fix_exception,reraise,Jobber
 from moat.collect import Collection,Collected
+from moat import parsecache
 
 class Parsers(Collection):
 	name = "parser"
@@ -68,9 +71,17 @@ class Parser(Collected,Jobber):
 	do_prompt = False
 	last_pos = None
 	job = None
+	sync = None
+	errors = 0
 
-	def __init__(self, input, interpreter, ctx=None):
-		"""Parse an input stream and pass the commands to the processor @proc."""
+	def __init__(self, input, interpreter, ctx=None, sync=None):
+		"""\
+			Parse an input stream and pass the commands to the processor @proc.
+
+			@sync: tokenize all of the input before parsing it, instead of
+			feeding it line by line to a tokenizer job. The default is to
+			do that for non-interactive file input.
+			"""
 		global _npars
 		_npars += 1
 		super(Parser,self).__init__("n"+str(_npars))
@@ -87,11 +98,16 @@ class Parser(Collected,Jobber):
 		self.input = input
 		self.proc = interpreter
 		self.do_prompt = interpreter.do_prompt
+		if sync is not None:
+			self.sync = sync
+		elif input is not None and not self.do_prompt:
+			self.sync = self._is_file(input)
 
 	def list(self):
 		"""Yield a couple of (left,right) tuples, for enumeration."""
 		yield super(Parser,self)
 		yield ("input",str(self.input))
+		yield ("sync",self.sync)
 		if self.last_pos is not None:
 			yield ("line",str(self.last_pos[0]))
 			yield ("pos",str(self.last_pos[1]))
@@ -106,12 +122,22 @@ class Parser(Collected,Jobber):
 	def lineReceived(self, data):
 		self.add_line(data)
 
+	@staticmethod
+	def _is_file(input):
+		try:
+			return stat.S_ISREG(os.fstat(input.fileno()).st_mode)
+		except (AttributeError,EnvironmentError,io.UnsupportedOperation):
+			return False
+
 	def run(self):
 		self.init_state()
 		self.prompt()
 		if self.input is None:
 			self.p_gen = tokizer(self._do_parse,self.job,self.stop_client)
 			return
+		if self.sync:
+			self._run_sync()
+			return
 		syn = AsyncResult()
 		self.start_job("job",self._run,syn)
 		self.p_gen = tokizer(self._do_parse,self.job)
@@ -150,6 +176,69 @@ class Parser(Collected,Jobber):
 			self.input.close()
 			self.input = None
 		return "Bla"
+
+	def _run_sync(self):
+		"""\
+			Read and tokenize the whole input, then parse the result.
+
+			The token stream is the same as _run() would feed to the
+			tokenizer job, including the final "." line.
+			"""
+		name = getattr(self.input,"name",None)
+		try:
+			lines = [ l if isinstance(l,six.text_type) else l.decode("utf-8") for l in self.input ]
+		finally:
+			self.input.close()
+			self.input = None
+		lines.append(".")
+
+		cache = parsecache.cache
+		if cache is not None and isinstance(name,six.string_types):
+			key = cache.key(lines)
+			events = cache.get(name,key)
+			if events is not None:
+				self._replay(events)
+				return
+			self.proc = rec = parsecache.Recorder(self.proc)
+		else:
+			rec = None
+
+		tokens,err = tokenize_lines(lines)
+		try:
+			for t in tokens:
+				self._do_parse(*t)
+		except StopParsing:
+			return
+		if err is not None:
+			reraise(err)
+		if rec is not None and not self.errors:
+			cache.put(name,key,rec.events)
+
+	def _replay(self, events):
+		"""\
+			Feed cached statements to the interpreter, like _parseStep
+			would have done.
+			"""
+		try:
+			for e in events:
+				try:
+					if e[0] == "s":
+						self.proc.simple_statement(e[1])
+					elif e[0] == "c":
+						_ = self.proc.complex_statement(e[1])
+						self.p_stack.append(self.proc)
+						self.proc = _
+					else:
+						self.proc.done()
+						if self.p_stack:
+							self.proc = self.p_stack.pop()
+				except Exception as ex:
+					fix_exception(ex)
+					if self.p_stack:
+						self.proc = self.p_stack[0]
+					self.proc.error(self,ex)
+		except StopParsing:
+			pass
 	
 
 	def endConnection(self, res=None, kill=True):
@@ -201,6 +290,7 @@ class Parser(Collected,Jobber):
 
 		except Exception as ex:
 			fix_exception(ex)
+			self.errors += 1
 			if self.p_stack:
 				self.proc = self.p_stack[0]
 
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+Count the requests a command sends to etcd, and the bytes it gets back.
+"""
+
+from time import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+class EtcStats:
+	"""\
+		Hooks into an aio_etcd client and counts every response.
+
+		Reads which a snapshot answers locally are not counted, as they
+		don't cause a round trip.
+		"""
+	def __init__(self, client):
+		self.client = client
+		self.requests = 0
+		self.bytes = 0
+		self.started = time()
+		self._handle = client._handle_server_response
+		client._handle_server_response = self._handle_response
+
+	async def _handle_response(self, response):
+		data = await response.read() # aiohttp keeps the body
+		self.requests += 1
+		self.bytes += len(data)
+		return (await self._handle(response))
+
+	def close(self):
+		"""Unhook from the client."""
+		if self.client is not None:
+			del self.client._handle_server_response
+			self.client = None
+
+	def __str__(self):
+		return "etcd: %d requests, %d bytes, %.3f sec" % (self.requests, self.bytes, time()-self.started)
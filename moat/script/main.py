@@ -54,6 +54,7 @@ DEFAULT_CONFIG = dict(
 		'max-retry':600,
 		'restart':2,
 		'one-shot':False,
+		'perf':60,
 	}
 )
 
@@ -85,6 +86,8 @@ You can load more than one config file.
 	cfg = None
 	verbose = None
 	etcd = None
+	snapshot = None
+	etc_stats = None
 	amqp = None
 	tree = None
 	loop = None
@@ -136,6 +139,9 @@ You can load more than one config file.
 		self.parser.add_option('-a', '--app',
 			action="store", dest="app",
 			help="application name. Default is the reversed FQDN.")
+		self.parser.add_option('--lazy',
+			action="store_true", dest="lazy",
+			help="load etcd subtrees when they're accessed")
 
 	async def finish(self):
 		logger.debug("Closing %s",self)
@@ -174,6 +180,15 @@ You can load more than one config file.
 			except Exception as exc:
 				logger.exception("Closing etcd tree")
 
+		e,self.snapshot = self.snapshot,None
+		if e is not None:
+			try:
+				await e.close()
+			except NameError:
+				pass # GC
+			except Exception as exc:
+				logger.exception("Closing etcd snapshot")
+
 		e,self.etcd = self.etcd,None
 		if e is not None:
 			try:
@@ -183,6 +198,13 @@ You can load more than one config file.
 			except Exception as exc:
 				logger.exception("Closing etcd connection")
 
+		e,self.etc_stats = self.etc_stats,None
+		if e is not None:
+			e.close()
+			logger.info("%s", e)
+			if self.verbose is not None and self.verbose > 1:
+				print(e, file=sys.stderr)
+
 		await super().finish()
 		logger.debug("Closed %s",self)
 
@@ -312,6 +334,7 @@ You can load more than one config file.
 
 				from moat.types.etcd import MoatRoot
 				self.tree = await etc.tree('/', root_cls=MoatRoot, immediate=None)
+				self.tree.lazy = bool(self.options.lazy)
 				self.types = await self.tree.subdir(TYPEDEF_DIR,recursive=True)
 		return self.tree
 
@@ -319,7 +342,9 @@ You can load more than one config file.
 		"""\
 			Connect to etcd.
 
-			Also, underlays the current configuration with whatever is in etcd.
+			Also, underlays the current configuration with whatever is in etcd,
+			and starts the local snapshot if config.snapshot is set.
+			Requests to etcd are counted; see moat.script.etcstats.
 			"""
 		if self.etcd is not None:
 			return self.etcd
@@ -328,6 +353,13 @@ You can load more than one config file.
 		self._types = types = EtcTypes()
 
 		self.etcd = etc = await client(self.cfg, loop=self.loop)
+		from moat.script.etcstats import EtcStats
+		self.etc_stats = EtcStats(etc.client)
+		snap = self.cfg['config'].get('snapshot',None)
+		if snap:
+			from moat.script.snapshot import EtcSnapshot
+			self.snapshot = EtcSnapshot(snap, etc, loop=self.loop)
+			await self.snapshot.start()
 		self.etc_cfg = await etc.tree("/config", types=types.step('config'))
 		self.cfg = OverlayDict(self.cfg,{'config': self.etc_cfg})
 		return etc
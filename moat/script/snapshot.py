@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+A local snapshot of the etcd tree.
+
+Loading the MoaT tree from etcd takes one recursive read per subtree.
+On large installations that's slow, so the last-seen state of the tree
+can be kept in a file. On startup the snapshot is caught up with the
+events etcd has seen since, or re-read in one go if etcd has compacted
+its history (or there were too many). It is then kept current by a
+watcher and answers plain reads while it's at least as current as
+every tree watcher on the connection.
+
+Enable it with `config.snapshot: /path/to/file`.
+"""
+
+import asyncio
+import json
+import os
+from time import time
+
+import aio_etcd as etcd
+
+import logging
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+_PROPS = ('key','value','dir','ttl','expiration','modifiedIndex','createdIndex')
+
+def _norm(key):
+	return '/'+key.strip('/')
+
+def _parent(key):
+	return key.rsplit('/',1)[0] or '/'
+
+class _Client:
+	"""\
+		Wraps an aio_etcd client. Reads are answered from the snapshot
+		if possible; writes tell the snapshot which index to wait for.
+		"""
+	def __init__(self, client, snap):
+		self._client = client
+		self._snap = snap
+
+	def __getattr__(self, k):
+		return getattr(self._client,k)
+
+	async def read(self, key, **kw):
+		snap = self._snap
+		if set(kw) <= {'recursive'} and snap.current:
+			return snap.read(key, recursive=kw.get('recursive',False))
+		snap.misses += 1
+		return (await self._client.read(key, **kw))
+
+	async def write(self, key, value, **kw):
+		res = await self._client.write(key, value, **kw)
+		self._snap.wrote(res)
+		return res
+
+	async def delete(self, key, **kw):
+		res = await self._client.delete(key, **kw)
+		self._snap.wrote(res)
+		return res
+
+class EtcSnapshot:
+	"""\
+		Keeps a copy of an etcd (sub)tree, optionally saved in a file.
+
+		@conn: the etcd_tree client. Its aio_etcd client is wrapped so
+		that plain reads are answered locally.
+		"""
+	max_events = 500 # catching up with more than this: reload instead
+	catchup_timeout = 2 # etcd didn't report anything within this time
+
+	index = None
+	_watcher = None
+
+	def __init__(self, path, conn, loop=None):
+		self.path = path
+		self.conn = conn
+		self.loop = loop if loop is not None else asyncio.get_event_loop()
+		self.root = _norm(conn.root)
+		self.nodes = {}
+		self.children = {}
+		self.need = 0
+		self.hits = 0
+		self.misses = 0
+		self.n_events = 0
+		self.full = False
+		self.client = conn.client
+
+	def __repr__(self):
+		return "<%s %s @%s>" % (self.__class__.__name__, self.path, self.index)
+
+	@property
+	def current(self):
+		"""Is it OK to read from the snapshot?"""
+		if self.index is None or self.index < self.need:
+			return False
+		for t in self.conn._trees:
+			if getattr(t,'last_read',0) > self.index:
+				return False
+		return True
+
+	async def start(self):
+		"""Load the snapshot, bring it up to date, and hook into the client."""
+		t1 = time()
+		try:
+			self.load()
+		except (EnvironmentError,ValueError,KeyError) as exc:
+			if not isinstance(exc,FileNotFoundError):
+				logger.warning("Snapshot %s unusable: %r", self.path, exc)
+			self._clear()
+		if self.index is not None:
+			try:
+				await self._catch_up()
+			except etcd.EtcdEventIndexCleared:
+				logger.info("Snapshot %s: etcd history compacted", self.path)
+				self.index = None
+			except asyncio.TimeoutError:
+				logger.info("Snapshot %s: catch-up stalled at %d", self.path, self.index)
+				self.index = None
+		if self.index is None:
+			await self._load_all()
+		logger.info("Snapshot %s: %d nodes at %d, %s in %.3fs", self.path, len(self.nodes), self.index,
+			"full load" if self.full else "%d events" % self.n_events, time()-t1)
+		if self.path is not None and (self.full or self.n_events):
+			self.save()
+
+		self.conn.client = _Client(self.client, self)
+		self._watcher = asyncio.ensure_future(self._watch(), loop=self.loop)
+
+	async def close(self, save=True):
+		"""Unhook from the client, stop watching and save the snapshot."""
+		if isinstance(self.conn.client, _Client):
+			self.conn.client = self.client
+		w,self._watcher = self._watcher,None
+		if w is not None:
+			w.cancel()
+			try:
+				await w
+			except asyncio.CancelledError:
+				pass
+			except Exception:
+				logger.exception("Snapshot watcher")
+		if save and self.path is not None and self.index is not None:
+			self.save()
+		logger.debug("Snapshot %s: %d reads, %d passed on", self.path, self.hits, self.misses)
+
+	def _clear(self):
+		self.index = None
+		self.nodes = {}
+		self.children = {}
+
+	def load(self):
+		with open(self.path) as f:
+			data = json.load(f)
+		if data['format'] != FORMAT or data['root'] != self.root:
+			raise ValueError("wrong format or root")
+		self._clear()
+		for n in data['nodes']:
+			self._store(n)
+		self.index = data['index']
+
+	def save(self):
+		tmp = self.path+".tmp"
+		with open(tmp,"w") as f:
+			json.dump({'format':FORMAT, 'root':self.root, 'index':self.index,
+				'nodes':list(self.nodes.values())}, f)
+		os.rename(tmp,self.path)
+
+	async def _load_all(self):
+		"""Read the whole tree, in one go"""
+		res = await self.client.read(self.root, recursive=True)
+		self._clear()
+		node = {k:getattr(res,k) for k in _PROPS}
+		node['key'] = self.root
+		node['nodes'] = res._children
+		todo = [node]
+		while todo:
+			n = todo.pop()
+			todo.extend(n.pop('nodes',()))
+			self._store(n)
+		self.index = res.etcd_index
+		self.full = True
+
+	async def _catch_up(self):
+		"""Apply the changes since the snapshot was taken"""
+		cur = (await self.client.read(self.root)).etcd_index
+		while self.index < cur:
+			if self.n_events >= self.max_events:
+				raise etcd.EtcdEventIndexCleared("too many changes")
+			# A timeout means that we can't tell whether we missed anything,
+			# so it propagates and the caller re-reads the whole tree.
+			res = await asyncio.wait_for(self.client.read(self.root, recursive=True,
+				wait=True, waitIndex=self.index+1), self.catchup_timeout)
+			self.apply(res)
+
+	async def _watch(self):
+		try:
+			await self.client.eternal_watch(self.root, index=self.index+1, recursive=True, callback=self.apply)
+		except asyncio.CancelledError:
+			raise
+		except Exception:
+			logger.exception("Snapshot %s: watcher died", self.path)
+			self.index = None # don't save, don't answer
+			if isinstance(self.conn.client, _Client):
+				self.conn.client = self.client
+
+	def _store(self, n):
+		n = {k:v for k,v in n.items() if k in _PROPS and v is not None}
+		key = n['key'] = _norm(n['key'])
+		self.nodes[key] = n
+		if n.get('dir',False):
+			self.children.setdefault(key,set())
+		if key != self.root:
+			p = _parent(key)
+			if p not in self.nodes:
+				self._store({'key':p, 'dir':True,
+					'modifiedIndex':n.get('modifiedIndex'), 'createdIndex':n.get('createdIndex')})
+			self.children[p].add(key)
+
+	def _drop(self, key):
+		for k in self.children.pop(key,()):
+			self._drop(k)
+		self.nodes.pop(key,None)
+
+	def apply(self, res):
+		"""Process an event from etcd's watch stream"""
+		key = _norm(res.key)
+		if res.modifiedIndex <= (self.index or 0):
+			return
+		if key == self.root or key.startswith(self.root.rstrip('/')+'/'):
+			if res.action in {'delete','expire','compareAndDelete'}:
+				self._drop(key)
+				p = _parent(key)
+				if p in self.children:
+					self.children[p].discard(key)
+			else:
+				self._store({k:getattr(res,k) for k in _PROPS})
+		self.index = res.modifiedIndex
+		self.n_events += 1
+
+	def wrote(self, res):
+		"""Our own write: don't answer reads until the watcher has seen it"""
+		i = getattr(res,'modifiedIndex',None)
+		if i is not None and i > self.need:
+			self.need = i
+
+	def _node(self, key, recursive, top=True):
+		n = dict(self.nodes[key])
+		if n.get('dir',False) and (top or recursive):
+			n['nodes'] = [self._node(k,recursive,False) for k in self.children.get(key,())]
+		return n
+
+	def read(self, key, recursive=False):
+		"""Answer a plain read, like etcd would"""
+		key = _norm(key)
+		self.hits += 1
+		if key not in self.nodes:
+			raise etcd.EtcdKeyNotFound("Key not found : "+key, payload={'errorCode':100,'index':self.index})
+		n = self._node(key, recursive)
+		if key == '/':
+			del n['key']
+		res = etcd.EtcdResult('get',n)
+		res.etcd_index = res.raft_index = self.index
+		return res
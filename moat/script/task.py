@@ -30,9 +30,10 @@ Class for managing tasks.
 import attr
 import asyncio
 from etcd_tree.etcd import EtcTypes, WatchStopped
-from etcd_tree.node import EtcFloat,EtcBase
+from etcd_tree.node import EtcFloat,EtcBase,EtcDir
 import etcd
 import inspect
+import json
 from time import time
 from traceback import format_exception
 import weakref
@@ -40,6 +41,7 @@ from bdb import BdbQuit
 
 from moat.task import _VARS, TASK_DIR,TASKDEF_DIR,TASK,TASKDEF, TASKSTATE_DIR,TASKSTATE
 from moat.task.reg import Reg, Task as regTask
+from moat.task.perf import TaskPerf, start_loop_lag, stop_loop_lag
 
 import logging
 logger = logging.getLogger(__name__)
@@ -81,6 +83,11 @@ class Task(regTask):
 		To facilitate releasing resources allocated by a task, the task has
 		a moat_reg attribute; see moat.task.reg for details.
 
+		Run-time statistics are collected in `self.perf`; see
+		moat.task.perf. Tasks which loop should wrap each iteration in
+		`with self.perf.iteration():`. The `perf` config value controls how
+		often (in seconds) the statistics are published; zero turns that off.
+
 		"""
 	taskdef = None
 	summary = """This is a prototype. Do not use."""
@@ -140,6 +147,7 @@ class Task(regTask):
 		self._refresh = config.get('refresh',None) if _refresh is None else _refresh
 		self.parents = parents
 		self.taskdir = taskdir
+		self.perf = TaskPerf()
 
 	def __repr__(self):
 		r = super().__repr__()
@@ -176,6 +184,23 @@ class Task(regTask):
 		async def send_alert(**kw):
 			await self.amqp.alert('moat.task.'+'.'.join(run_state.path[len(TASKSTATE_DIR):-1]),kw)
 
+		async def send_perf():
+			p = self.perf.summary()
+			pd = run_state.get('perf',None)
+			if isinstance(pd,EtcDir): # old format
+				await run_state.delete('perf', recursive=True)
+			# one etcd write, not one per value
+			await run_state.set("perf",json.dumps(p, sort_keys=True))
+			await send_alert(state='perf', perf=p)
+
+		async def perf_updater(interval):
+			while True:
+				await asyncio.sleep(interval, loop=r.loop)
+				try:
+					await send_perf()
+				except (etcd.EtcdKeyNotFound,KeyError):
+					pass # race condition
+
 		await send_alert(state= 'setup')
 		main_task = None
 		Reg(task=self, loop=self.loop)
@@ -306,7 +331,10 @@ class Task(regTask):
 			await save_exc(exc)
 			raise
 		run_task = self.moat_reg.task(updater(refresh))
-		self._main = main_task = self.moat_reg.task(self.task())
+		self._main = main_task = self.moat_reg.task(self.perf.wrap(self.task()))
+		start_loop_lag(r.loop)
+		perf_interval = float(r.cfg['config']['run'].get('perf',0))
+		perf_task = self.moat_reg.task(perf_updater(perf_interval)) if perf_interval > 0 else None
 		res = None
 		try:
 			try:
@@ -385,11 +413,24 @@ class Task(regTask):
 
 		finally: # Clean up everything
 			self._main = None
+			stop_loop_lag()
+			if perf_task is not None:
+				perf_task.cancel()
+				try:
+					await perf_task
+				except asyncio.CancelledError:
+					pass
+				except Exception:
+					logger.exception("Perf updater %s",self)
 			try:
 				await self.teardown()
 			except Exception as exc:
 				logger.exception("Clean up %s",self)
 
+			try:
+				await send_perf()
+			except Exception as exc:
+				logger.exception("Perf data %s",self)
 			await run_state.set("stopped",time())
 			if not keep_running and 'running' in run_state:
 				try:
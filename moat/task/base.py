@@ -256,4 +256,5 @@ TaskState.register('started')(EtcFloat)
 TaskState.register('stopped')(EtcFloat)
 TaskState.register('running')(TaskRunning)
 TaskState.register('debug_time')(EtcFloat)
+TaskState.register('perf')(EtcString) # JSON, see moat.task.perf.TaskPerf.summary
 
@@ -24,14 +24,39 @@ from __future__ import absolute_import, print_function, division, unicode_litera
 ##BP
 
 import asyncio
+from time import time
 from etcd_tree import EtcFloat,EtcString, ReloadRecursive
 
-from . import TASK_DIR,TASKSCAN_DIR
+from . import TASK_DIR,TASKSCAN_DIR,TASK
 from moat.script.task import Task
 
 import logging
 logger = logging.getLogger(__name__)
 
+BATCH = 50 # etcd writes between waiting for the results
+
+def same_value(node, value):
+	"""Check whether an etcd node holds @value, recursively"""
+	if isinstance(value,dict):
+		if not hasattr(node,'keys') or set(node.keys()) != set(value.keys()):
+			return False
+		for k,v in value.items():
+			if not same_value(node[k],v):
+				return False
+		return True
+	return getattr(node,'value',node) == value
+
+def same_task(node, taskdef, kw):
+	"""Check whether the task at @node matches what add_task() would write"""
+	if not isinstance(taskdef,str):
+		taskdef = '/'.join(taskdef)
+	kw = kw.copy()
+	parent = kw.pop('parent',None)
+	d = dict(taskdef=taskdef, data=kw)
+	if parent is not None:
+		d['parent'] = '/'.join(parent.path)
+	return same_value(node, d)
+
 class Collector(Task):
 	"""\
 		This task runs a task collector.
@@ -40,6 +65,11 @@ class Collector(Task):
 		attribute/property which supports the async iteration protocol.
 		The node is found by simply chopping %s off the front
 		of this task's path.
+
+		The initial results are collected until the monitor says "watch",
+		then compared with the tasks in etcd; only the differences are
+		written. Later results are applied as they arrive, if they
+		change anything.
 		""" % ('/'.join(TASKSCAN_DIR),)
 
 	taskdef="task/collect"
@@ -59,7 +89,72 @@ class Collector(Task):
 		# But if it is, remember
 		known = set()
 
+		# (kind,path) => (taskdef,kw); kind is "add" or "scan"
+		pending = {}
+		drops = set()
+		started = time()
+		watching = False
+
+		def below(path):
+			return len(path) == len(master.path)+1 and path[:-1] == master.path
+
+		async def lookup(d, path):
+			try:
+				return await d.lookup(*(tuple(path)+(TASK,)))
+			except KeyError:
+				return None
+
+		async def apply(cleanup=False):
+			"""Write the pending changes"""
+			nonlocal started
+			stats = dict(added=0,changed=0,unchanged=0,removed=0)
+			r = None
+			n = 0
+			async def step(res):
+				nonlocal r,n
+				if res is not None:
+					r = res
+				n += 1
+				if n % BATCH == 0 and r is not None:
+					await root.wait(r)
+
+			with self.perf.iteration():
+				for (kind,path),(taskdef,kw) in pending.items():
+					d = tasks if kind == "add" else scantasks
+					t = await lookup(d,path)
+					if t is not None and same_task(t,taskdef,kw):
+						stats['unchanged'] += 1
+						continue
+					stats['added' if t is None else 'changed'] += 1
+					await step(await d.add_task(path=path, taskdef=taskdef, force=(t is not None), sync=False, **kw))
+				pending.clear()
+
+				for path in drops:
+					try:
+						t = await tasks.lookup(*path)
+					except KeyError:
+						continue
+					stats['removed'] += 1
+					await step(await t.delete(recursive=True, sync=False))
+				drops.clear()
+
+				if cleanup:
+					for k in list(me.keys()):
+						if k[0] != ':' and k not in known:
+							logger.info("Deleting "+'/'.join(me.path+(k,)))
+							stats['removed'] += 1
+							await step(await me.delete(k, sync=False))
+				if r is not None:
+					await root.wait(r)
+
+			stats['seconds'] = time()-started
+			changes = stats['added']+stats['changed']+stats['removed']
+			(logger.info if changes else logger.debug)("Collect %s: %d added, %d changed, %d removed, %d unchanged, %.3fs", self.name, stats['added'],stats['changed'],stats['removed'],stats['unchanged'],stats['seconds'])
+			self.stats = stats
+			started = time()
+
 		async def found(r):
+			nonlocal watching
 			logger.debug("Collect %s: %s",self.name,r)
 #			if self.cmd.root.verbose > 2:
 #				print(r)
@@ -67,33 +162,37 @@ class Collector(Task):
 			if typ == "add":
 				typ,taskdef,path,kw = r
 				kw.setdefault('parent',master)
-				await tasks.add_task(path=path, taskdef=taskdef, **kw)
-				if len(path) == len(master.path)+1 and path[:-1] == master.path:
+				path = tuple(path)
+				pending[("add",path)] = (taskdef,kw)
+				drops.discard(path)
+				if below(path):
 					known.add(path[-1])
 			elif typ == "scan":
 				typ,path,kw = r
 				kw.setdefault('parent',master)
-				await scantasks.add_task(path=path, taskdef=self.taskdef, **kw)
-				if len(path) == len(master.path)+1 and path[:-1] == master.path:
+				pending[("scan",tuple(path))] = (self.taskdef,kw)
+				if below(path):
 					known.add(path[-1])
 			elif typ == "drop":
 				typ,path = r
-				t = await tasks.subdir(*path)
-				await t.delete(recursive=True)
-				if len(path) == len(master.path)+1 and path[:-1] == master.path:
+				path = tuple(path)
+				pending.pop(("add",path),None)
+				drops.add(path)
+				if below(path):
 					try:
 						known.remove(path[-1])
 					except KeyError:
 						pass
 			elif typ == "watch":
-				for k in list(me.keys()):
-					if k[0] != ':' and k not in known:
-						logger.info("Deleting "+'/'.join(me.path+(k,)))
-						await me.delete(k)
+				watching = True
+				await apply(cleanup=True)
 				if self.cfg.get('one-shot',False):
 					raise StopAsyncIteration
+				return
 			else:
 				raise NotImplementedError("Unknown Collect result: "+repr(r))
+			if watching:
+				await apply()
 
 		try:
 			if hasattr(coll,'__aiter__'):
@@ -104,6 +203,8 @@ class Collector(Task):
 					await found(r)
 		except StopAsyncIteration:
 			pass
+		if pending or drops:
+			await apply()
 
 		# sleep
 		if not self.cfg.get('one-shot',False):
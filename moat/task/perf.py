@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+
+"""\
+This module collects run-time statistics for MoaT tasks.
+
+A task's coroutines are wrapped so that the wall and CPU time spent
+inside them is accounted for; everything else is time spent waiting,
+i.e. awaited I/O. Tasks which loop mark their iterations; each iteration
+is recorded in a small ring buffer.
+
+A process-wide monitor samples the event loop's lag.
+"""
+
+import asyncio
+from time import time, perf_counter, process_time
+from collections.abc import Coroutine as CoroutineABC
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Ring:
+	"""\
+		A fixed-size ring buffer of samples.
+
+		Samples are tuples; nothing is allocated after setup, except for
+		the tuples themselves.
+		"""
+	def __init__(self, size=128):
+		self.size = size
+		self.data = [None]*size
+		self.pos = 0
+		self.count = 0
+
+	def add(self, sample):
+		self.data[self.pos] = sample
+		self.pos += 1
+		if self.pos == self.size:
+			self.pos = 0
+		self.count += 1
+
+	def __len__(self):
+		return min(self.count,self.size)
+
+	def __iter__(self):
+		"""Iterate over the samples, oldest first"""
+		if self.count >= self.size:
+			yield from self.data[self.pos:]
+		yield from self.data[:self.pos]
+
+class _TimedCoro(CoroutineABC):
+	"""\
+		Wraps a coroutine and adds the time spent in each of its steps to
+		a TaskPerf record.
+		"""
+	def __init__(self, coro, perf):
+		self._coro = coro
+		self._perf = perf
+
+	def send(self, value):
+		w = perf_counter(); c = process_time()
+		try:
+			return self._coro.send(value)
+		finally:
+			p = self._perf
+			p.busy += perf_counter()-w
+			p.cpu += process_time()-c
+			p.steps += 1
+
+	def throw(self, typ, val=None, tb=None):
+		w = perf_counter(); c = process_time()
+		try:
+			return self._coro.throw(typ, val, tb)
+		finally:
+			p = self._perf
+			p.busy += perf_counter()-w
+			p.cpu += process_time()-c
+			p.steps += 1
+
+	def close(self):
+		return self._coro.close()
+
+	def __await__(self):
+		return self
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return self.send(None)
+
+	def __repr__(self):
+		return "<timed %r>" % (self._coro,)
+
+class _Iteration:
+	def __init__(self, perf):
+		self.perf = perf
+
+	def __enter__(self):
+		p = self.perf
+		self.t = time()
+		self.w = perf_counter()
+		self.busy = p.busy
+		self.cpu = p.cpu
+		return self
+
+	def __exit__(self, *tb):
+		p = self.perf
+		wall = perf_counter()-self.w
+		busy = p.busy-self.busy
+		lag = loop_lag.max_since(self.t) if loop_lag is not None else 0
+		p.ring.add((self.t, wall, p.cpu-self.cpu, max(wall-busy,0), lag))
+		p.iterations += 1
+
+class TaskPerf:
+	"""\
+		Run-time statistics for a single task.
+
+		@busy, @cpu: wall and CPU seconds spent running the task's code
+		@steps: number of times the task's code was resumed
+		@iterations: number of iterations recorded
+		@overruns: number of iterations which took longer than planned
+		@ring: (timestamp, wall, cpu, io, lag) of recent iterations
+		"""
+	def __init__(self, size=128):
+		self.started = time()
+		self.busy = 0
+		self.cpu = 0
+		self.steps = 0
+		self.iterations = 0
+		self.overruns = 0
+		self.ring = Ring(size)
+
+	def wrap(self, coro):
+		"""Account for the time spent in this coroutine"""
+		return _TimedCoro(coro, self)
+
+	def iteration(self):
+		"""\
+			Record one iteration of a looping task:
+
+				with self.perf.iteration():
+					await self.do_something()
+			"""
+		return _Iteration(self)
+
+	def summary(self):
+		"""\
+			Aggregate the data collected so far into a dict which is
+			suitable for storing in etcd, or sending via AMQP.
+			"""
+		now = time()
+		res = dict(
+			uptime=now-self.started,
+			busy=self.busy,
+			cpu=self.cpu,
+			steps=self.steps,
+			iterations=self.iterations,
+			overruns=self.overruns,
+			)
+		if now > self.started:
+			res['load'] = self.cpu/(now-self.started)
+		n = len(self.ring)
+		if n:
+			s_wall = s_cpu = s_io = 0
+			m_wall = m_cpu = m_lag = 0
+			for _,wall,cpu,io,lag in self.ring:
+				s_wall += wall; s_cpu += cpu; s_io += io
+				if m_wall < wall: m_wall = wall
+				if m_cpu < cpu: m_cpu = cpu
+				if m_lag < lag: m_lag = lag
+			res.update(wall_avg=s_wall/n, wall_max=m_wall, cpu_avg=s_cpu/n, cpu_max=m_cpu, io_avg=s_io/n, lag_max=m_lag)
+		if loop_lag is not None:
+			res['loop_lag'] = loop_lag.current
+		return res
+
+class LoopLag:
+	"""\
+		Periodically measure how late the event loop runs a timer.
+
+		The last @size samples are kept as (timestamp, lag) tuples.
+		"""
+	def __init__(self, loop, interval=0.5, size=128):
+		self.loop = loop
+		self.interval = interval
+		self.ring = Ring(size)
+		self.current = 0
+		self._timer = None
+		self._users = 0
+
+	def start(self):
+		self._users += 1
+		if self._timer is None:
+			self._schedule()
+
+	def stop(self):
+		self._users -= 1
+		if self._users <= 0 and self._timer is not None:
+			self._timer.cancel()
+			self._timer = None
+
+	def cancel(self):
+		"""Stop sampling, regardless of users"""
+		self._users = 0
+		if self._timer is not None:
+			self._timer.cancel()
+			self._timer = None
+
+	def _schedule(self):
+		self._due = self.loop.time()+self.interval
+		self._timer = self.loop.call_at(self._due, self._tick)
+
+	def _tick(self):
+		self.current = max(self.loop.time()-self._due, 0)
+		self.ring.add((time(), self.current))
+		self._schedule()
+
+	def max_since(self, ts):
+		res = self.current
+		for t,lag in self.ring:
+			if t >= ts and res < lag:
+				res = lag
+		return res
+
+loop_lag = None
+
+def start_loop_lag(loop):
+	"""Start monitoring the loop. Each call must be paired with stop_loop_lag()."""
+	global loop_lag
+	if loop_lag is None or loop_lag.loop is not loop:
+		if loop_lag is not None:
+			loop_lag.cancel()
+		loop_lag = LoopLag(loop)
+	loop_lag.start()
+	return loop_lag
+
+def stop_loop_lag():
+	if loop_lag is not None:
+		loop_lag.stop()
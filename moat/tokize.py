@@ -33,7 +33,7 @@ import string, re, os, sys
 from token import *
 from . import tokenize27 as t
 
-from moat.logging import log,TRACE
+from moat.logging import log,log_wanted,TRACE
 from moat.event import StopParsing
 from moat.twist import fix_exception, Jobber
 
@@ -94,15 +94,18 @@ tokenprog, pseudoprog, namestart, num = map(
 tabsize = 8
 
 class tokizer(Jobber):
-	def __init__(self, output, parent=None, endput=None):
+	q = None
+
+	def __init__(self, output, parent=None, endput=None, start=True):
 		super(tokizer,self).__init__()
 		self._output = output
 		self._endput = endput
 		self.parent = parent
-		self.q = Channel()
 		self.init()
-		self.start_job("job",self._job)
-		self.job.link(self._end)
+		if start:
+			self.q = Channel()
+			self.start_job("job",self._job)
+			self.job.link(self._end)
 	
 	def init(self):
 		self.lnum = self.parenlev = self.continued = 0
@@ -282,3 +285,23 @@ class tokizer(Jobber):
 				self.parent.kill(e)
 			return
 
+
+def tokenize_lines(lines):
+	"""\
+		Tokenize a whole non-interactive input in one go, without a
+		separate job and without per-token logging.
+
+		Returns a list of (type,text,begin,end,line) tuples, plus the
+		error which stopped tokenizing (or None).
+		"""
+	res = []
+	tok = tokizer(lambda *a: res.append(a), start=False)
+	if not log_wanted("token",TRACE):
+		tok.output = tok._output
+	try:
+		for line in lines:
+			tok._do_line(line)
+	except Exception as e:
+		fix_exception(e)
+		return res,e
+	return res,None
@@ -29,7 +29,7 @@ from pprint import pformat
 from time import time
 
 from qbroker.util import import_string
-from etcd_tree import EtcRoot, EtcDir, EtcString, EtcInteger, EtcXValue, ReloadRecursive
+from etcd_tree import EtcRoot, EtcDir, EtcString, EtcInteger, EtcXValue, EtcAwaiter, ReloadRecursive
 
 import logging
 logger = logging.getLogger(__name__)
@@ -40,13 +40,90 @@ from . import TYPEDEF_DIR,TYPEDEF
 # fixed names at the root of the tree
 
 class recEtcDir:
-	"""an EtcDir mix-in which always loads its content up front"""
+	"""\
+		An EtcDir mix-in which loads its content up front.
+
+		If the root is in lazy mode, only the first @prefetch levels of
+		subdirectories are loaded; the rest is fetched on first access.
+		Use load_all() if you need all of it.
+		"""
+	prefetch = 2
+	_prefetching = False
+
 	@classmethod
 	async def this_obj(cls, recursive, **kw):
-		if not recursive:
+		if not recursive and not is_lazy(kw.get('parent',None)):
 			raise ReloadRecursive
 		return (await super().this_obj(recursive=recursive, **kw))
 
+	async def init(self):
+		await super().init()
+		if self.prefetch and is_lazy(self):
+			p = self.parent
+			while p is not None:
+				if getattr(p,'_prefetching',False):
+					return # the ancestor takes care of this
+				p = p.parent
+			await self._prefetch(self.prefetch)
+
+	async def _fill_data(self, pre, recursive):
+		if recursive is False and is_lazy(self):
+			recursive = None # don't cascade single-level reads
+		await super()._fill_data(pre=pre, recursive=recursive)
+
+	async def _prefetch(self, depth):
+		self._prefetching = True
+		try:
+			await load_levels(self, depth)
+		finally:
+			self._prefetching = False
+
+	async def load_all(self):
+		"""Load everything below this node. See load_all()."""
+		await load_all(self)
+
+def is_lazy(node):
+	"""Does this node's tree load recEtcDir subtrees on demand?"""
+	if node is None:
+		return False
+	return getattr(node.root,'lazy',False)
+
+async def load_levels(node, depth=None, recursive=None):
+	"""\
+		Load @depth levels of subdirectories below @node, one level at a
+		time. Subdirectories which are loaded by this are read with
+		@recursive.
+		"""
+	level = [node]
+	while level and depth != 0:
+		aw = []
+		nxt = []
+		for d in level:
+			for v in list(d._data.values()):
+				if type(v) is EtcAwaiter:
+					aw.append(v.load(recursive=recursive))
+				elif isinstance(v,EtcDir):
+					nxt.append(v)
+		res = await asyncio.gather(*aw, loop=node._loop)
+		if not recursive:
+			nxt.extend(res)
+		level = nxt
+		if depth is not None:
+			depth -= 1
+
+async def load_all(node):
+	"""\
+		Make sure that everything below @node is present, e.g. before
+		dumping it. Every subtree that's not yet loaded is read in one go.
+
+		This is a no-op unless the tree is lazy.
+		"""
+	if isinstance(node,EtcAwaiter):
+		node = await node
+	if is_lazy(node):
+		await load_levels(node, recursive=True)
+	return node
+
 class MoatBusBase(EtcDir):
 	"""\
 		Base class for /bus/‹name› subsystems.
@@ -152,6 +229,8 @@ class MoatMetaModule(EtcDir):
 		if hasattr(obj,'schema'):
 			d['data'] = obj.schema
 		tt = await self.subdir(obj.prefix, create=None)
+		if force:
+			await load_all(tt)
 		r = None
 		lang = tt.get('language',None)
 		if lang is None:
@@ -225,6 +304,8 @@ class MoatMetaTask(EtcDir):
 		if hasattr(task,'schema'):
 			d['data'] = task.schema
 		tt = await self.subdir(task.taskdef,name=TASKDEF, create=None)
+		if force:
+			await load_all(tt)
 		lang = tt.get('language',None)
 		if lang is None:
 			logger.info("%s: new", task.taskdef)
@@ -282,6 +363,8 @@ class MoatMetaWeb(recEtcDir,EtcDir):
 		if hasattr(webdef,'schema'):
 			d['data'] = webdef.schema
 		tt = await self.subdir(webdef.name,name=WEBDEF, create=None)
+		if force:
+			await load_all(tt)
 		if force:
 			changed = []
 			for k,v in d.items():
@@ -328,6 +411,8 @@ class MoatInfraSub(EtcDir):
 	pass
 
 class MoatInfra(EtcDir):
+	_graph = None
+
 	async def init(self):
 		from moat.infra.base import InfraHost, InfraStatic
 		self.register("*", cls=MoatInfraSub)
@@ -341,6 +426,17 @@ class MoatInfra(EtcDir):
 		from moat.infra import INFRA
 		return (await self.subdir(host.split('.')[::-1], name=INFRA, **kw))
 
+	async def graph(self):
+		"""\
+			Return a model of the hosts and their links.
+			It's re-read after anything below /infra changes.
+			"""
+		from moat.infra.graph import InfraGraph
+		g = self._graph
+		if g is None or g.stale:
+			self._graph = g = await InfraGraph.build(self)
+		return g
+
 class MoatStatusRun(EtcDir):
 	"""Singleton for /status/run"""
 	async def init(self):
@@ -390,7 +486,7 @@ class MoatTask(EtcDir):
 		self.register('*', cls=MoatTask)
 		await super().init()
 
-	async def add_task(self, path, taskdef, force=False, parent=None, **kw):
+	async def add_task(self, path, taskdef, force=False, parent=None, sync=True, **kw):
 		from moat.task import TASK,TASKDEF_DIR,TASKDEF
 
 		if isinstance(path,str):
@@ -451,6 +547,8 @@ class MoatTask(EtcDir):
 				logger.debug("%s: not changed", p)
 		else:
 			logger.debug("%s: exists, skipped", p)
+		if not sync:
+			return r
 		if r is not None:
 			await self.root.wait(r)
 
@@ -557,6 +655,8 @@ class StaticSubdirs(_Subdirs):
 
 class MoatRoot(EtcRoot):
 	"""Singleton for etcd / (root)"""
+	lazy = False # see recEtcDir
+
 	async def init(self):
 		self._managed = WeakValueDictionary()
 
@@ -35,7 +35,7 @@ from moat.base import Name,SName
 from moat.logging import log,DEBUG,TRACE,INFO,WARN
 from moat.statement import Statement, main_words, AttributedStatement
 from moat.check import Check,register_condition,unregister_condition
-from moat.onewire import connect,disconnect, devices
+from moat.onewire import connect,disconnect, devices, OWFSconverter
 from moat.net import NetConnect
 from moat.monitor import Monitor,MonitorHandler, MonitorAgain
 from moat.in_out import register_input,register_output, unregister_input,unregister_output, Input,Output
@@ -227,7 +227,12 @@ class OWFSmon(Monitor):
 		dev = devices[self.device]
 		if self.switch is not None:
 			dev.set(self.switch, self.to_high if self.switched else self.to_low)
-		val = dev.get(self.attribute)
+			val = dev.get(self.attribute)
+		elif OWFSconverter.handles(dev,self.attribute):
+			# share the conversion with other sensors on this segment
+			val = dev.bus.converter(dev.path).get(dev)
+		else:
+			val = dev.get(self.attribute)
 		if val == "":
 			raise MonitorAgain(self.name)
 		val = float(val)
@@ -537,6 +542,8 @@ class OWFSpoller(Collected,Jobber):
 		if id not in devices:
 			if id not in self.seen_new:
 				self.seen_new.add(id)
+				# make the next bus scan look for it
+				self.bus.bus.invalidate(self.bus.path)
 				simple_event("onewire","alarm","new", bus=self.bus.bus.name, path=self.path, id=id)
 			return # not yet known, presumably on next scan
 		if id in self.seen_new:
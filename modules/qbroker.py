@@ -39,11 +39,14 @@ from moat.twist import Jobber,fix_exception,reraise
 from moat.run import process_failure,simple_event,register_worker,unregister_worker,MIN_PRIO
 from moat.event import TrySomethingElse
 from moat.worker import Worker
-from moat.logging import BaseLogger,TRACE,LogLevels,LogNames
+from moat.logging import BaseLogger,TRACE,WARN,LogLevels,LogNames,log_exc
 from moat.times import now
 
 from datetime import datetime,date,time,timedelta
 from weakref import ref
+from collections import OrderedDict
+from itertools import count
+import asyncio
 
 from gevent.queue import Queue
 from gevent.event import AsyncResult
@@ -55,6 +58,10 @@ from qbroker.unit import CC_DICT
 
 conn_seq = 0
 
+QUEUE_SIZE = 1000 # events waiting for the broker
+BATCH = 100 # events sent concurrently
+POLICIES = ("drop","oldest","coalesce")
+
 class QBconns(Collection):
 	name = Name("qbroker","connection")
 QBconns = QBconns()
@@ -98,6 +105,114 @@ def gen_rpcconn(name):
 	return namedRPC
 		
 
+class EventBridge(object):
+	"""\
+		Hand events from the gevent side to a publisher task on the
+		asyncio side, without waiting for the broker.
+
+		The queue is bounded. When it is full, the policy decides:
+		drop: discard the new event
+		oldest: discard the oldest queued event
+		coalesce: a new event replaces a queued one with the same name;
+		          otherwise discard the oldest
+		"""
+	task = None
+
+	def __init__(self, server, size=QUEUE_SIZE, policy="drop", batch=BATCH):
+		if size < 1:
+			raise ValueError("The queue size must be at least 1")
+		self.server = server
+		self.size = size
+		self.policy = policy
+		self.batch = batch
+		self.queue = OrderedDict()
+		self._seq = count()
+		self._wake = None
+		self._woken = False
+		self.n_queued = 0
+		self.n_sent = 0
+		self.n_dropped = 0
+		self.n_coalesced = 0
+		self.n_failed = 0
+
+	def start(self):
+		qbroker.loop.call_soon_threadsafe(self._start)
+
+	def _start(self):
+		self._wake = asyncio.Event(loop=qbroker.loop)
+		self.task = asyncio.ensure_future(self._run(), loop=qbroker.loop)
+		if self.queue:
+			self._wake.set()
+
+	def stop(self):
+		if self.task is not None:
+			qbroker.loop.call_soon_threadsafe(self.task.cancel)
+			self.task = None
+
+	def put(self, name, data):
+		"""Queue an event. Never blocks."""
+		q = self.queue
+		if self.policy == "coalesce":
+			key = name
+			if key in q:
+				q[key] = (name,data)
+				self.n_coalesced += 1
+				return
+		else:
+			key = next(self._seq)
+		if len(q) >= self.size:
+			self.n_dropped += 1
+			if self.policy == "drop":
+				return
+			q.popitem(last=False)
+		q[key] = (name,data)
+		self.n_queued += 1
+		if not self._woken and self._wake is not None:
+			self._woken = True
+			qbroker.loop.call_soon_threadsafe(self._wake.set)
+
+	async def _run(self):
+		while True:
+			await self._wake.wait()
+			self._wake.clear()
+			self._woken = False
+			while self.queue:
+				msgs = []
+				while self.queue and len(msgs) < self.batch:
+					msgs.append(self.queue.popitem(last=False)[1])
+				res = await asyncio.gather(*(self.server.alert(name, **data) for name,data in msgs), loop=qbroker.loop, return_exceptions=True)
+				for (name,_),r in zip(msgs,res):
+					if isinstance(r,Exception):
+						self.n_failed += 1
+						log_exc(msg=u"qbroker: could not send %s:" % (name,), err=r, level=WARN)
+					else:
+						self.n_sent += 1
+
+	def list(self):
+		yield ("queue",len(self.queue))
+		yield ("queue max",self.size)
+		yield ("policy",self.policy)
+		yield ("queued",self.n_queued)
+		yield ("sent",self.n_sent)
+		yield ("dropped",self.n_dropped)
+		yield ("coalesced",self.n_coalesced)
+		yield ("failed",self.n_failed)
+
+def match_event(filters, event):
+	"""\
+		Check whether @event starts with any of @filters.
+		A '*' in a filter matches any single word.
+		"""
+	for f in filters:
+		if len(f) > len(event):
+			continue
+		for a,b in zip(f,event):
+			if a != '*' and a != b:
+				break
+		else:
+			return True
+	return False
+
 class EventCallback(Worker):
 	args = None
 	prio = MIN_PRIO+1
@@ -123,15 +238,23 @@ class EventCallback(Worker):
 			yield("args",self.args)
 
 	def does_event(self,event):
-		return True
+		filters = self.parent.filters
+		return not filters or match_event(filters,event)
 	
 	def process(self, event, queue=None, **k):
 		super().process(event=event)
 
-		k.update(event.ctx)
-		k['event'] = list(event)
-		if self.parent and self.parent.server:
-			self.parent.server.alert_gevent('moat.event.'+'.'.join(event), **k)
+		p = self.parent
+		if p and p.server:
+			if p.context is None:
+				k.update(event.ctx)
+			else:
+				ctx = event.ctx
+				for c in p.context:
+					if c in ctx:
+						k[c] = ctx[c]
+			k['event'] = list(event)
+			p.bridge.put('moat.event.'+'.'.join(event), k)
 		raise TrySomethingElse
 
 	def cancel(self):
@@ -142,7 +265,7 @@ class QBconn(Collected,Jobber):
 	"""A channel server"""
 	storage = QBconns
 
-	def __init__(self,name, host,port,vhost,app,codec, username,password):
+	def __init__(self,name, host,port,vhost,app,codec, username,password, filters=(),context=None,queue_size=QUEUE_SIZE,policy="drop"):
 		self.name = name
 		self.host=host
 		self.port=port
@@ -151,8 +274,11 @@ class QBconn(Collected,Jobber):
 		self.codec=codec
 		self.username=username
 		self.password=password
+		self.filters=filters
+		self.context=context
 		super().__init__()
 		self.server = qbroker.Unit(self.app, amqp=dict(codec=self.codec, server={'host':self.host,'port':self.port,'virtualhost':self.vhost,'login':self.username,'password':self.password}), loop=qbroker.loop)
+		self.bridge = EventBridge(self.server, size=queue_size, policy=policy)
 		self._rpc_connect()
 		self.evt = EventCallback(self)
 		register_worker(self.evt)
@@ -164,9 +290,11 @@ class QBconn(Collected,Jobber):
 
 	def start(self):
 		self.server.start_gevent(*getattr(moat,'_args',()))
+		self.bridge.start()
 		simple_event("qbroker","connect",*self.name)
 
 	def delete(self,ctx=None):
+		self.bridge.stop()
 		self.server.stop_gevent()
 		self.server = None
 		if self.evt is not None:
@@ -182,6 +310,11 @@ class QBconn(Collected,Jobber):
 		yield ("app",self.app)
 		yield ("codec",self.codec)
 		yield ("server",repr(self.server))
+		for f in self.filters:
+			yield ("filter"," ".join(f))
+		if self.context is not None:
+			yield ("context"," ".join(self.context))
+		yield self.bridge
 		
 	def _rpc_connect(self):
 		self.server.register_rpc("moat.list",self._list, call_conv=CC_DICT)
@@ -267,6 +400,11 @@ This command sets up an AMQP connection with QBroker semantics.
 It feeds all events to QBroker, and registers two commands:
 'cmd' to execute arbitrary MoaT commands
 'list' to display MoaT internals
+
+Events are queued and sent by a separate task, so a slow broker does
+not slow down MoaT. Use 'filter', 'context' and 'queue' to restrict
+which events, and which of their data, get sent, and what happens
+when the broker can't keep up.
 """
 
 	dest = None
@@ -275,6 +413,13 @@ It feeds all events to QBroker, and registers two commands:
 	codec = 'DEFAULT'
 	username="test"
 	password="test"
+	context = None
+	queue_size = QUEUE_SIZE
+	policy = "drop"
+
+	def __init__(self,*a,**k):
+		super(QBconnect,self).__init__(*a,**k)
+		self.filters = []
 
 	def run(self,ctx,**k):
 		event = self.params(ctx)
@@ -293,7 +438,7 @@ It feeds all events to QBroker, and registers two commands:
 			port = int(event[2])
 		else:
 			port = 5672
-		q = QBconn(dest,host,port,self.vhost,self.app,self.codec, self.username,self.password)
+		q = QBconn(dest,host,port,self.vhost,self.app,self.codec, self.username,self.password, filters=self.filters,context=self.context,queue_size=self.queue_size,policy=self.policy)
 		try:
 			q.start()
 		except Exception:
@@ -386,6 +531,68 @@ user ‹username› ‹password›
 		self.parent.password = event[1]
 QBconnect.register_statement(QBuser)
 
+class QBfilter(Statement):
+	name="filter"
+	doc="only send these events"
+
+	long_doc = u"""\
+filter ‹word…›
+- Only send events which start with these words.
+  '*' matches any single word. Use more than once to send more events.
+  Without a filter, all events are sent.
+"""
+
+	def run(self,ctx,**k):
+		event = self.params(ctx)
+		if len(event) < 1:
+			raise SyntaxError("Usage: filter ‹word…›")
+		self.parent.filters.append(tuple(event))
+QBconnect.register_statement(QBfilter)
+
+class QBcontext(Statement):
+	name="context"
+	doc="only send these event parameters"
+
+	long_doc = u"""\
+context ‹name…›
+- Send only these values of the event's context.
+  By default, the whole context is sent.
+"""
+
+	def run(self,ctx,**k):
+		event = self.params(ctx)
+		if self.parent.context is None:
+			self.parent.context = []
+		self.parent.context.extend(event)
+QBconnect.register_statement(QBcontext)
+
+class QBqueue(Statement):
+	name="queue"
+	doc="set the queue size and overflow policy"
+
+	long_doc = u"""\
+queue ‹size› [‹policy›]
+- Queue at most this many events while the broker is busy.
+  When the queue is full, the policy decides:
+  drop: discard the new event (default)
+  oldest: discard the oldest queued event
+  coalesce: only send the most recent event of each name
+"""
+
+	def run(self,ctx,**k):
+		event = self.params(ctx)
+		if len(event) < 1 or len(event) > 2:
+			raise SyntaxError("Usage: queue ‹size› [‹policy›]")
+		size = int(event[0])
+		if size < 1:
+			raise SyntaxError("The queue size must be at least 1")
+		self.parent.queue_size = size
+		if len(event) > 1:
+			if event[1] not in POLICIES:
+				raise SyntaxError("Policy must be one of: "+" ".join(POLICIES))
+			self.parent.policy = event[1]
+QBconnect.register_statement(QBqueue)
+
 class QBmodule(Module):
 	"""\
 		This module implements QB access to the MoaT process.
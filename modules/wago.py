@@ -145,6 +145,7 @@ class WAGOchannel(WAGOassembler, NetActiveConnector):
 	"""A receiver for the protocol used by the wago adapter."""
 	storage = WAGOchannels
 	typ = "wago"
+	nodelay = True # commands are pipelined
 
 	def handshake(self, external=False):
 		pass
@@ -198,8 +199,11 @@ class WAGOinitMsg(MsgReceiver):
 
 class WAGOmsgBase(MsgBase):
 	"""a small class to hold the common send() code"""
+	ordered = True # the server answers commands in sequence
+
 	def send(self,conn):
 		log("wago",TRACE,"send",repr(self.msg))
+		self._set_timeout() # does nothing unless the subclass sets .timeout
 		conn.write(self.msg)
 		return RECV_AGAIN
 
@@ -351,10 +355,14 @@ class WAGOqueue(MsgQueue):
 	storage = WAGOservers
 	ondemand = False
 	max_send = None
+	window = 8
 
 	def __init__(self, name, host,port, *a,**k):
 		super(WAGOqueue,self).__init__(name=name, factory=MsgFactory(WAGOchannel,name=name,host=host,port=port, **k))
 
+	def is_reply(self,msg):
+		return msg.type not in (MT_INFO,MT_IND,MT_IND_NAK)
+
 	def setup(self):
 		self.enqueue(WAGOinitMsg(self))
 		self.enqueue(WAGOmonitorsMsg(self))
@@ -368,6 +376,7 @@ class WAGOconnect(NetConnect):
 	max_retry_interval = None
 	timeout_interval = None
 	max_timeout_interval = None
+	window = None
 
 	long_doc="""\
 connect wago NAME [[host] port]
@@ -378,6 +387,8 @@ connect wago NAME [[host] port]
 
 	def start_up(self):
 		q = WAGOqueue(name=self.dest, host=self.host,port=self.port)
+		if self.window is not None:
+			q.window = self.window
 		if self.retry_interval is not None:
 			q.initial_connect_timeout = self.retry_interval
 		if self.max_retry_interval is not None:
@@ -409,6 +420,30 @@ keepalive ‹interval› ‹timeout›
 		except ValueError:
 			raise SyntaxError(u"Usage: %s ‹interval› ‹timeout› (#seconds, float)" % (self.name,))
 
+@WAGOconnect.register_statement
+class WAGOwindow(Statement):
+	name= "window"
+	doc="set how many commands may wait for a reply"
+
+	long_doc = u"""\
+window ‹n›
+- Send up to ‹n› commands before the first reply arrives. Replies are
+  matched to commands in order. Default: %d. Use 1 with servers that
+  cannot handle pipelined commands.
+""" % (WAGOqueue.window,)
+
+	def run(self,ctx,**k):
+		event = self.params(ctx)
+		if len(event) != 1:
+			raise SyntaxError(u"Usage: %s ‹n›" % (self.name,))
+		try:
+			n = int(event[0])
+		except ValueError:
+			n = 0
+		if n < 1:
+			raise SyntaxError(u"Usage: %s ‹n› (positive integer)" % (self.name,))
+		self.parent.window = n
+
 class WAGOconnected(Check):
 	name="connected wago"
 	doc="Test if the named wago server connection is running"
@@ -425,7 +460,7 @@ class WAGOconnected(Check):
 
 class WAGOrun(WAGOmsgBase):
 	"""Send a simple command to Wago. Base class."""
-	timeout=2
+	timeout=2 # seconds; then the command is re-sent (see .retries) or fails with NoAnswer
 
 	def send(self,conn):
 		super(WAGOrun,self).send(conn)
@@ -462,6 +497,7 @@ class WAGOioRun(WAGOrun):
 
 class WAGOinputRun(WAGOioRun):
 	"""Send a simple command read an input."""
+	retries = 2
 	@property
 	def msg(self):
 		return "i %d %d" % (self.card,self.port)
@@ -486,6 +522,7 @@ class WAGOoutputRun(WAGOioRun):
 
 class WAGOoutputInRun(WAGOioRun):
 	"""Send a simple command to read an output."""
+	retries = 2
 	@property
 	def msg(self):
 		return "I %d %d" % (self.card,self.port)
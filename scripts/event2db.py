@@ -22,6 +22,7 @@ import pprint
 import json
 from sqlmix.async_ import Db,NoData
 from time import time
+from moat.ext.graph.compress import Compressor
 
 import logging
 import sys
@@ -38,6 +39,7 @@ cf=u.config['amqp']['server']
 print(cf['host'],cf['virtualhost'])
 db=Db(**u.config['sql']['data_logger']['server'])
 prefix=u.config['sql']['data_logger']['prefix']
+UPDATE_INTERVAL=10 # seconds between updates of the type table
 
 class mon:
 	def __init__(self,u,typ,name):
@@ -47,6 +49,7 @@ class mon:
 		self.names = {}
 		self.skips = set()
 		self.f = 0
+		self.upd = {} # type id => [timestamp, n_values]
 
 	async def start(self):
 		await self.u.register_alert_async('#', self.callback, durable='log_mysql', call_conv=CC_MSG)
@@ -107,14 +110,16 @@ class mon:
 						tid = self.names[name]
 					except KeyError:
 						try:
-							tid,mode,rate = await d.DoFn("select id,method,rate from %stype where tag=${name} for update"%(prefix,), name=name,)
+							tid,mode,rate,deadband,deviation,max_gap = await d.DoFn("select id,method,rate,deadband,deviation,max_gap from %stype where tag=${name} for update"%(prefix,), name=name,)
 						except NoData:
 							tid = await d.Do("insert into %stype set tag=${name}"%(prefix,), name=name,)
 							mode = None
 							rate = 0
+							deadband = deviation = max_gap = None
 						if mode == 1:
 							self.skips.add(name)
-						tid = self.names[name] = [tid,rate,time()]
+						comp = Compressor(deadband=deadband, deviation=deviation, max_gap=max_gap)
+						tid = self.names[name] = [tid,rate,time(),comp]
 
 					else:
 						if tid[2]+tid[1] > time():
@@ -124,11 +129,10 @@ class mon:
 							continue
 					tid[2] = time()
 					if name in self.skips:
-						await d.Do("update %stype set timestamp=from_unixtime(${ts}) where id=${tid}"%(prefix,), tid=tid[0], ts=msg.timestamp, _empty=True)
+						self.updated(tid[0], msg.timestamp, 0)
 						self.f += 1
 					else:
-						self.f = await d.Do("insert into %slog set value=${value},aux_value=${aux_value},data_type=${tid},timestamp=from_unixtime(${ts})"%(prefix,), value=val,aux_value=aval,tid=tid[0], ts=msg.timestamp)
-						await d.Do("update %stype set timestamp=from_unixtime(${ts}), n_values=n_values+1 where id=${tid}"%(prefix,), tid=tid[0], ts=msg.timestamp)
+						await self.store(d, tid[0], tid[3].add(msg.timestamp, val,aval))
 						#print(dep,val,name)
 					print(" ",self.f,"\r", end="")
 					sys.stdout.flush()
@@ -141,6 +145,61 @@ class mon:
 			logger.exception("Problem processing %s", repr(body))
 			quitting.set()
 
+	async def store(self, d, tid, values):
+		"""Log the values the compressor wants to keep"""
+		for ts,val,aval in values:
+			self.f = await d.Do("insert into %slog set value=${value},aux_value=${aux_value},data_type=${tid},timestamp=from_unixtime(${ts})"%(prefix,), value=val,aux_value=aval,tid=tid, ts=ts)
+			self.updated(tid, ts, 1)
+
+	def updated(self, tid, ts, n):
+		"""Remember a type update; written by flush_updates()"""
+		u = self.upd.get(tid, None)
+		if u is None:
+			self.upd[tid] = [ts,n]
+		else:
+			u[0] = max(u[0],ts)
+			u[1] += n
+
+	async def flush_updates(self):
+		"""Write the accumulated timestamps and counters to the type table"""
+		upd,self.upd = self.upd,{}
+		if not upd:
+			return
+		async with db() as d:
+			for tid,(ts,n) in upd.items():
+				await d.Do("update %stype set timestamp=from_unixtime(${ts}), n_values=n_values+${n} where id=${tid}"%(prefix,), tid=tid, ts=ts, n=n, _empty=True)
+
+	async def flush_stale(self):
+		"""Store values the compressors have held back for longer than their max_gap"""
+		now = time()
+		async with db() as d:
+			for tid in self.names.values():
+				await self.store(d, tid[0], tid[3].flush_stale(now))
+
+	async def updater(self):
+		try:
+			while True:
+				await asyncio.sleep(UPDATE_INTERVAL)
+				await self.flush_stale()
+				await self.flush_updates()
+		except asyncio.CancelledError:
+			raise
+		except Exception:
+			logger.exception("Problem updating")
+			quitting.set()
+
+	async def stop(self):
+		"""Store the values the compressors are holding back, and update the types"""
+		async with db() as d:
+			n_in = n_out = 0
+			for tid in self.names.values():
+				comp = tid[3]
+				await self.store(d, tid[0], comp.flush())
+				n_in += comp.n_in
+				n_out += comp.n_out
+		await self.flush_updates()
+		logger.info("%d values seen, %d stored", n_in,n_out)
+
 ##################### main loop
 
 loop=None
@@ -150,8 +209,17 @@ async def mainloop():
 	await u.start()
 	m = mon(u,'topic','alert')
 	await m.start()
-	await quitting.wait()
-	await u.stop()
+	upd = asyncio.ensure_future(m.updater())
+	try:
+		await quitting.wait()
+	finally:
+		upd.cancel()
+		try:
+			await upd
+		except asyncio.CancelledError:
+			pass
+		await u.stop()
+		await m.stop()
 
 def _tilt():
 	loop.remove_signal_handler(signal.SIGINT)
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+Consume the AMQP event feed without falling behind. Used by eventlog.py.
+
+* Consumer: reads a queue with a prefetch window and acknowledges
+  messages in batches, instead of one round trip per message.
+
+* RateLimit: per-routing-key rate limiting and sampling, with bounded
+  state.
+
+* Archive: writes events to rotating JSONL files (gzip-compressed if the
+  name ends with ".gz").
+
+* Stats: counters and lag, for periodic reports.
+
+* FakeFeed: a stand-in for the broker, for testing throughput.
+"""
+
+import asyncio
+import gzip
+import json
+import os
+from collections import OrderedDict
+from time import time, strftime, gmtime
+
+import logging
+logger = logging.getLogger(__name__)
+
+PREFETCH = 500 # unacknowledged messages the broker may send us
+ACK_BATCH = 100 # acknowledge after this many messages …
+ACK_DELAY = 0.5 # … or after this many seconds
+MAX_KEYS = 10000 # per-key state to remember
+
+def decode(body, envelope, properties):
+    """\
+        Decode a message.
+        Returns (routing key, timestamp, data). The timestamp may be None.
+        """
+    ct = properties.content_type
+    if ct is not None:
+        from qbroker.codec import get_codec
+        try:
+            body = get_codec(ct).decode(body)
+        except Exception:
+            logger.debug("Could not decode %s: %s", ct, repr(body))
+    if isinstance(body,bytes):
+        body = body.decode("utf-8", errors="replace")
+    return envelope.routing_key, properties.timestamp, body
+
+class Consumer(object):
+    """\
+        Consume an AMQP queue.
+
+        At most @prefetch messages are in flight. They are acknowledged
+        in batches of @ack_batch, or after @ack_delay seconds at the latest.
+
+        @handler is called with (body, envelope, properties) for each
+        message. It must not block: the next message is only processed
+        when it returns.
+        """
+    channel = None
+    _timer = None
+
+    def __init__(self, handler, prefetch=PREFETCH, ack_batch=ACK_BATCH, ack_delay=ACK_DELAY, stats=None, loop=None):
+        self.handler = handler
+        self.prefetch = prefetch
+        self.ack_batch = max(min(ack_batch, prefetch), 1)
+        self.ack_delay = ack_delay
+        self.stats = stats
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._tag = None # highest delivery tag not yet acknowledged
+        self._pending = 0
+
+    async def start(self, channel, queue_name):
+        self.channel = channel
+        await channel.basic_qos(prefetch_count=self.prefetch, prefetch_size=0, connection_global=False)
+        await channel.basic_consume(self._on_message, queue_name=queue_name)
+
+    async def _on_message(self, channel, body, envelope, properties):
+        try:
+            self.handler(body, envelope, properties)
+        except Exception:
+            logger.exception("Problem processing %s", repr(body))
+        if self._tag is None or envelope.delivery_tag > self._tag:
+            self._tag = envelope.delivery_tag
+        self._pending += 1
+        if self._pending >= self.ack_batch:
+            await self.ack()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.ack_delay, self._ack_later)
+
+    def _ack_later(self):
+        self._timer = None
+        asyncio.ensure_future(self._ack_logged(), loop=self._loop)
+
+    async def _ack_logged(self):
+        """The timed ack. Nobody waits for it, so log any error."""
+        try:
+            await self.ack()
+        except Exception:
+            logger.exception("Could not acknowledge up to %s", self._tag)
+
+    async def ack(self):
+        """Acknowledge everything processed so far"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        n,self._pending = self._pending,0
+        try:
+            await self.channel.basic_client_ack(self._tag, multiple=True)
+        except BaseException:
+            self._pending += n # the next ack covers these
+            raise
+        if self.stats is not None:
+            self.stats.acks += 1
+            self.stats.acked += n
+
+    async def stop(self):
+        await self.ack()
+
+def _match(pattern, words):
+    """Match an AMQP topic pattern, split into words"""
+    if not pattern:
+        return not words
+    p = pattern[0]
+    if p == '#':
+        return any(_match(pattern[1:], words[i:]) for i in range(len(words)+1))
+    if not words:
+        return False
+    return (p == '*' or p == words[0]) and _match(pattern[1:], words[1:])
+
+class RateLimit(object):
+    """\
+        Decide which messages to keep, per routing key.
+
+        @rate: messages per second and key; None: unlimited.
+        @burst: how many messages may exceed the rate at once.
+        @sample: keep every Nth message of a key that passes the rate limit.
+
+        Rules for specific keys can be added with .add(); the first
+        matching rule wins. State is kept for at most @max_keys keys;
+        the least recently seen ones are forgotten.
+
+        >>> r = RateLimit(rate=1, burst=5)
+        >>> r.add("wind.#", sample=10)
+        >>> r.check("wind.speed", now)
+        'sample'
+        """
+    def __init__(self, rate=None, burst=1, sample=1, max_keys=MAX_KEYS):
+        self.rules = []
+        self.default = (rate, burst, sample)
+        self.max_keys = max_keys
+        self.keys = OrderedDict() # key => [tokens, last check, count, rule]
+
+    def add(self, pattern, rate=None, burst=1, sample=1):
+        self.rules.append((pattern.split('.'), (rate, burst, sample)))
+        self.keys.clear()
+
+    def _rule(self, key):
+        words = key.split('.')
+        for p,r in self.rules:
+            if _match(p, words):
+                return r
+        return self.default
+
+    def check(self, key, now):
+        """\
+            Returns None if the message should be kept, else the reason
+            for dropping it: 'rate' or 'sample'.
+            """
+        s = self.keys.get(key,None)
+        if s is None:
+            rule = self._rule(key)
+            s = self.keys[key] = [rule[1], now, 0, rule]
+            if len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+        else:
+            self.keys.move_to_end(key)
+        rate,burst,sample = s[3]
+        if rate is not None:
+            s[0] = min(burst, s[0] + (now-s[1])*rate)
+            s[1] = now
+            if s[0] < 1:
+                return 'rate'
+            s[0] -= 1
+        s[2] += 1
+        if sample > 1 and s[2] % sample != 1:
+            return 'sample'
+        return None
+
+def _seq_name(name, seq):
+    """Add a sequence number to a file name, before its extension"""
+    if not seq:
+        return name
+    gz = ""
+    if name.endswith(".gz"):
+        name,gz = name[:-3],".gz"
+    name,ext = os.path.splitext(name)
+    return "%s.%d%s%s" % (name,seq,ext,gz)
+
+class Archive(object):
+    """\
+        Write events to rotating JSONL files.
+
+        @path is a strftime pattern (UTC), applied when a file is opened.
+        If it ends with ".gz", the files are compressed.
+        A new file is started after @max_size bytes (uncompressed) or
+        @max_age seconds.
+
+        Existing files are not appended to. If the name is taken, a
+        sequence number is added: "ev.jsonl.gz", "ev.1.jsonl.gz", ….
+        """
+    _file = None
+
+    def __init__(self, path, max_size=None, max_age=None):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.name = None
+        self.n_files = 0
+        self._base = None
+        self._seq = 0
+
+    def _open(self, now):
+        base = strftime(self.path, gmtime(now))
+        if base != self._base:
+            self._base = base
+            self._seq = 0
+        while True:
+            self.name = _seq_name(base, self._seq)
+            if not os.path.exists(self.name):
+                break
+            self._seq += 1
+        d = os.path.dirname(self.name)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        if self.name.endswith(".gz"):
+            self._file = gzip.open(self.name, "xb")
+        else:
+            self._file = open(self.name, "xb")
+        self._opened = now
+        self._size = 0
+        self.n_files += 1
+
+    def write(self, rec, now=None):
+        if now is None:
+            now = time()
+        if self._file is not None and ((self.max_size and self._size >= self.max_size) or (self.max_age and now-self._opened >= self.max_age)):
+            self.close()
+        if self._file is None:
+            self._open(now)
+        data = (json.dumps(rec, default=str, separators=(',',':'))+"\n").encode("utf-8")
+        self._file.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class Stats(object):
+    """\
+        Counters for a feed. report() returns a summary of the last
+        interval and starts a new one; report_total() summarizes all of
+        them.
+        """
+    def __init__(self):
+        self.reset()
+        self.total = dict.fromkeys(self.FIELDS, 0)
+        self.created = self.started
+
+    FIELDS = "received written filtered rate sample acks acked".split()
+
+    def reset(self):
+        for f in self.FIELDS:
+            setattr(self,f,0)
+        self.lag_sum = 0
+        self.lag_n = 0
+        self.lag_max = 0
+        self.started = time()
+
+    def lag(self, ts, now):
+        if ts is None:
+            return
+        d = max(now-ts, 0)
+        self.lag_sum += d
+        self.lag_n += 1
+        if self.lag_max < d:
+            self.lag_max = d
+
+    @staticmethod
+    def _fmt(c, dt):
+        dt = max(dt, 0.001)
+        return "%.0f msg/s: %d in, %d out, %d filtered, %d rate-limited, %d sampled, %d acked in %d batches" % (c['received']/dt, c['received'],c['written'],c['filtered'],c['rate'],c['sample'],c['acked'],c['acks'])
+
+    def report(self):
+        res = self._fmt(vars(self), time()-self.started)
+        if self.lag_n:
+            res += "; lag %.1f avg, %.1f max" % (self.lag_sum/self.lag_n, self.lag_max)
+        for f in self.FIELDS:
+            self.total[f] += getattr(self,f)
+        self.reset()
+        return res
+
+    def report_total(self):
+        """Everything up to the last report()"""
+        return "total: " + self._fmt(self.total, self.started-self.created)
+
+class _Envelope(object):
+    def __init__(self, tag, routing_key):
+        self.delivery_tag = tag
+        self.routing_key = routing_key
+
+class _Properties(object):
+    def __init__(self, timestamp):
+        self.content_type = "application/json"
+        self.timestamp = timestamp
+
+class FakeFeed(object):
+    """\
+        Pretends to be an AMQP channel which delivers @messages,
+        (routing key, data) tuples, as fast as the consumer takes them
+        while honoring the prefetch window.
+
+        >>> f = FakeFeed(msgs)
+        >>> await consumer.start(f, "test")
+        >>> await f.run()
+        """
+    prefetch = 0
+    callback = None
+
+    def __init__(self, messages, timestamp=None, loop=None):
+        self.messages = messages
+        self.timestamp = timestamp
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.unacked = OrderedDict()
+        self.n_acks = 0
+        self.max_unacked = 0
+        self._room = asyncio.Event(loop=self._loop)
+
+    async def basic_qos(self, prefetch_count=0, **kw):
+        self.prefetch = prefetch_count
+
+    async def basic_consume(self, callback, queue_name='', **kw):
+        self.callback = callback
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        self.n_acks += 1
+        if multiple:
+            for t in list(self.unacked):
+                if t > delivery_tag:
+                    break
+                del self.unacked[t]
+        else:
+            del self.unacked[delivery_tag]
+        self._room.set()
+
+    async def run(self):
+        """Deliver all messages, then wait until they're acknowledged"""
+        from qbroker.codec.json import encode
+        tag = 0
+        for key,data in self.messages:
+            while self.prefetch and len(self.unacked) >= self.prefetch:
+                self._room.clear()
+                await self._room.wait()
+            tag += 1
+            self.unacked[tag] = True
+            if self.max_unacked < len(self.unacked):
+                self.max_unacked = len(self.unacked)
+            ts = self.timestamp if self.timestamp is not None else int(time())
+            await self.callback(self, encode(data), _Envelope(tag,key), _Properties(ts))
+        while self.unacked:
+            self._room.clear()
+            await self._room.wait()
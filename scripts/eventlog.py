@@ -14,113 +14,211 @@ from __future__ import absolute_import, print_function, division, unicode_litera
 ## Thus, please do not remove the next line, or insert any blank lines.
 ##BP
 
+"""\
+Log the AMQP event stream.
+
+Messages are read with a prefetch window and acknowledged in batches.
+Busy event types can be rate-limited or sampled; events can be archived
+to rotating JSONL files. Statistics (rate, drops, lag) are logged
+periodically.
+
+Use "--fake N" to measure throughput without a broker.
+"""
+
 import asyncio
-from qbroker.unit import Unit, CC_DATA, CC_MSG
+from qbroker.unit import Unit
 from qbroker.util.tests import load_cfg
 import signal
 import pprint
 import json
+from argparse import ArgumentParser
 from time import time
+from eventfeed import Consumer, RateLimit, Archive, Stats, FakeFeed, decode, PREFETCH, ACK_BATCH
 
 import logging
 import sys
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-import os
-if len(sys.argv) != 2:
-    print("Usage: %s cfgname" % (sys.argv[0],), file=sys.stderr)
-    sys.exit(1)
-cfg = sys.argv[1]
-u=Unit("qbroker.monitor", **load_cfg(cfg)['config'])
-u.config['amqp']['exchanges']['alert'] = "moat.event"
-cf=u.config['amqp']['server']
-print(cf['host'],cf['virtualhost'])
+STATS_INTERVAL = 60 # seconds between statistics reports
+
+def filter_event(nam, body):
+    """\
+        Clean up an event. Returns (dep,name,body), or None if the event
+        is not interesting.
+        """
+    dep = '_'
+    if nam.startswith("hass."):
+        if isinstance(body,bytes):
+            body = body.decode('utf-8')
+        try:
+            body = json.loads(body)
+        except Exception:
+            pass
+    if isinstance(body,(str,bytes,int,float,list,tuple)):
+        body = { 'raw': body, 'event':nam.split('.') }
+    else:
+        dep = '.'
+    if True:
+        body.pop("timestamp",None)
+        body.pop("steps",None)
+        body.pop("last_value",None)
+        body.pop("data",None)
+
+        if body.get('deprecated',False):
+            return None
+        try:
+            nam = body.pop("event")
+        except KeyError:
+            if nam == "hass.event" and body.get('event_type','') == 'state_changed':
+                return None
+        else:
+            if nam is None:
+                pprint.pprint(body)
+                return None
+            if nam[0] == "wait":
+                return None
+            if len(nam) > 2 and nam[0] == 'hass' and nam[1] == 'state' and nam[-1] != 'state':
+                return None
+            if len(nam) == 4 and nam[0] == "ets" and nam[1] == "meter" and nam[2] in {"EG","UG","OG"} and nam[3] in {"P","P1","P2","P3", "I","I1","I2","I3", "W","W1","W2","W3", "U1","U2","U3", "phi1","phi2","phi3", "VAr","VAr1","VAr2","VAr3"}:
+                return None
+            if len(nam) == 5 and nam[0] == "monitor" and nam[1] == "update" and nam[2] == "temperatur" and nam[3] in {"aussen","heizung","wasser","unten"} and nam[4] in {"kessel","dach","pumpe","saeule","vorne","hinten","vorlauf","ruecklauf"}:
+                return None
+            if len(nam) >= 3 and nam[0] == "monitor" and nam[1] == "update" and body.get('value_delta',-1) == 0:
+                return None
+            nam = ' '.join(nam)
+        if nam in {
+                "monitor update wind dir",
+                "monitor update wind speed",
+                "monitor update light",
+                }:
+            return None
+        if nam == "hass.event" and body.get('event_type','') == 'call_service':
+            ed = body['event_data']
+            if ed.get('domain','') == "mqtt" and ed.get('service','') == 'publish':
+                return None
+    return dep,nam,body
 
 class mon:
-    def __init__(self,u,typ,name):
+    def __init__(self, u, name, limit=None, archive=None, quiet=False, stats=None):
         self.u = u
-        self.typ = typ
-        self.name = u.config['amqp']['exchanges'][name]
-        self.names = {}
-        self.skips = set()
-        self.f = 0
+        self.name = name
+        self.limit = limit
+        self.archive = archive
+        self.quiet = quiet
+        self.stats = stats if stats is not None else Stats()
 
-    async def start(self):
-        await self.u.register_alert_async('#', self.callback, durable=False, call_conv=CC_MSG)
-
-    #async def callback(self, channel,body,envelope,properties):
-    async def callback(self, msg):
-        try:
-            dep = '_'
-            body = msg.data
-            nam = msg.routing_key
-            if nam.startswith("hass."):
-                if isinstance(body,bytes):
-                    body = body.decode('utf-8')
-                try:
-                    body = json.loads(body)
-                except Exception:
-                    pass
-            if isinstance(body,(str,bytes,int,float,list,tuple)):
-                body = { 'raw': body, 'event':nam.split('.') }
-            else:
-                dep = '.'
-            if True:
-                body.pop("timestamp",None)
-                body.pop("steps",None)
-                body.pop("last_value",None)
-                body.pop("data",None)
-
-                if body.get('deprecated',False):
-                    return
-                try:
-                    nam = body.pop("event")
-                except KeyError:
-                    if nam == "hass.event" and body.get('event_type','') == 'state_changed':
-                        return
-                else:
-                    if nam is None:
-                        pprint.pprint(body)
-                        return
-                    if nam[0] == "wait":
-                        return
-                    if len(nam) > 2 and nam[0] == 'hass' and nam[1] == 'state' and nam[-1] != 'state':
-                        return
-                    if len(nam) == 4 and nam[0] == "ets" and nam[1] == "meter" and nam[2] in {"EG","UG","OG"} and nam[3] in {"P","P1","P2","P3", "I","I1","I2","I3", "W","W1","W2","W3", "U1","U2","U3", "phi1","phi2","phi3", "VAr","VAr1","VAr2","VAr3"}:
-                        return
-                    if len(nam) == 5 and nam[0] == "monitor" and nam[1] == "update" and nam[2] == "temperatur" and nam[3] in {"aussen","heizung","wasser","unten"} and nam[4] in {"kessel","dach","pumpe","saeule","vorne","hinten","vorlauf","ruecklauf"}:
-                        return
-                    if len(nam) >= 3 and nam[0] == "monitor" and nam[1] == "update" and body.get('value_delta',-1) == 0:
-                        return
-                    nam = ' '.join(nam)
-                if nam in {
-                        "monitor update wind dir",
-                        "monitor update wind speed",
-                        "monitor update light",
-                        }:
-                    return
-                if nam == "hass.event" and body.get('event_type','') == 'call_service':
-                    ed = body['event_data']
-                    if ed.get('domain','') == "mqtt" and ed.get('service','') == 'publish':
-                        return
+    async def start(self, consumer):
+        channel = (await self.u.conn.amqp.channel())
+        await channel.exchange_declare(self.name, 'topic', passive=True)
+        q = (await channel.queue_declare('', auto_delete=True, passive=False, exclusive=True))
+        await channel.queue_bind(q['queue'], self.name, routing_key='#')
+        await consumer.start(channel, q['queue'])
 
+    def handle(self, body, envelope, properties):
+        """Process one message. Called by the Consumer."""
+        now = time()
+        key,ts,body = decode(body, envelope, properties)
+        st = self.stats
+        st.received += 1
+        st.lag(ts, now)
+        if self.limit is not None:
+            why = self.limit.check(key, now)
+            if why is not None:
+                setattr(st, why, getattr(st, why)+1)
+                return
+        r = filter_event(key, body)
+        if r is None:
+            st.filtered += 1
+            return
+        dep,nam,body = r
+        st.written += 1
+        if self.archive is not None:
+            self.archive.write({'ts':ts, 'key':key, 'event':nam, 'data':body}, now)
+        if not self.quiet:
             print(dep,nam,body)
-        except Exception as exc:
-            logger.exception("Problem processing %s", repr(body))
-            quitting.set()
+
+    def report(self):
+        if self.archive is not None:
+            self.archive.flush()
+        logger.info("%s", self.stats.report())
+
+    async def reporter(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.report()
 
 ##################### main loop
 
 loop=None
 quitting=None
 
-async def mainloop():
-    await u.start()
-    m = mon(u,'topic','alert')
-    await m.start()
-    await quitting.wait()
-    await u.stop()
+def get_options():
+    p = ArgumentParser(description="Log the AMQP event stream")
+    p.add_argument("cfg", nargs='?', help="config file")
+    p.add_argument("-p","--prefetch", type=int, default=PREFETCH, help="messages in flight (default %(default)s)")
+    p.add_argument("-b","--ack-batch", type=int, default=ACK_BATCH, help="acknowledge this many messages at once (default %(default)s)")
+    p.add_argument("-r","--rate", type=float, help="max messages per second and routing key")
+    p.add_argument("--burst", type=int, default=10, help="messages which may exceed the rate (default %(default)s)")
+    p.add_argument("-s","--sample", type=int, default=1, help="keep every Nth message of a routing key")
+    p.add_argument("-l","--limit", action="append", default=[], metavar="KEY=RATE[/SAMPLE]", help="rate and sampling for routing keys matching this pattern")
+    p.add_argument("-a","--archive", help="archive to this file (strftime pattern; compressed if it ends with .gz)")
+    p.add_argument("--max-size", type=int, default=100*1024*1024, help="rotate the archive after this many bytes")
+    p.add_argument("--max-age", type=int, default=86400, help="rotate the archive after this many seconds")
+    p.add_argument("-S","--stats", type=float, default=STATS_INTERVAL, help="seconds between statistics reports")
+    p.add_argument("-q","--quiet", action="store_true", help="don't print events")
+    p.add_argument("--fake", type=int, metavar="N", help="don't connect; process N generated messages and report throughput")
+    opts = p.parse_args()
+    if opts.cfg is None and opts.fake is None:
+        p.error("You need a config file")
+    return opts
+
+def get_limit(opts):
+    if opts.rate is None and opts.sample == 1 and not opts.limit:
+        return None
+    limit = RateLimit(rate=opts.rate, burst=opts.burst, sample=opts.sample)
+    for l in opts.limit:
+        key,r = l.split('=',1)
+        r,_,s = r.partition('/')
+        limit.add(key, rate=float(r) if r else None, burst=opts.burst, sample=int(s) if s else 1)
+    return limit
+
+async def mainloop(opts):
+    archive = Archive(opts.archive, max_size=opts.max_size, max_age=opts.max_age) if opts.archive else None
+    m = mon(None, None, limit=get_limit(opts), archive=archive, quiet=opts.quiet)
+    c = Consumer(m.handle, prefetch=opts.prefetch, ack_batch=opts.ack_batch, stats=m.stats, loop=loop)
+    rep = asyncio.ensure_future(m.reporter(opts.stats), loop=loop)
+    try:
+        if opts.fake is not None:
+            await fake(c, opts.fake)
+            return
+        cfg = load_cfg(opts.cfg)['config']
+        cfg['amqp']['exchanges']['alert'] = "moat.event"
+        m.u = Unit("qbroker.monitor", **cfg)
+        m.name = m.u.config['amqp']['exchanges']['alert']
+        cf=m.u.config['amqp']['server']
+        print(cf['host'],cf['virtualhost'])
+        await m.u.start()
+        await m.start(c)
+        await quitting.wait()
+        await c.stop()
+        await m.u.stop()
+    finally:
+        rep.cancel()
+        m.report()
+        logger.info("%s", m.stats.report_total())
+        if archive is not None:
+            archive.close()
+
+async def fake(c, n):
+    """Feed @n generated messages through the consumer"""
+    msgs = (("monitor.update.temp.%d" % (i%50,), {'event':['monitor','update','temp',str(i%50)], 'value':i}) for i in range(n))
+    f = FakeFeed(msgs, loop=loop)
+    await c.start(f, "fake")
+    t = time()
+    await f.run()
+    t = time()-t
+    logger.info("%d messages in %.3f sec: %.0f msg/s, %d acks, max %d in flight", n, t, n/t, f.n_acks, f.max_unacked)
 
 def _tilt():
     loop.remove_signal_handler(signal.SIGINT)
@@ -130,12 +228,12 @@ def _tilt():
 def main():
     global loop
     global quitting
+    opts = get_options()
     loop = asyncio.get_event_loop()
     quitting = asyncio.Event(loop=loop)
     loop.add_signal_handler(signal.SIGINT,_tilt)
     loop.add_signal_handler(signal.SIGTERM,_tilt)
-    loop.run_until_complete(mainloop())
+    loop.run_until_complete(mainloop(opts))
 
 if __name__ == '__main__':
     main()
-
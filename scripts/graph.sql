@@ -14,6 +14,10 @@ CREATE TABLE `data_type` (
   `display_unit` char(10) NULL,
   `display_factor` double(40,10) NOT NULL default 1,
   `n_values` int(11) NOT NULL default 0,
+  # Compression before logging (scripts/event2db.py), NULL: none
+  `deadband` double(40,10) DEFAULT NULL, # drop changes up to this much
+  `deviation` double(40,10) DEFAULT NULL, # swinging door
+  `max_gap` int(11) DEFAULT NULL, # seconds; log a value at least this often
   # NULL  newly created
   # zero  ignored
   # 1     ignored and to-be-deleted
@@ -76,3 +80,16 @@ CREATE TABLE `data_agg` (
   CONSTRAINT `data_agg_type` FOREIGN KEY (`data_agg_type`) REFERENCES `data_agg_type` (`id`)
 );
 
+
+# Optional: partition data_log and data_agg by time, so that expired data
+# can be discarded by dropping whole partitions ("moat graph partition").
+# MySQL requires the partitioning column to be part of every unique key
+# and does not support foreign keys on partitioned tables, thus:
+#
+# ALTER TABLE `data_log` DROP FOREIGN KEY `data_log_ibfk_1`,
+#   DROP PRIMARY KEY, ADD PRIMARY KEY (`id`,`timestamp`);
+# ALTER TABLE `data_agg` DROP FOREIGN KEY `data_agg_type`,
+#   DROP PRIMARY KEY, ADD PRIMARY KEY (`id`,`timestamp`),
+#   DROP KEY `data_agg_tsc`, ADD UNIQUE KEY `data_agg_tsc` (`data_agg_type`,`tsc`,`timestamp`);
+#
+# then run "moat graph partition --init -t data_log" (and "-t data_agg").
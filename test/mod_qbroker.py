@@ -89,6 +89,9 @@ connect qbroker foo localhost:
 	vhost "/test"
 	app test moat
 	codec application "json+obj"
+	filter wait
+	context state
+	queue 100 oldest
 log ERROR connected
 try:
 	wait shutdown:
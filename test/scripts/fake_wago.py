@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+"""\
+A fake WAGO server, for throughput and timeout tests.
+
+It understands a subset of the protocol (i/I/s/c, m, D…) and answers
+each command, in order, after a configurable latency.
+
+	fake_wago.py -p 59069 -l 0.01       # run a server
+	fake_wago.py -l 0.01 --bench 1000   # measure reads/sec per window size
+"""
+
+import os
+import sys
+import socket
+import gevent
+from gevent.server import StreamServer
+from gevent.queue import Queue
+from time import time
+
+class FakeWAGO(object):
+	"""\
+		A line server which answers like a WAGO controller would.
+
+		@latency: seconds between receiving a command and replying
+		@slow: (n,delay): every n'th reply is delayed by that much more.
+		       As replies are sent in order, the following ones wait too.
+		"""
+	def __init__(self, port=0, latency=0, slow=None, host="localhost"):
+		self.latency = latency
+		self.slow = slow
+		self.ports = {}
+		self.n_cmds = 0
+		self.n_timed = 0
+		self.server = StreamServer((host,port), self._conn)
+
+	@property
+	def port(self):
+		return self.server.server_port
+
+	def start(self):
+		self.server.start()
+
+	def stop(self):
+		self.server.stop()
+
+	def _conn(self, sock, addr):
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		q = Queue()
+		w = gevent.spawn(self._writer, sock,q)
+		q.put((0,"* fake WAGO server\n"))
+		try:
+			for line in sock.makefile("r"):
+				t = time()+self.latency
+				self.n_cmds += 1
+				if self.slow and self.n_cmds % self.slow[0] == 0:
+					t += self.slow[1]
+				q.put((t,self.reply(line.strip(),q)))
+		finally:
+			q.put(None)
+			w.join()
+			sock.close()
+
+	def _writer(self, sock,q):
+		while True:
+			r = q.get()
+			if r is None:
+				return
+			t,txt = r
+			t -= time()
+			if t > 0:
+				gevent.sleep(t)
+			try:
+				sock.sendall(txt.encode("utf-8"))
+			except socket.error:
+				return # the client went away
+
+	def reply(self, line,q):
+		"""Return the reply to a command line"""
+		cmd = line.split()
+		if not cmd:
+			return "?empty\n"
+		if cmd[0] == "m":
+			return "=\n.\n"
+		if cmd[0].startswith("D"):
+			return "+\n"
+		try:
+			card,port = int(cmd[1]),int(cmd[2])
+		except (IndexError,ValueError):
+			return "?bad command: %s\n" % (line,)
+		if cmd[0] in ("i","I"):
+			return "+%d\n" % (self.ports.get((card,port),0),)
+		if cmd[0] in ("s","c"):
+			self.ports[(card,port)] = int(cmd[0] == "s")
+			if len(cmd) < 4:
+				return "+\n"
+			self.n_timed += 1
+			n = self.n_timed
+			def revert():
+				self.ports[(card,port)] = int(cmd[0] != "s")
+				q.put((0,"!-%d\n" % (n,)))
+			gevent.spawn_later(float(cmd[3]), revert)
+			return "!+%d\n" % (n,)
+		return "?unknown: %s\n" % (line,)
+
+def bench(srv, n, windows):
+	"""Read an input @n times, concurrently, with each window size"""
+	from moat.base import Name
+	from modules.wago import WAGOqueue,WAGOinputRun
+
+	srv.ports[(1,1)] = 1
+	for w in windows:
+		q = WAGOqueue(name=Name("bench",str(w)), host="localhost",port=srv.port)
+		q.window = w
+		while q.state != "connected" or q.n_outq or q.is_open:
+			gevent.sleep(0.01)
+
+		def read():
+			msg = WAGOinputRun(1,1)
+			q.enqueue(msg)
+			res = msg.result.get()
+			assert res == "1", res
+
+		t = time()
+		gevent.joinall([gevent.spawn(read) for _ in range(n)], raise_error=True)
+		t = time()-t
+		print("window %3d: %d reads in %.3fs, %.0f/s; %d timeouts, %d late" % (w,n,t,n/t, q.n_timeouts,q.n_late))
+		q.delete()
+
+if __name__ == "__main__":
+	from argparse import ArgumentParser
+	p = ArgumentParser(description="fake WAGO server")
+	p.add_argument("-p","--port", type=int, default=59069)
+	p.add_argument("-l","--latency", type=float, default=0)
+	p.add_argument("-s","--slow", nargs=2, type=float, metavar=("N","DELAY"), help="delay every N'th reply")
+	p.add_argument("-b","--bench", type=int, metavar="N", help="run N reads against an in-process server")
+	p.add_argument("-w","--window", type=int, action="append", help="window size(s) to benchmark")
+	a = p.parse_args()
+
+	slow = (int(a.slow[0]),a.slow[1]) if a.slow else None
+	if a.bench:
+		sys.path.insert(0, os.path.join(os.path.dirname(__file__),os.pardir,os.pardir))
+		srv = FakeWAGO(0, latency=a.latency, slow=slow)
+		srv.start()
+		bench(srv, a.bench, a.window or (1,2,8,32))
+	else:
+		srv = FakeWAGO(a.port, latency=a.latency, slow=slow)
+		srv.server.serve_forever()
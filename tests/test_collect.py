@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import pytest
+from time import time
+
+from moat.base import Name
+from moat.collect import Collection,Collected,NameIndex,get_collect,collections,CKeyError,CCollError
+
+class Outputs(Collection):
+	name = "test output"
+Outputs = Outputs()
+Outputs.does("del")
+
+class Output(Collected):
+	storage = Outputs.storage
+
+class Monitors(Collection):
+	name = "test output monitor"
+Monitors = Monitors()
+
+class Monitor(Collected):
+	storage = Monitors.storage
+
+def old_get_collect(name, allow_collection=False):
+	"""The previous implementation, for comparison"""
+	coll = collections
+	while len(name):
+		n = len(name)
+		while n > 0:
+			try:
+				coll = coll[Name(*name[:n])]
+			except KeyError:
+				n = n-1
+			else:
+				name = name[n:]
+				break
+		if n == 0:
+			coll = coll[name[0]]
+			name = name[1:]
+	return coll
+
+def test_index():
+	i = NameIndex()
+	i.add(Name("a","b"),1)
+	i.add(Name("a"),2)
+	i.add("c",3)
+	assert i.longest(("a","b","x")) == (1,2)
+	assert i.longest(("a","x")) == (2,1)
+	assert i.longest(("x","a","b"),1) == (1,3)
+	assert i.longest(("c",)) == (3,1)
+	assert i.longest(("b",)) == (None,0)
+	i.remove(Name("a","b"))
+	assert i.longest(("a","b")) == (2,1)
+	i.remove(Name("a"))
+	assert "a" not in i.root
+
+def test_collect():
+	o = Output("foo","bar")
+	o2 = Output("foo")
+	m = Monitor("foo","bar","baz")
+	try:
+		assert get_collect(("test","output","foo","bar")) is o
+		assert get_collect(("test","output","foo")) is o2
+		assert get_collect(("test","output","monitor","foo","bar","baz")) is m
+		assert get_collect(("test","output","*"), allow_collection=True) is Outputs
+		assert get_collect(("test","output"), allow_collection=True) is Outputs
+		with pytest.raises(CKeyError):
+			get_collect(("test","output","nope"))
+		with pytest.raises(CCollError):
+			get_collect(("test","output"))
+		o.delete()
+		with pytest.raises(CKeyError):
+			get_collect(("test","output","foo","bar","x"))
+	finally:
+		for x in (o,o2,m):
+			if x.name in x.storage:
+				x.delete()
+
+def test_collect_on():
+	"""Handlers are also found by their arguments and by their ID"""
+	from moat.event_hook import OnEventBase
+	h = OnEventBase(None, Name("fuß"), name=Name("Schau","auf","die","Füße"))
+	h2 = OnEventBase(None, Name("num","1"))
+	try:
+		assert get_collect(("on","Schau","auf","die","Füße")) is h
+		assert get_collect(("on","fuß")) is h
+		assert get_collect(("on",h.id)) is h
+		assert get_collect(("on","num","1")) is h2
+		assert get_collect(("on",h2.id)) is h2
+		with pytest.raises(CKeyError):
+			get_collect(("on","nope"))
+
+		# del on <args>
+		get_collect(("on","fuß")).delete()
+		with pytest.raises(CKeyError):
+			get_collect(("on","fuß"))
+		# del on <id>
+		get_collect(("on",h2.id)).delete()
+		with pytest.raises(CKeyError):
+			get_collect(("on","num","1"))
+	finally:
+		for x in (h,h2):
+			if x.name in x.storage:
+				x.delete()
+
+def test_collect_bench():
+	"""Compare with the previous implementation; not a pass/fail test"""
+	N = 10000
+	objs = []
+	for i in range(N):
+		objs.append(Output("room%d"%(i//10),"light",str(i%10)))
+		objs.append(Monitor("room%d"%(i//10),"temp",str(i%10)))
+	names = []
+	for i in range(0,N,7):
+		names.append(("test","output","room%d"%(i//10),"light",str(i%10)))
+		names.append(("test","output","monitor","room%d"%(i//10),"temp",str(i%10)))
+	try:
+		t1 = time()
+		for n in names:
+			old_get_collect(n)
+		t2 = time()
+		for n in names:
+			get_collect(n)
+		t3 = time()
+		print("%d lookups: old %.3fs, new %.3fs" % (len(names),t2-t1,t3-t2))
+	finally:
+		for o in objs:
+			o.delete()
+
+def test_collect_many():
+	"""Many similar names resolve like the previous implementation did"""
+	N = 1000
+	objs = []
+	for i in range(N):
+		objs.append(Output("room%d"%(i//10),"light",str(i%10)))
+		objs.append(Monitor("room%d"%(i//10),"temp",str(i%10)))
+	names = []
+	for i in range(0,N,7):
+		names.append(("test","output","room%d"%(i//10),"light",str(i%10)))
+		names.append(("test","output","monitor","room%d"%(i//10),"temp",str(i%10)))
+	try:
+		for n in names:
+			assert get_collect(n) is old_get_collect(n)
+	finally:
+		for o in objs:
+			o.delete()
+	assert not Outputs._index.root
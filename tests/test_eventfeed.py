@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import asyncio
+import os
+import pytest
+import sys
+
+# eventfeed lives next to its user, scripts/eventlog.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+def test_feed_limit():
+	from eventfeed import RateLimit
+	r = RateLimit(rate=1, burst=3, max_keys=2)
+	r.add("wind.#", sample=10)
+	r.add("*.light", rate=None)
+
+	# burst, then one per second
+	assert [r.check("temp.in", 100) for _ in range(5)] == [None,None,None,'rate','rate']
+	assert r.check("temp.in", 101) is None
+	assert r.check("temp.in", 101.5) == 'rate'
+	# sampling, no rate limit
+	assert [r.check("wind.speed.avg", 100) for _ in range(21)].count(None) == 3
+	assert all(r.check("hall.light", 100) is None for _ in range(100))
+	# bounded state
+	assert len(r.keys) == 2
+	assert "temp.in" not in r.keys
+
+@pytest.mark.run_loop
+async def test_feed(loop, tmpdir):
+	import gzip, json
+	from eventfeed import Consumer, FakeFeed, Archive, Stats, decode
+	st = Stats()
+	a = Archive(str(tmpdir.join("ev-%Y.jsonl.gz")), max_size=1000)
+	seen = []
+	def handler(body, env, props):
+		key,ts,data = decode(body, env, props)
+		seen.append(env.delivery_tag)
+		st.received += 1
+		st.lag(ts, 1010)
+		a.write({'key':key, 'data':data})
+	c = Consumer(handler, prefetch=20, ack_batch=8, ack_delay=0.01, stats=st, loop=loop)
+	f = FakeFeed((("a.%d" % (i%3), {'value':i}) for i in range(100)), timestamp=1000, loop=loop)
+	await c.start(f, "test")
+	await f.run()
+	a.close()
+
+	assert seen == list(range(1,101))
+	assert f.max_unacked <= 20
+	assert f.n_acks == st.acks == 13 # 12 batches, one timed
+	assert st.acked == 100
+	assert "lag 10.0 avg" in st.report()
+	assert st.total['received'] == 100 and st.received == 0
+	assert "total: " in st.report_total() and " 100 in," in st.report_total()
+
+	# the archive was rotated into new files of bounded size
+	files = tmpdir.listdir(lambda p: p.basename.startswith("ev-"))
+	assert len(files) == a.n_files > 1
+	def seq(p):
+		n = p.basename.split('.')
+		return int(n[1]) if len(n) > 3 else 0
+	recs = []
+	for p in sorted(files, key=seq):
+		with gzip.open(str(p), "rb") as fd:
+			data = fd.read()
+		assert len(data) < 1000+100
+		recs.extend(json.loads(l) for l in data.decode("utf-8").splitlines())
+	assert [r['data']['value'] for r in recs] == list(range(100))
+	assert recs[4]['key'] == "a.1"
+
+	# a restart doesn't append to existing files
+	n = a.n_files
+	a = Archive(str(tmpdir.join("ev-%Y.jsonl.gz")), max_size=1000)
+	a.write({'key':'new'})
+	a.close()
+	assert len(tmpdir.listdir(lambda p: p.basename.startswith("ev-"))) == n+1
+	assert a.name.endswith(".%d.jsonl.gz" % n)
+
+@pytest.mark.run_loop
+async def test_feed_ack_error(loop, tmpdir, caplog):
+	from eventfeed import Consumer, FakeFeed
+	class FailAck(FakeFeed):
+		fail = True
+		async def basic_client_ack(self, delivery_tag, multiple=False):
+			if self.fail:
+				self.fail = False
+				raise RuntimeError("channel closed")
+			await super().basic_client_ack(delivery_tag, multiple)
+	c = Consumer(lambda *a: None, prefetch=20, ack_batch=8, ack_delay=0.01, loop=loop)
+	f = FailAck((("a", {'value':i}) for i in range(3)), timestamp=1000, loop=loop)
+	await c.start(f, "test")
+	run = asyncio.ensure_future(f.run(), loop=loop)
+	await asyncio.sleep(0.1, loop=loop)
+	assert "Could not acknowledge" in caplog.text
+	assert len(f.unacked) == 3
+
+	# the next ack covers the failed one
+	await c.stop()
+	await asyncio.wait_for(run, 1, loop=loop)
+	assert not f.unacked
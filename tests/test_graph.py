@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+
+import asyncio
+import pytest
+import sqlite3
+from datetime import datetime
+
+from moat.ext.graph.query import GraphQuery, Series, _layer, plan, lttb, BUCKET_POINTS
+
+class FakeDb:
+	"""Answers the queries GraphQuery sends, from in-memory tables"""
+	def __init__(self, layers, data):
+		self.layers = layers # list of dicts
+		self.data = data # agg_type id => [(ts,value,min,max)]
+		self.n_fetch = 0
+
+	async def DoSelect(self, sql, _dict=False, _empty=False, **kw):
+		if sql.startswith("select id,method from data_type"):
+			yield dict(id=1, method=2)
+		elif "from data_agg_type" in sql:
+			for l in self.layers:
+				yield l
+		elif "from data_agg " in sql:
+			self.n_fetch += 1
+			s = kw['start'].timestamp() if kw['start'].tzinfo else (kw['start']-datetime(1970,1,1)).total_seconds()
+			e = kw['end'].timestamp() if kw['end'].tzinfo else (kw['end']-datetime(1970,1,1)).total_seconds()
+			for r in self.data[kw['atid']]:
+				if s <= r[0] < e:
+					yield (datetime.utcfromtimestamp(r[0]),)+r[1:]
+		elif "from data_log" in sql:
+			pass # no raw data
+		else:
+			raise RuntimeError(sql)
+
+def test_graph_plan():
+	raw = _layer(id=None,layer=-1,interval=0,max_age=None,timestamp=None, cutoff=9000)
+	l0 = _layer(id=10,layer=0,interval=60,max_age=None,timestamp=10000, cutoff=5000)
+	l1 = _layer(id=11,layer=1,interval=3600,max_age=None,timestamp=10000)
+	ls = [raw,l0,l1]
+
+	# fine resolution: raw data, then layer 0, then layer 1
+	assert plan(ls, 0,10000, 10000) == [(raw,9000,10000),(l0,5000,9000),(l1,0,5000)]
+	# 100 seconds per point: layer 0 is good enough
+	assert plan(ls, 6000,10000, 40) == [(l0,6000,10000)]
+	# coarse: layer 1 only
+	assert plan(ls, 0,100000, 10) == [(l1,0,100000)]
+	assert plan(ls, 10,10, 10) == []
+
+def test_graph_lttb():
+	s = Series(tag="x")
+	s.extend((i, (i == 37)*10.0, -i, i) for i in range(100))
+	r = lttb(s, 12)
+	assert len(r) == 12
+	assert r.ts[0] == 0 and r.ts[-1] == 99
+	# the peak is retained
+	assert 37 in r.ts
+	assert max(r.avg) == 10.0
+	assert max(r.max) == 99
+	assert min(r.min) == -99
+	assert lttb(s, 200) is s
+
+@pytest.mark.run_loop
+async def test_graph_query(loop):
+	T = 1000000
+	l0 = dict(id=10,layer=0,interval=60,max_age=None,timestamp=datetime.utcfromtimestamp(T))
+	l1 = dict(id=11,layer=1,interval=600,max_age=3600,timestamp=datetime.utcfromtimestamp(T-1000))
+	data = {
+		10: [(t,1.0,0.5,1.5) for t in range(T-7200,T,60)], # partly expired
+		11: [(t,2.0,1.5,2.5) for t in range(0,T-1000,600)],
+	}
+	db = FakeDb([l0,l1], data)
+	q = GraphQuery(db)
+	s = await q.get("foo", T-3600*3, T, points=100)
+	# layer 1 expires layer 0 data older than T-1000-3600
+	assert s.layers == [(1,T-10800,T-4600),(0,T-4600,T)]
+	assert s.avg[0] == 2.0 and s.avg[-1] == 1.0
+	assert s.ts == sorted(s.ts)
+	assert len(s) == 10+76
+
+	# The current bucket is not cached, but older ones are
+	s = await q.get("foo", 800000,900000, points=10)
+	assert s.layers == [(1,800000,900000)]
+	n = db.n_fetch
+	s2 = await q.get("foo", 800000,900000, points=10)
+	assert s2 == s
+	assert db.n_fetch == n
+	assert q.hits > 0
+
+class PartDb:
+	"""Pretends to be a partitioned data_log, with partitions p1…p3 of @interval seconds"""
+	def __init__(self, interval=86400):
+		from moat.ext.graph.partition import part_name
+		self.parts = [(part_name(i*interval),(i+1)*interval) for i in range(3)] + [("pmax",None)]
+		self.p1,self.p2,self.p3 = (n for n,_ in self.parts[:3])
+		# partition => [(data_type,count,max_id)]
+		self.content = {self.p1: [(1,100,99),(2,10,109)], self.p2: [(1,100,209)], self.p3: [(1,5,214)]}
+		self.sql = []
+		self.scanned = []
+
+	async def DoSelect(self, sql, _dict=False, _empty=False, **kw):
+		if "information_schema.partitions" in sql:
+			for n,b in self.parts:
+				yield n, "MAXVALUE" if b is None else str(b), 0
+		elif "from data_agg_type" in sql:
+			# type 1 expires everything older than 2.5 days, type 2 has no layers
+			yield 1, datetime.utcfromtimestamp(3.5*86400), 86400, 300
+		elif "partition (" in sql:
+			p = sql[sql.index("partition (")+11:].split(")")[0]
+			self.scanned.append(p)
+			for k,n,max_id in self.content.get(p,()):
+				yield (k,n) if "count(*)" in sql else (k,max_id)
+		else:
+			raise RuntimeError(sql)
+
+	async def Do(self, sql, _empty=False, **kw):
+		self.sql.append((sql,kw))
+		if sql.startswith("alter table `data_log` drop partition "):
+			p = sql.rsplit(' ',1)[1]
+			self.parts = [x for x in self.parts if x[0] != p]
+		elif sql.startswith("alter table `data_log` reorganize"):
+			self.parts.insert(-1, ("pnew",4*86400))
+		return 1
+
+@pytest.mark.run_loop
+async def test_graph_partition(loop):
+	from moat.ext.graph.partition import expire_partitions, create_partitions
+	db = PartDb()
+	# p1 has unmanaged data, p3 is too new
+	assert await expire_partitions(db, "data_log") == [(db.p2,100)]
+	assert [p for p,_ in db.parts] == [db.p1,db.p3,"pmax"]
+	assert db.sql[-1][1] == dict(n=100,id=1)
+	# p3 is past every cutoff and thus not examined; only p2 was counted
+	assert db.scanned == [db.p1,db.p2,db.p2]
+
+	assert await create_partitions(db, "data_log", 86400, 4*86400-1) == ["p19700104_0000"]
+	assert "p19700104_0000 values less than (345600)" in db.sql[-1][0]
+	assert await create_partitions(db, "data_log", 86400, 4*86400) == []
+
+@pytest.mark.run_loop
+async def test_graph_partition_interval(loop):
+	"""Maintenance creates partitions as large as the existing ones"""
+	from moat.ext.graph.partition import partition_interval, create_partitions
+	db = PartDb(interval=3600)
+	assert db.p3 == "p19700101_0200"
+	assert await partition_interval(db, "data_log") == 3600
+	assert await create_partitions(db, "data_log", 3600, 5*3600) == ["p19700101_0300","p19700101_0400"]
+	assert "p19700101_0400 values less than (18000)" in db.sql[-1][0]
+
+def test_graph_compress():
+	from moat.ext.graph.compress import Compressor
+
+	def run(c, data):
+		res = []
+		for ts,v in data:
+			res.extend(c.add(ts,v))
+		res.extend(c.flush())
+		return res
+
+	# a ramp followed by a plateau: swinging door keeps the corners
+	data = [(t, min(t,50)*0.1) for t in range(100)]
+	c = Compressor(deviation=0.01)
+	res = run(c, data)
+	assert res == [(0,0.0),(50,5.0),(99,5.0)]
+	assert c.n_in == 100 and c.n_out == 3
+
+	# a step without time in between closes the door
+	c = Compressor(deviation=1)
+	assert c.add(0,0) == [(0,0)]
+	assert c.add(10,0) == []
+	assert c.add(10,100) == [(10,0),(10,100)]
+	assert c.add(20,100) == []
+	assert c.flush() == [(20,100)]
+	# every value is within the deviation of the interpolated line
+	for ts,v in data:
+		(t1,v1),(t2,v2) = [(a,b) for a,b in zip(res,res[1:]) if a[0] <= ts <= b[0]][0]
+		assert abs(v1+(v2-v1)*(ts-t1)/(t2-t1) - v) <= 0.01+1e-9
+
+	# deadband: noise is dropped, a step is stored with the value before it
+	data = [(t, 20+(t%2)*0.05+(t >= 30)) for t in range(60)]
+	res = run(Compressor(deadband=0.1), data)
+	assert res == [(0,20),(29,20.05),(30,21),(59,21.05)]
+
+	# maximum gap
+	res = run(Compressor(deadband=1, max_gap=25), [(t,5) for t in range(60)])
+	assert [t for t,_ in res] == [0,25,50,59]
+
+	# a held-back value is released once it is max_gap old
+	c = Compressor(deadband=1, max_gap=25)
+	assert c.add(0,5) == [(0,5)]
+	assert c.add(10,5) == []
+	assert c.flush_stale(20) == []
+	assert c.flush_stale(25) == [(10,5)]
+	assert c.flush_stale(100) == []
+	assert c.add(30,5) == []
+	assert Compressor(deadband=1).flush_stale(100) == []
+
+	# no compression
+	assert len(run(Compressor(), data)) == 60
+
+async def log_and_run(storage, values, cleanup=True):
+	"""Log @values, (tag,ts,value), then aggregate like "moat graph run" does"""
+	from moat.ext.graph.storage import log_value
+	from moat.ext.graph.process import agg_type
+	for tag,ts,v in values:
+		async with storage() as db:
+			await log_value(db, tag, v, ts)
+	todo = []
+	async with storage() as db:
+		async for d in db.DoSelect("select * from data_agg_type order by layer,timestamp", _dict=True, _empty=True):
+			todo.append(d)
+	for d in todo:
+		async with storage() as db:
+			at = agg_type(None,db)
+			await at.set(d)
+			await at.run(cleanup=cleanup)
+
+async def graph_types(storage, tags):
+	"""Two layers, one minute and ten minutes"""
+	async with storage() as db:
+		for tag in tags:
+			tid = await db.Do("insert into data_type(tag,method) values(${tag},2)", tag=tag)
+			await db.Do("insert into data_agg_type(data_type,layer,`interval`,max_age) values(${tid},0,60,600)", tid=tid)
+			await db.Do("insert into data_agg_type(data_type,layer,`interval`,max_age) values(${tid},1,600,0)", tid=tid)
+
+async def dump_agg(storage):
+	async with storage() as db:
+		return [r async for r in db.DoSelect("select data_type.tag,layer,tsc,data_agg.value,min_value,max_value,data_agg.n_values,data_agg.timestamp from data_agg join data_agg_type on data_agg_type.id=data_agg.data_agg_type join data_type on data_type.id=data_agg_type.data_type order by tag,layer,tsc", _empty=True)]
+
+def graph_values(n, tags=("temp in","temp out"), start=1500000020):
+	return [(tag, start+i*7+j, (i*13+j*5)%17+j) for i in range(n) for j,tag in enumerate(tags)]
+
+@pytest.mark.run_loop
+async def test_graph_sqlite(loop, tmpdir):
+	from moat.ext.graph.storage import open_storage
+	from moat.ext.graph.process import NoData
+	values = graph_values(500)
+	T = values[-1][1]
+
+	storage = open_storage(dict(backend="sqlite", path=str(tmpdir.join("one.db")), batch=0), loop=loop)
+	await graph_types(storage, ("temp in","temp out"))
+	await log_and_run(storage, values)
+	res = await dump_agg(storage)
+
+	# compare with the expected averages
+	for tag in ("temp in","temp out"):
+		for layer,intv in ((0,60),(1,600)):
+			exp = {}
+			for t,ts,v in values:
+				if t == tag:
+					exp.setdefault(ts//intv,[]).append(v)
+			got = [r for r in res if r[0] == tag and r[1] == layer]
+			assert [r[2] for r in got] == sorted(exp)
+			for _,_,tsc,v,mn,mx,n,ts in got:
+				e = exp[tsc]
+				assert v == pytest.approx(sum(e)/len(e))
+				assert (mn,mx,n) == (min(e),max(e),len(e))
+				assert ts <= datetime.utcfromtimestamp(T)
+
+	# raw data older than 600 seconds have been cleaned up
+	async with storage() as db:
+		n, = await db.DoFn("select count(*) from data_log")
+		assert 0 < n < len(values)
+	await storage.close()
+
+	# Batched: same result
+	storage = open_storage(dict(backend="sqlite", path=str(tmpdir.join("two.db")), batch=100), loop=loop)
+	await graph_types(storage, ("temp in","temp out"))
+	await log_and_run(storage, values)
+	assert await dump_agg(storage) == res
+	assert storage.n_commits == 0
+
+	# errors only roll back their own block
+	with pytest.raises(NoData):
+		async with storage() as db:
+			await db.Do("delete from data_agg", _empty=True)
+			await db.DoFn("select id from data_type where tag='nonexistent'")
+	assert await dump_agg(storage) == res
+	await storage.close()
+	assert storage.n_commits == 1
+
+	storage = open_storage(dict(backend="sqlite", path=str(tmpdir.join("two.db"))), loop=loop)
+	assert await dump_agg(storage) == res
+	await storage.close()
+
+@pytest.mark.run_loop
+async def test_graph_sqlite_batch(loop, tmpdir):
+	"""Logging and aggregating, with and without batched transactions"""
+	from moat.ext.graph.storage import open_storage
+	values = graph_values(1000, tags=["temp %d" % i for i in range(5)])
+	res = {}
+	for batch in (0,1):
+		storage = open_storage(dict(backend="sqlite", path=str(tmpdir.join("b%d.db" % batch)), batch=batch), loop=loop)
+		await graph_types(storage, set(t for t,_,_ in values))
+		await log_and_run(storage, values)
+		await storage.close()
+		res[batch] = storage.n_commits
+	assert res[1] < res[0]/100
+
+class FailCommit:
+	"""Wraps a sqlite3 connection. The next COMMIT fails."""
+	def __init__(self, conn):
+		self.conn = conn
+		self.fail = True
+	def execute(self, sql, *a):
+		if sql == "COMMIT" and self.fail:
+			self.fail = False
+			raise sqlite3.OperationalError("database is locked")
+		return self.conn.execute(sql, *a)
+	def __getattr__(self, k):
+		return getattr(self.conn, k)
+
+@pytest.mark.run_loop
+async def test_graph_sqlite_commit_error(loop, tmpdir):
+	"""A failed delayed commit is reported by the next transaction"""
+	from moat.ext.graph.storage import open_storage
+	storage = open_storage(dict(backend="sqlite", path=str(tmpdir.join("c.db")), batch=0.05), loop=loop)
+	storage.conn = FailCommit(storage.conn)
+	await graph_types(storage, ("temp in",))
+	await asyncio.sleep(0.2, loop=loop)
+	assert storage.n_commits == 0
+	with pytest.raises(sqlite3.OperationalError):
+		async with storage() as db:
+			pass
+	async with storage() as db:
+		n, = await db.DoFn("select count(*) from data_type")
+		assert n == 1
+	await storage.close()
+	assert storage.n_commits == 1
+
+	storage = open_storage(dict(backend="sqlite", path=str(tmpdir.join("c.db"))), loop=loop)
+	async with storage() as db:
+		n, = await db.DoFn("select count(*) from data_type")
+		assert n == 1
+	await storage.close()
+
+def test_graph_storage_unknown():
+	from moat.ext.graph.storage import open_storage
+	with pytest.raises(ValueError):
+		open_storage(dict(backend="nonexistent"))
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import asyncio
+import pytest
+from random import Random
+from time import time
+
+from etcd_tree import EtcClient, EtcRoot
+
+from moat.infra.graph import InfraGraph, VL, CDict, NoVlanError
+from moat.types.etcd import MoatInfra
+from .test_lazy import CountingEtcd
+
+def topology(n, seed=1):
+	"""\
+		A core switch with a tree of n-1 switches and hosts below it.
+		Links go both ways. Every fifth host has a VLAN set on its
+		uplink port; some hosts are special (no VLAN).
+		"""
+	rnd = Random(seed)
+	hosts = {"core.example": ["1", {}]}
+	names = ["core.example"]
+	for i in range(1,n):
+		name = "h%d.example" % (i,)
+		up = names[rnd.randrange(len(names))]
+		hosts[name] = [rnd.choice(("1","2","3,4","-","*")), {}]
+		pn = "p%d" % (len(hosts[up][1]),)
+		hosts[up][1][pn] = (str(i%7) if i%5 == 0 else None, name)
+		hosts[name][1]["up"] = (None, up)
+		names.append(name)
+	return {k:tuple(v) for k,v in hosts.items()}
+
+def old_vlans(hosts, name, seen=None):
+	"""The recursive walk of the former VlanInfo.extend()"""
+	vlans = CDict()
+	ports = {}
+	if seen is None:
+		seen = set()
+	elif name in seen:
+		return vlans,ports
+	seen.add(name)
+	vlan,pp = hosts[name]
+	if vlan is None:
+		raise NoVlanError(name)
+	v = VL(vlan)
+	if not v:
+		return vlans,ports
+	vlans |= v
+	for n,vh in pp.items():
+		v,h = vh
+		if v is not None:
+			v = VL(v)
+		elif h is None:
+			continue
+		else:
+			v,_ = old_vlans(hosts, h, seen)
+		ports[n] = (v,h)
+		vlans |= v
+	return vlans,ports
+
+def old_path(hosts, src, dest):
+	"""The BFS of the former PathCommand"""
+	todo = [src]
+	prevs = {src: None}
+	while todo:
+		h = todo.pop(0)
+		for v,r in hosts[h][1].values():
+			if r == dest:
+				res = [r]
+				while h is not None:
+					res.append(h)
+					h = prevs[h]
+				return res[::-1]
+			if r is not None and r not in prevs:
+				prevs[r] = h
+				todo.append(r)
+
+def test_infra_vlans():
+	hosts = topology(200)
+	g = InfraGraph(hosts)
+	for name in hosts:
+		vli = g.vlan_info(name)
+		vlans,ports = old_vlans(hosts,name)
+		assert vli.vlans == vlans, name
+		assert vli.ports == ports, name
+	assert g.vlan_info("h5.example") is g.vlan_info("h5.example")
+
+	with pytest.raises(NoVlanError):
+		InfraGraph({"a": (None,{})}).vlan_info("a")
+	with pytest.raises(KeyError):
+		InfraGraph({"a": ("1",{"p":(None,"b")})}).vlan_info("a")
+
+def test_infra_path():
+	hosts = topology(200)
+	g = InfraGraph(hosts)
+	for i in range(1,200,7):
+		dest = "h%d.example" % (i,)
+		assert g.path("core.example",dest) == old_path(hosts,"core.example",dest)
+		assert g.path(dest,"core.example") == old_path(hosts,dest,"core.example")
+	hosts["lost.example"] = ("1",{"p":(None,"core.example")})
+	g = InfraGraph(hosts)
+	assert g.unreachable("core.example") == ["lost.example"]
+	assert g.path("core.example","lost.example") is None
+	assert g.path("lost.example","h5.example")[:2] == ["lost.example","core.example"]
+
+def test_infra_bench():
+	hosts = topology(1000)
+	dests = ["h%d.example" % (i,) for i in range(1,1000,10)]
+
+	t1 = time()
+	for i in range(3):
+		for name in ("core.example","h10.example","h500.example"):
+			old_vlans(hosts,name)
+		for d in dests:
+			old_path(hosts,"core.example",d)
+	t2 = time()
+	g = InfraGraph(hosts)
+	for i in range(3):
+		for name in ("core.example","h10.example","h500.example"):
+			g.vlan_info(name)
+		for d in dests:
+			g.path("core.example",d)
+	t3 = time()
+	print("1000 nodes: walking %.3f sec, graph %.3f sec" % (t2-t1,t3-t2))
+	assert t3-t2 < t2-t1
+
+@pytest.mark.run_loop
+async def test_infra_tree(loop, monkeypatch):
+	class Root(EtcRoot):
+		pass
+	Root.register('infra', cls=MoatInfra)
+
+	e = CountingEtcd(loop)
+	await e.write("/infra/example/a/:host/vlan", "1")
+	await e.write("/infra/example/a/:host/ports/p1/host", "b.example")
+	await e.write("/infra/example/b/:host/vlan", "2")
+	monkeypatch.setattr("etcd_tree.etcd.Client", lambda loop=None, **k: e)
+	t = await EtcClient(loop=loop).tree('/', root_cls=Root, immediate=None, update_delay=0.01)
+	i = await t['infra']
+
+	g = await i.graph()
+	assert g.path("a.example","b.example") == ["a.example","b.example"]
+	assert sorted(g.vlan_info("a.example").vlans) == [1,2]
+	assert (await i.graph()) is g
+
+	await e.write("/infra/example/b/:host/vlan", "3")
+	await asyncio.sleep(0.1, loop=loop)
+	await t.wait()
+	assert g.stale
+	g = await i.graph()
+	assert sorted(g.vlan_info("a.example").vlans) == [1,3]
+	await t.close()
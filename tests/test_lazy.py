@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import json
+import pytest
+from time import time
+
+from etcd_tree import EtcRoot, EtcDir, EtcAwaiter, EtcClient
+
+from moat.types.etcd import recEtcDir, load_all
+from .test_snapshot import FakeEtcd
+
+class CountingEtcd(FakeEtcd):
+	"""Count requests and (approximate) response bytes"""
+	requests = 0
+	bytes = 0
+
+	async def read(self, key, **kw):
+		res = await super().read(key, **kw)
+		self.requests += 1
+		self.bytes += len(json.dumps(res._children if res.dir else res.value))
+		return res
+
+	def close(self):
+		pass
+
+class Dev(recEtcDir, EtcDir):
+	pass
+
+class Root(EtcRoot):
+	lazy = False
+Root.register('dev','*', cls=Dev)
+
+async def fill(e, n, m=20):
+	for i in range(n):
+		await e.write("/dev/d%d/temp" % (i,), str(i))
+		for j in range(m):
+			await e.write("/dev/d%d/conf/a/b/v%d" % (i,j), "x"*20)
+
+async def tree(loop, monkeypatch, e, lazy):
+	monkeypatch.setattr("etcd_tree.etcd.Client", lambda loop=None, **k: e)
+	c = EtcClient(loop=loop)
+	Root.lazy = lazy
+	return (await c.tree('/', root_cls=Root, immediate=None, static=True))
+
+@pytest.mark.run_loop
+async def test_lazy(loop, monkeypatch):
+	e = CountingEtcd(loop)
+	await fill(e,1)
+	t = await tree(loop, monkeypatch, e, True)
+	e.requests = 0
+	d = await t.subdir('dev','d0')
+	assert d['temp'] == '0'
+	assert e.requests == 4 # /dev, the device, and two levels of prefetch
+	assert type(d['conf']['a']._data['b']) is EtcAwaiter
+
+	await load_all(d)
+	assert e.requests == 5
+	assert d['conf']['a']['b']['v1'] == "x"*20
+	await t.close()
+
+@pytest.mark.run_loop
+async def test_lazy_bench(loop, monkeypatch):
+	"""Cold start of a device listing, with and without lazy loading"""
+	res = {}
+	for lazy in (False,True):
+		e = CountingEtcd(loop)
+		await fill(e,200)
+		t1 = time()
+		t = await tree(loop, monkeypatch, e, lazy)
+		d = await t['dev']
+		temps = []
+		for k in sorted(d.keys()):
+			temps.append((await d[k])['temp'])
+		res[lazy] = (e.requests, e.bytes, time()-t1)
+		assert len(temps) == 200
+		await t.close()
+	for lazy,(r,b,t) in res.items():
+		print("%s: %d requests, %d bytes, %.3f sec" % ("lazy" if lazy else "full", r,b,t))
+	assert res[True][1] < res[False][1]/2
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import pytest
+
+from moat.collect import Collection
+from moat.msg import MsgQueue,MsgBase,NoAnswer, NOT_MINE,MINE,RECV_AGAIN
+
+class Queues(Collection):
+	name = "test msg queue"
+Queues = Queues()
+Queues.does("del")
+
+class Queue(MsgQueue):
+	"""A queue without a connection: sending is done by hand"""
+	storage = Queues.storage
+	window = None
+
+	def __init__(self):
+		super(Queue,self).__init__(factory=None, name=("test","ordered"))
+		self.sent = []
+
+	def start(self):
+		pass
+
+	def is_reply(self,msg):
+		return msg.startswith("R ")
+
+	def send(self,msg):
+		"""What the handler does with an ordered message"""
+		assert msg.send(self.sent) is RECV_AGAIN
+		msg._window = self
+		msg._answered = False
+		self.inflight.append(msg)
+
+	def resend(self):
+		for mq in self.senders:
+			while mq:
+				self.send(mq.pop(0))
+
+class Cmd(MsgBase):
+	"""Its reply consists of @parts lines starting with 'R'"""
+	ordered = True
+
+	def __init__(self, name, parts=1, retries=0):
+		super(Cmd,self).__init__()
+		self.name = name
+		self.parts = parts
+		self.retries = retries
+		self.got = []
+
+	def send(self,sent):
+		sent.append(self.name)
+		return RECV_AGAIN
+
+	def recv(self,msg):
+		if not msg.startswith("R "):
+			return NOT_MINE
+		self.got.append(msg[2:])
+		if len(self.got) < self.parts:
+			return RECV_AGAIN
+		self.result.set(self.got)
+		return MINE
+
+class Monitor(Cmd):
+	"""Acknowledged by a reply, then gets indications ('I …') until 'I end'"""
+	def recv(self,msg):
+		if msg == "R ok" and not self.result.ready():
+			self.result.set(True)
+			return RECV_AGAIN
+		if msg.startswith("I "):
+			self.got.append(msg[2:])
+			return MINE if msg == "I end" else RECV_AGAIN
+		return NOT_MINE
+
+@pytest.fixture
+def q():
+	q = Queue()
+	yield q
+	q.delete()
+
+def test_ordered(q):
+	a,b,c = Cmd("a"),Cmd("b"),Cmd("c")
+	for m in (a,b,c):
+		q.send(m)
+	assert q._incoming_ordered("R 1")
+	assert a.result.get(block=False) == ["1"]
+	# unsolicited messages are not taken by the window
+	assert not q._incoming_ordered("info")
+	assert q._incoming_ordered("R 2")
+	assert q._incoming_ordered("R 3")
+	assert b.result.get(block=False) == ["2"]
+	assert c.result.get(block=False) == ["3"]
+	assert not q.inflight
+
+def test_multipart(q):
+	a,b = Cmd("a",parts=3),Cmd("b")
+	q.send(a)
+	q.send(b)
+	# the rest of a's reply must not be offered to b
+	for r in ("R 1","R 2","R 3","R 4"):
+		assert q._incoming_ordered(r)
+	assert a.result.get(block=False) == ["1","2","3"]
+	assert b.result.get(block=False) == ["4"]
+	assert not q.inflight
+	assert not any(q.receivers)
+
+def test_monitor(q):
+	q.window = 1
+	m,b = Monitor("m"),Cmd("b")
+	q.send(m)
+	assert q.n_inflight == 1
+	assert q._incoming_ordered("R ok")
+	# acknowledged: its slot is free
+	assert q.n_inflight == 0
+	q.send(b)
+	assert q._incoming_ordered("I 1")
+	# b's reply ends m's, which stays around for its indications
+	assert q._incoming_ordered("R b")
+	assert b.result.get(block=False) == ["b"]
+	assert not q.inflight
+	assert q.receivers[m.prio] == [m]
+	assert m.got == ["1"]
+
+def test_stale_reply(q):
+	a,b = Cmd("a",retries=1),Cmd("b")
+	q.send(a)
+	q.send(b)
+	q._timed_out(a)
+	assert (q.n_timeouts,q.n_retries) == (1,1)
+	assert not a.result.ready()
+	assert q.senders[a.prio] == [a]
+
+	# the late reply is skipped, so b still gets its own
+	assert not q._incoming_ordered("info")
+	assert q._incoming_ordered("R late")
+	assert q.n_late == 1
+	assert q._incoming_ordered("R b")
+	assert b.result.get(block=False) == ["b"]
+	assert not a.result.ready()
+
+	# the retry
+	q.resend()
+	assert q.sent == ["a","b","a"]
+	assert q._incoming_ordered("R a")
+	assert a.result.get(block=False) == ["a"]
+	assert not q.inflight
+
+def test_no_answer(q):
+	a = Cmd("a")
+	q.send(a)
+	q._timed_out(a)
+	assert q.n_retries == 0
+	assert not any(q.senders)
+	assert isinstance(a.result.get(block=False), NoAnswer)
+	stale = q.inflight[0]
+	assert q._incoming_ordered("R late")
+	assert stale.timer is None
+	assert not q.inflight
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import socket
+from time import time
+from threading import Thread
+
+from moat.net import LineBuffer
+
+def old_lines(buffer, val, delimiter=b"\n"):
+	"""The previous LineReceiver code, for comparison"""
+	buffer = buffer + val
+	data = []
+	while True:
+		i = buffer.find(delimiter)
+		if i < 0:
+			break
+		data.append(buffer[:i])
+		buffer = buffer[i+len(delimiter):]
+	return buffer,data
+
+def test_linebuffer():
+	b = LineBuffer(size=8)
+	assert b.feed(b"ab") == []
+	assert b.feed(b"c\nde\n\nf") == [b"abc",b"de",b""]
+	assert len(b) == 1
+	assert b.feed(b"g"*20) == []
+	assert b.feed(b"\n") == [b"f"+b"g"*20]
+	assert len(b) == 0
+
+	b = LineBuffer(delimiter=b"\r\n")
+	assert b.feed(b"a\r") == []
+	assert b.feed(b"\nb\r\n") == [b"a",b"b"]
+
+def test_linebuffer_overflow():
+	b = LineBuffer(max_length=10)
+	assert b.feed(b"ok\n"+b"x"*11) == [b"ok"]
+	assert b.overflows == 1
+	assert b.feed(b"yyy") == []
+	assert b.feed(b"zz\nfine\n") == [b"fine"]
+	assert b.overflows == 1
+	assert b.dropped == 16
+
+def test_linebuffer_chunks():
+	"""Every way of splitting the input gives the same lines"""
+	for d in (b"\n", b"\r\n"):
+		data = d.join((b"one",b"",b"three",b"four")) + d + b"part"
+		for i in range(len(data)+1):
+			for j in range(i,len(data)+1):
+				b = LineBuffer(delimiter=d, size=4)
+				buf,res = b'',[]
+				lines = []
+				for chunk in (data[:i],data[i:j],data[j:]):
+					lines.extend(b.feed(chunk))
+					buf,l = old_lines(buf,chunk,d)
+					res.extend(l)
+				assert lines == res == [b"one",b"",b"three",b"four"]
+				# the trailing partial line is kept
+				assert len(b) == len(buf) == 4
+				assert b.feed(d) == [b"part"]
+				assert len(b) == 0
+
+def test_linebuffer_crlf():
+	b = LineBuffer(delimiter=b"\r\n")
+	# a lone CR or LF is not a delimiter
+	assert b.feed(b"a\rb\nc\r") == []
+	assert b.feed(b"\n") == [b"a\rb\nc"]
+	assert b.feed(b"\r") == []
+	assert b.feed(b"\r\n") == [b"\r"]
+
+def test_linebuffer_recv_into():
+	line = b"DI 1 2 3 some more data\n"
+	N = 10000
+	a,s = socket.socketpair()
+	w = Thread(target=a.sendall, args=(line*N+b"DI 4",))
+	w.start()
+	try:
+		lb,lines = LineBuffer(size=100),[]
+		while len(lines) < N:
+			assert lb.recv_into(s,1000) > 0
+			lines.extend(lb.lines())
+		w.join()
+		a.close()
+		while lb.recv_into(s,1000):
+			lines.extend(lb.lines())
+	finally:
+		w.join()
+		a.close()
+		s.close()
+	assert lines == [line[:-1]]*N
+	assert len(lb) == 4
+
+def test_linebuffer_bench():
+	"""Throughput over a socketpair, old code vs. recv_into; not a pass/fail test"""
+	line = b"DI 1 2 3 some more data\n"
+	N = 100000
+	data = line*N
+
+	def run(read):
+		a,b = socket.socketpair()
+		w = Thread(target=a.sendall, args=(data,))
+		try:
+			t1 = time()
+			w.start()
+			n = read(b)
+			t2 = time()
+		finally:
+			w.join()
+			a.close()
+			b.close()
+		assert n == N
+		return t2-t1
+
+	def read_old(s):
+		buf,n = b'',0
+		while n < N:
+			buf,lines = old_lines(buf,s.recv(65536))
+			n += len(lines)
+		return n
+
+	def read_new(s):
+		lb,n = LineBuffer(),0
+		while n < N:
+			lb.recv_into(s,65536)
+			n += len(lb.lines())
+		return n
+
+	t_old = run(read_old)
+	t_new = run(read_new)
+	print("%d lines: old %.3fs, new %.3fs" % (N,t_old,t_new))
@@ -28,7 +28,8 @@ import pytest
 from time import time
 from moat.proto import ProtocolClient
 from qbroker.unit import Unit,CC_DATA
-from moat.ext.onewire.proto import OnewireServer
+from moat.ext.onewire.proto import OnewireServer, OnewireError
+from moat.ext.onewire.sim import OnewireSimServer, SimThermo, SimSwitch, SimCoupler, SimRoot, make_topology, run_load
 from moat.task import TASK
 import mock
 import aio_etcd as etcd
@@ -189,6 +190,63 @@ async def test_onewire_real(loop,owserver):
 					await ow.write(p,q,"temphigh", data="99")
 	await ow.close()
 
+@pytest.mark.run_loop
+async def test_onewire_sim(loop):
+	root = SimRoot()
+	b = root.bus()
+	t = b.add(SimThermo("001001001001", temperature=12.5))
+	s = b.add(SimSwitch("010101010101"))
+	c = b.add(SimCoupler("123123123123"))
+	t2 = c.aux.add(SimThermo("002002002002", temperature=42.25))
+	srv = OnewireSimServer(root, busy_rate=1, busy_count=2, loop=loop)
+	await srv.start()
+	ow = srv.client()
+	try:
+		res = await ow.dir('uncached')
+		assert res == ["bus.0","uncached"], res
+		res = await ow.dir('uncached','bus.0')
+		assert "10.001001001001" in res
+		assert "1f.123123123123" in res
+		assert "simultaneous" in res
+		res = await ow.dir('uncached','bus.0','1f.123123123123','aux')
+		assert "10.002002002002" in res
+		assert "10.001001001001" not in res
+
+		assert float(await ow.read('bus.0','10.001001001001','temperature')) == 12.5
+		t2.temperature = 10
+		await ow.write('bus.0','1f.123123123123','aux','simultaneous','temperature', data="1")
+		assert c.aux.n_converts == 1
+		assert b.n_converts == 0
+		assert float(await ow.read('bus.0','1f.123123123123','aux','10.002002002002','temperature')) == 10
+
+		assert await ow.read('bus.0','05.010101010101','sensed') == "0"
+		await ow.write('bus.0','05.010101010101','PIO', data="0")
+		assert s.val
+		assert await ow.read('uncached','bus.0','05.010101010101','sensed') == "1"
+
+		with pytest.raises(OnewireError):
+			await ow.read('bus.0','10.123456789012','temperature')
+		assert srv.stats['busy'] >= 2*srv.stats['requests']
+	finally:
+		await ow.close()
+		await srv.stop()
+
+@pytest.mark.run_loop
+async def test_onewire_sim_load(loop):
+	root = make_topology(buses=2, thermo=100, switches=20, couplers=2, per_coupler=5, seed=1)
+	srv = OnewireSimServer(root, error_rate=0.05, seed=2, loop=loop)
+	await srv.start()
+	ow = srv.client()
+	try:
+		res = await run_load(ow, rounds=2, concurrency=5, loop=loop)
+	finally:
+		await ow.close()
+		await srv.stop()
+	assert [r.name for r in res] == ["scan","poll","temperature"]*2
+	assert sum(r.ops for r in res)+sum(r.errors for r in res) == srv.stats['requests']
+	assert sum(r.errors for r in res) == srv.stats['errors']
+	assert res[-1].ops > 50
+
 @pytest.mark.run_loop
 async def test_onewire_fake(loop):
 	from etcd_tree import client
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import gevent
+from gevent.lock import Semaphore
+
+from moat.base import Name
+from moat.onewire import OWFSdevice,OWFSroot,OWFSconverter, ATTRgetmsg,ATTRsetmsg, devices
+
+class FakeOWFS(object):
+	"""\
+		Answers the messages an OWFSqueue would send to owserver.
+
+		Like a real 1wire bus, this does one thing at a time.
+		Reading "temperature" runs a conversion; "latesttemp" does not.
+		"""
+	def __init__(self, temps, conv_time=0.05, fail=False, broken=False):
+		self.name = Name("fake","owfs")
+		self.temps = temps
+		self.conv_time = conv_time
+		self.fail = fail
+		self.broken = broken # reads cannot be queued
+		self.calls = []
+		self.lock = Semaphore()
+		self.root = OWFSroot(self)
+
+	def enqueue(self,msg):
+		if self.broken and msg.path[-1] == "latesttemp":
+			raise RuntimeError("bus gone")
+		gevent.spawn(self._run,msg)
+
+	def _run(self,msg):
+		with self.lock:
+			p = msg.path
+			if isinstance(msg,ATTRsetmsg):
+				self.calls.append(("set",)+tuple(p[-2:]))
+				if self.fail:
+					res = RuntimeError("conversion failed")
+				else:
+					gevent.sleep(self.conv_time/10) # just the command
+					res = b""
+			else:
+				self.calls.append(("get",)+tuple(p[-2:]))
+				dev,attr = p[-2:]
+				if attr == "type":
+					res = b"DS18B20"
+				elif attr == "temperature":
+					gevent.sleep(self.conv_time)
+					res = ("%12.4f" % self.temps[dev]).encode("utf-8")
+				else:
+					assert attr == "latesttemp", attr
+					res = ("%12.4f" % self.temps[dev]).encode("utf-8")
+			msg.result.set(res)
+
+def make_bus(n, **kw):
+	temps = dict(("28.%012x"%(i+1), 20+i/4) for i in range(n))
+	bus = FakeOWFS(temps, **kw)
+	devs = [OWFSdevice(id=id, bus=bus, path=("bus.0",)) for id in sorted(temps)]
+	while any(d.typ is None for d in devs): # let the devices read their types
+		gevent.sleep(0.001)
+	del bus.calls[:]
+	return bus,devs
+
+def drop_devs(devs):
+	for d in devs:
+		devices.pop(d.id,None)
+
+def test_converter_one_conversion():
+	bus,devs = make_bus(10)
+	try:
+		conv = OWFSconverter(bus,("bus.0",))
+		conv.conv_time = bus.conv_time
+		jobs = [gevent.spawn(conv.get,d) for d in devs]
+		gevent.joinall(jobs, raise_error=True)
+
+		assert [j.value for j in jobs] == [bus.temps[d.bus_id] for d in devs]
+		assert bus.calls.count(("set","simultaneous","temperature")) == 1
+		assert sorted(c[1] for c in bus.calls if c[0] == "get") == sorted(bus.temps)
+		assert all(c[2] == "latesttemp" for c in bus.calls if c[0] == "get")
+		assert conv.n_conv == 1
+		assert conv.n_read == 10
+	finally:
+		drop_devs(devs)
+
+def test_converter_next_round():
+	bus,devs = make_bus(4)
+	try:
+		conv = OWFSconverter(bus,("bus.0",))
+		conv.conv_time = bus.conv_time
+		first = [gevent.spawn(conv.get,d) for d in devs[:2]]
+		gevent.sleep(conv.gather+bus.conv_time/2) # the first conversion is running
+		second = [gevent.spawn(conv.get,d) for d in devs[2:]]
+		gevent.joinall(first+second, raise_error=True)
+		assert conv.n_conv == 2
+		assert [j.value for j in first+second] == [bus.temps[d.bus_id] for d in devs]
+	finally:
+		drop_devs(devs)
+
+def test_converter_error():
+	bus,devs = make_bus(3, fail=True)
+	try:
+		conv = OWFSconverter(bus,("bus.0",))
+		jobs = [gevent.spawn(conv.get,d) for d in devs]
+		gevent.joinall(jobs)
+		for j in jobs:
+			assert isinstance(j.exception,RuntimeError)
+		assert not any(c[0] == "get" for c in bus.calls)
+		assert conv.job is None
+	finally:
+		drop_devs(devs)
+
+def test_converter_broken():
+	"""Every waiter gets the error, even if it happens unexpectedly"""
+	bus,devs = make_bus(3, broken=True)
+	try:
+		conv = OWFSconverter(bus,("bus.0",))
+		conv.conv_time = bus.conv_time
+		jobs = [gevent.spawn(conv.get,d) for d in devs]
+		gevent.joinall(jobs, timeout=5)
+		for j in jobs:
+			assert j.ready()
+			assert str(j.exception) == "bus gone"
+		assert conv.job is None
+		assert conv.n_read == 0
+	finally:
+		drop_devs(devs)
+
+def test_converter_shared():
+	"""One shared conversion instead of one per sensor"""
+	bus,devs = make_bus(20)
+	try:
+		gevent.joinall([gevent.spawn(d.get,"temperature") for d in devs], raise_error=True)
+		assert sum(1 for c in bus.calls if c[2] == "temperature") == 20
+		del bus.calls[:]
+		conv = OWFSconverter(bus,("bus.0",))
+		conv.conv_time = bus.conv_time
+		gevent.joinall([gevent.spawn(conv.get,d) for d in devs], raise_error=True)
+		assert bus.calls.count(("set","simultaneous","temperature")) == 1
+		assert not any(c[2] == "temperature" for c in bus.calls if c[0] == "get")
+	finally:
+		drop_devs(devs)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import gevent
+
+from moat.base import Name
+from moat.onewire import OWFSqueue, ATTRgetmsg,DIRmsg, devices, FULL_SCAN
+
+class FakeQueue(OWFSqueue):
+	"""\
+		An OWFSqueue which answers its messages from a fake bus tree
+		instead of talking to owserver.
+		"""
+	def __init__(self, tree, name):
+		self.tree = tree
+		self.n_dir = 0
+		super(FakeQueue,self).__init__(name=name, host="localhost",port=0, scan=False)
+
+	def start(self):
+		pass
+
+	def enqueue(self,msg):
+		if isinstance(msg,DIRmsg):
+			self.n_dir += 1
+			names = self.tree[tuple(msg.path)]
+			for n in names:
+				msg.cb(n)
+			msg.result.set(len(names))
+		else:
+			assert isinstance(msg,ATTRgetmsg) and msg.path[-1] == "type", msg
+			msg.result.set(b"DS18B20")
+
+def make_tree(n_coupler=2, n_dev=3):
+	tree = {(): ["bus.0","bus.1"], ("bus.1",): ["28.100000000000"]}
+	b0 = ["10.000000000000"]
+	for c in range(n_coupler):
+		cid = "1F.%012x" % (c+1,)
+		b0.append(cid)
+		for k in ("main","aux"):
+			tree[("bus.0",cid,k)] = ["28.%02x%02x%08x" % (c,k=="aux",i) for i in range(n_dev)]
+	tree[("bus.0",)] = b0
+	return tree
+
+def all_ids(tree):
+	return set(n.lower() for names in tree.values() for n in names if not n.startswith("bus."))
+
+def wait_up():
+	while any(d.typ is None for d in devices.values()): # reading their types
+		gevent.sleep(0.001)
+
+def cleanup(q):
+	for id in all_ids(q.tree):
+		devices.pop(id,None)
+	q.delete()
+
+def test_scan_cached():
+	tree = make_tree()
+	q = FakeQueue(tree, Name("test","scan","cached"))
+	try:
+		q._update_all()
+		wait_up()
+		assert q.n_listed == len(tree)
+		assert q.n_cached == 0
+		assert all_ids(tree) <= set(devices.keys())
+
+		q.n_dir = 0
+		q._update_all()
+		assert q.n_dir == 1 # just the top level
+		assert q.n_cached == len(tree)-1
+
+		# a new device on a coupler's branch is not seen …
+		new = "28.ffffffffffff"
+		tree[("bus.0","1F.000000000002","aux")].append(new)
+		q._update_all()
+		assert new not in devices
+
+		# … until something says that the bus has changed
+		q.invalidate(("bus.0","1F.000000000002"))
+		q.n_dir = 0
+		q._update_all()
+		assert q.n_dir == 3
+		assert new in devices
+	finally:
+		cleanup(q)
+
+def test_scan_down():
+	tree = make_tree()
+	q = FakeQueue(tree, Name("test","scan","down"))
+	try:
+		q._update_all()
+		wait_up()
+		dev = devices["28.010000000001"]
+		assert dev.path == ("bus.0","1F.000000000002","main")
+		dev.go_down()
+		assert q.dirty == set((dev.path,))
+		q.n_dir = 0
+		q._update_all()
+		assert q.n_dir == 2
+		assert not q.dirty
+	finally:
+		cleanup(q)
+
+def test_scan_full():
+	tree = make_tree(n_coupler=20, n_dev=10)
+	q = FakeQueue(tree, Name("test","scan","full"))
+	try:
+		counts = []
+		for i in range(FULL_SCAN+1):
+			q.n_dir = 0
+			q._update_all(full=(i == 3))
+			counts.append(q.n_dir)
+		print("%d branches: full scan %d DIRs, partial %d" % (len(tree),counts[0],counts[1]))
+		assert counts[0] == len(tree)
+		assert counts[3] == len(tree)
+		assert counts[FULL_SCAN] == len(tree)
+		assert set(counts[1:3]+counts[4:FULL_SCAN]) == set((1,))
+		assert dict(q._scan_list())["branches"] == len(tree)
+	finally:
+		cleanup(q)
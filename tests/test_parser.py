@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import io
+from time import time
+
+from moat.context import Context
+from moat.interpreter import Processor
+from moat.parser import Parser
+
+class Recorder(Processor):
+	"""Records the statement tree instead of running it."""
+	def __init__(self, res, depth=0):
+		super(Recorder,self).__init__()
+		self.res = res
+		self.depth = depth
+
+	def simple_statement(self,args):
+		self.res.append((self.depth,"simple",tuple(args)))
+
+	def complex_statement(self,args):
+		self.res.append((self.depth,"complex",tuple(args)))
+		return Recorder(self.res,self.depth+1)
+
+	def done(self):
+		self.res.append((self.depth,"done"))
+
+config = """\
+# a comment
+log DEBUG
+connect wago foo:
+	host "localhost"
+	port 502
+	window 8
+	# nested
+	input foo.bar:
+		name pump one
+		interval -2.5
+
+set state on $foo *bar
+wait short: for 0.5
+if exists file "/tmp/x":
+	trigger foo bar
+
+	trigger baz
+"""
+
+def parse(src, sync):
+	res = []
+	p = Parser(io.StringIO(src), Recorder(res), ctx=Context(filename="test"), sync=sync)
+	p.run()
+	return res
+
+def big_config(n):
+	res = []
+	for i in range(n):
+		res.append("on foo bar %d:\n\tname \"handler %d\"\n\tif exists state x%d:\n\t\tset state on x%d\n\ttrigger done %d\n" % (i,i,i,i,i))
+	return "".join(res)
+
+def test_sync_same_tree():
+	res = parse(config,True)
+	assert res == parse(config,False)
+	assert (1,"complex",("input","foo.bar")) in res
+	assert (0,"simple",("set","state","on","$foo","*bar")) in res
+	assert (1,"simple",("for",0.5)) in res
+
+def test_sync_file(tmpdir):
+	f = tmpdir.join("test.moat")
+	f.write(config)
+	res = []
+	p = Parser(open(str(f)), Recorder(res), ctx=Context(filename="test"))
+	assert p.sync
+	p.run()
+	assert p.p_gen is None
+	assert res == parse(config,False)
+
+	p = Parser(io.StringIO(config), Recorder([]), ctx=Context(filename="test"))
+	assert not p.sync
+
+def test_sync_bench():
+	src = big_config(1000)
+	t1 = time()
+	a = parse(src,False)
+	t2 = time()
+	b = parse(src,True)
+	t3 = time()
+	assert a == b
+	assert len(a) == 7000
+	print("%d lines: job %.3fs, sync %.3fs" % (src.count("\n"),t2-t1,t3-t2))
+
+def parse_file(path, res):
+	p = Parser(open(path), Recorder(res), ctx=Context(filename=path))
+	p.run()
+	return p
+
+def test_cache(tmpdir):
+	from moat.parsecache import set_cache
+	from moat import parsecache
+	set_cache(str(tmpdir.join("cache")))
+	try:
+		f = tmpdir.join("test.moat")
+		f.write(config)
+		a,b,c = [],[],[]
+		parse_file(str(f),a)
+		assert parsecache.cache.misses == 1
+		p = parse_file(str(f),b)
+		assert parsecache.cache.hits == 1
+		assert a == b == parse(config,True)
+		assert not p.p_stack
+
+		f.write(config+"log INFO\n")
+		parse_file(str(f),c)
+		assert parsecache.cache.misses == 2
+		assert c == b+[(0,"simple",("log","INFO"))]
+	finally:
+		set_cache(None)
+
+def test_cache_bench(tmpdir):
+	from moat.parsecache import set_cache
+	from moat import parsecache
+	set_cache(str(tmpdir.join("cache")))
+	try:
+		f = tmpdir.join("big.moat")
+		f.write(big_config(1000))
+		a,b = [],[]
+		t1 = time()
+		parse_file(str(f),a)
+		t2 = time()
+		parse_file(str(f),b)
+		t3 = time()
+		assert a == b
+		assert parsecache.cache.hits == 1
+		print("%d statements: parsed %.3fs, cached %.3fs" % (len(a),t2-t1,t3-t2))
+	finally:
+		set_cache(None)
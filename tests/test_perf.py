@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import asyncio
+import json
+import pytest
+from time import sleep
+
+from moat.task.perf import Ring, TaskPerf, start_loop_lag, stop_loop_lag
+
+def test_ring():
+	r = Ring(3)
+	assert list(r) == []
+	r.add(1); r.add(2)
+	assert list(r) == [1,2]
+	r.add(3); r.add(4)
+	assert list(r) == [2,3,4]
+	assert len(r) == 3
+	assert r.count == 4
+
+@pytest.mark.run_loop
+async def test_task_perf(loop):
+	p = TaskPerf()
+	lag = start_loop_lag(loop)
+	async def job():
+		for _ in range(3):
+			with p.iteration():
+				sleep(0.02) # busy
+				await asyncio.sleep(0.05, loop=loop) # waiting
+		return 42
+	try:
+		assert (await p.wrap(job())) == 42
+	finally:
+		stop_loop_lag()
+
+	assert p.iterations == 3
+	assert p.steps >= 4
+	assert p.busy >= 0.06
+	s = p.summary()
+	assert s['iterations'] == 3
+	assert s['wall_max'] >= 0.02
+	assert s['io_avg'] >= 0.04
+	assert s['io_avg'] < s['wall_avg']
+	assert lag._timer is None
+	assert json.loads(json.dumps(s)) == s
+
+def test_loop_lag_replace():
+	l1 = asyncio.new_event_loop()
+	l2 = asyncio.new_event_loop()
+	try:
+		lag1 = start_loop_lag(l1)
+		assert lag1._timer is not None
+		lag2 = start_loop_lag(l2)
+		assert lag2 is not lag1
+		assert lag1._timer is None
+		assert lag2._timer is not None
+		stop_loop_lag()
+		assert lag2._timer is None
+	finally:
+		l1.close()
+		l2.close()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import pytest
+import asyncio
+import qbroker
+
+@pytest.fixture
+def qb(loop):
+	"""\
+		modules.qbroker, with the test's loop as qbroker's.
+
+		Setting qbroker.loop first keeps the module's qbroker.setup() from
+		replacing the event loop policy.
+		"""
+	old = qbroker.loop
+	qbroker.loop = loop
+	try:
+		import modules.qbroker as qb
+		yield qb
+	finally:
+		qbroker.loop = old
+
+class FakeServer:
+	def __init__(self, loop):
+		self.loop = loop
+		self.sent = []
+	async def alert(self, name, **data):
+		await asyncio.sleep(0, loop=self.loop)
+		if name.endswith(".bad"):
+			raise RuntimeError(name)
+		self.sent.append((name,data))
+
+def test_match_event(qb):
+	m = qb.match_event
+	assert m([("a","b")], ("a","b","c"))
+	assert m([("x",),("a","*","c")], ("a","b","c"))
+	assert not m([("a","b","c","d")], ("a","b","c"))
+	assert not m([("a","c")], ("a","b","c"))
+	assert not m([], ("a",))
+
+def test_bridge_policies(qb):
+	with pytest.raises(ValueError):
+		qb.EventBridge(None, size=0, policy="oldest")
+
+	b = qb.EventBridge(None, size=2, policy="drop")
+	for i in range(3):
+		b.put("e%d"%i, {})
+	assert [n for n,_ in b.queue.values()] == ["e0","e1"]
+	assert (b.n_queued,b.n_dropped) == (2,1)
+
+	b = qb.EventBridge(None, size=2, policy="oldest")
+	for i in range(3):
+		b.put("e%d"%i, {})
+	assert [n for n,_ in b.queue.values()] == ["e1","e2"]
+	assert (b.n_queued,b.n_dropped) == (3,1)
+
+	b = qb.EventBridge(None, size=2, policy="coalesce")
+	b.put("a", {'v':1})
+	b.put("b", {'v':2})
+	b.put("a", {'v':3})
+	assert list(b.queue.values()) == [("a",{'v':3}),("b",{'v':2})]
+	assert b.n_coalesced == 1
+	b.put("c", {'v':4})
+	assert list(b.queue) == ["b","c"]
+	assert b.n_dropped == 1
+
+	b = qb.EventBridge(None, size=1, policy="oldest")
+	b.put("a", {})
+	b.put("b", {})
+	assert [n for n,_ in b.queue.values()] == ["b"]
+
+@pytest.mark.run_loop
+async def test_bridge_send(loop, qb, monkeypatch):
+	logged = []
+	monkeypatch.setattr(qb, "log_exc", lambda msg,err,level: logged.append(str(err)))
+	srv = FakeServer(loop)
+	b = qb.EventBridge(srv, batch=2)
+	b.put("moat.event.one", {'v':1})
+	b.put("moat.event.bad", {})
+	b._start()
+	b.put("moat.event.two", {'v':2})
+	try:
+		for _ in range(100):
+			await asyncio.sleep(0.01, loop=loop)
+			if not b.queue and b.n_sent+b.n_failed == 3:
+				break
+	finally:
+		b.task.cancel()
+	assert srv.sent == [("moat.event.one",{'v':1}),("moat.event.two",{'v':2})]
+	assert (b.n_sent,b.n_failed) == (2,1)
+	assert logged == ["moat.event.bad"]
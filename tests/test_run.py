@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import asyncio
+import pytest
+
+from etcd_tree import EtcClient
+
+from moat.cmd.run import RunCommand
+from moat.task import TASK
+from .test_lazy import CountingEtcd
+
+class Opts:
+	this = 0
+
+async def settle(loop, t):
+	await asyncio.sleep(0.1, loop=loop)
+	await t.wait()
+
+@pytest.mark.run_loop
+async def test_run_index(loop, monkeypatch):
+	e = CountingEtcd(loop)
+	for i in range(20):
+		await e.write("/task/app/scan/dev%d/%s/code" % (i,TASK), "x")
+	await e.write("/task/app/other/%s/code" % (TASK,), "x")
+	await e.write("/task/app/other/:state/foo", "x")
+	monkeypatch.setattr("etcd_tree.etcd.Client", lambda loop=None, **k: e)
+	t = await EtcClient(loop=loop).tree('/', immediate=None, update_delay=0.01)
+
+	cmd = RunCommand()
+	cmd.loop = loop
+	cmd.options = Opts()
+	cmd._setup()
+	cmd._watch(await t.subdir('task','app'), -1)
+	await cmd._scan()
+	names = sorted('/'.join(x.path[1:-1]) for x in cmd.tasks)
+	assert len(names) == 21
+	assert names[0] == "app/other"
+	assert cmd.state['tasks'] == 21
+	assert not cmd.gone
+
+	# the monitors' initial reports don't find anything new
+	await settle(loop, t)
+	await cmd._scan()
+	assert len(cmd.tasks) == 21
+
+	# Changing a task doesn't cause a rescan
+	cmd.tasks = []
+	cmd.rescan = False
+	await e.write("/task/app/scan/dev3/%s/code" % (TASK,), "y")
+	await settle(loop, t)
+	assert not cmd.rescan
+
+	# Adding one does, and only finds the new task
+	await e.write("/task/app/scan/new/%s/code" % (TASK,), "x")
+	await settle(loop, t)
+	assert cmd.rescan
+	await cmd._scan()
+	assert [x.path for x in cmd.tasks] == [('task','app','scan','new',TASK)]
+	assert cmd.state['tasks'] == 22
+
+	# Deleting a subtree drops its tasks
+	await e.delete("/task/app/scan/dev1", recursive=True)
+	await settle(loop, t)
+	assert cmd.gone == {"app/scan/dev1"}
+	assert cmd.state['tasks'] == 22
+	await cmd._scan()
+	assert cmd.state['tasks'] == 21
+	await t.close()
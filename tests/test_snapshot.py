@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division, unicode_literals
+##
+##  This file is part of MoaT, the Master of all Things.
+##
+##  MoaT is Copyright © 2007-2016 by Matthias Urlichs <matthias@urlichs.de>,
+##  it is licensed under the GPLv3. See the file `README.rst` for details,
+##  including optimistic statements by the author.
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License (included; see the file LICENSE)
+##  for more details.
+##
+##  This header is auto-generated and may self-destruct at any time,
+##  courtesy of "make update". The original is in ‘scripts/_boilerplate.py’.
+##  Thus, do not remove the next line, or insert any blank lines above.
+##BP
+
+import asyncio
+import pytest
+import aio_etcd as etcd
+
+from moat.script.snapshot import EtcSnapshot
+
+class FakeEtcd:
+	"""\
+		An in-process stand-in for etcd and its aio_etcd client.
+
+		Keeps the last @history events for watching.
+		"""
+	def __init__(self, loop, history=1000):
+		self.loop = loop
+		self.history = history
+		self.index = 1
+		self.nodes = {'/': {'key':'/', 'dir':True, 'modifiedIndex':1, 'createdIndex':1}}
+		self.events = []
+		self.reads = 0
+		self.waits = 0
+		self._waiting = []
+
+	def _children(self, key):
+		p = key.rstrip('/')+'/'
+		return sorted(k for k in self.nodes if k != key and k.startswith(p) and '/' not in k[len(p):])
+
+	def _node(self, key, recursive, top=True):
+		n = dict(self.nodes[key])
+		if n['dir'] and (top or recursive):
+			n['nodes'] = [self._node(k,recursive,False) for k in self._children(key)]
+		return n
+
+	def _result(self, action, node):
+		res = etcd.EtcdResult(action, node)
+		res.etcd_index = self.index
+		return res
+
+	def _event(self, action, node):
+		self.events.append((action,node))
+		del self.events[:-self.history]
+		w,self._waiting = self._waiting,[]
+		for f in w:
+			if not f.done():
+				f.set_result(None)
+		return self._result(action,node)
+
+	async def read(self, key, recursive=None, wait=False, waitIndex=None, **kw):
+		key = '/'+key.strip('/')
+		if not wait:
+			self.reads += 1
+			if key not in self.nodes:
+				raise etcd.EtcdKeyNotFound(key)
+			n = self._node(key, recursive)
+			if key == '/':
+				del n['key']
+			return self._result('get',n)
+		self.waits += 1
+		while True:
+			if self.events and waitIndex < self.events[0][1]['modifiedIndex']:
+				raise etcd.EtcdEventIndexCleared(waitIndex)
+			for action,node in self.events:
+				if node['modifiedIndex'] >= waitIndex and (node['key']+'/').startswith(key.rstrip('/')+'/'):
+					return self._result(action,node)
+			f = asyncio.Future(loop=self.loop)
+			self._waiting.append(f)
+			await f
+
+	async def eternal_watch(self, key, callback, index=None, recursive=None):
+		while True:
+			res = await self.read(key, wait=True, waitIndex=index, recursive=recursive)
+			index = res.modifiedIndex+1
+			callback(res)
+
+	async def write(self, key, value, dir=False, **kw):
+		self.index += 1
+		key = '/'+key.strip('/')
+		p = key.rsplit('/',1)[0] or '/'
+		while p not in self.nodes: # etcd creates these silently
+			self.nodes[p] = {'key':p, 'dir':True, 'modifiedIndex':self.index, 'createdIndex':self.index}
+			p = p.rsplit('/',1)[0] or '/'
+		n = self.nodes.get(key,None)
+		c = n['createdIndex'] if n is not None else self.index
+		n = {'key':key, 'dir':dir, 'modifiedIndex':self.index, 'createdIndex':c}
+		if not dir:
+			n['value'] = value
+		self.nodes[key] = n
+		return self._event('set',dict(n))
+
+	async def delete(self, key, recursive=None, dir=None, **kw):
+		self.index += 1
+		key = '/'+key.strip('/')
+		n = self.nodes.pop(key)
+		for k in list(self.nodes):
+			if k.startswith(key+'/'):
+				del self.nodes[k]
+		n = dict(n, modifiedIndex=self.index)
+		return self._event('delete',n)
+
+	def other(self):
+		"""Something happens elsewhere"""
+		self.index += 1
+
+class FakeConn:
+	"""The parts of etcd_tree's client that the snapshot uses"""
+	def __init__(self, client):
+		self.root = ''
+		self.client = client
+		self._trees = set()
+
+class FakeWatcher:
+	last_read = 0
+
+def flat(node, res=None):
+	if res is None:
+		res = {}
+	if node.get('dir',False):
+		for n in node.get('nodes',()):
+			flat(n,res)
+	else:
+		res[node['key']] = node['value']
+	return res
+
+def tree(res):
+	return flat({'dir':True, 'nodes':res._children})
+
+async def fill(e, n):
+	for i in range(n):
+		await e.write("/device/dev%d/temp" % (i//10,), str(i))
+	await e.write("/task/foo/bar", "baz")
+	await e.write("/meta/type/int", "int")
+
+@pytest.mark.run_loop
+async def test_snapshot_full(loop, tmpdir):
+	e = FakeEtcd(loop)
+	await fill(e,1000)
+	path = str(tmpdir.join("snap"))
+
+	c = FakeConn(e)
+	s = EtcSnapshot(path, c, loop=loop)
+	await s.start()
+	assert s.full
+	assert e.reads == 1
+	assert c.client is not e
+
+	r = await c.client.read('/device', recursive=True)
+	assert e.reads == 1
+	assert tree(r) == tree(await e.read('/device', recursive=True))
+	assert r.etcd_index == e.index
+	r = await c.client.read('/')
+	assert isinstance(r, etcd.EtcdResult) # aio_etcd's, like a real read
+	assert sorted(n.name for n in r.child_nodes) == ['device','meta','task']
+	with pytest.raises(etcd.EtcdKeyNotFound):
+		await c.client.read('/nope')
+	await s.close()
+	assert c.client is e
+
+@pytest.mark.run_loop
+async def test_snapshot_catch_up(loop, tmpdir):
+	e = FakeEtcd(loop)
+	await fill(e,100)
+	path = str(tmpdir.join("snap"))
+	s = EtcSnapshot(path, FakeConn(e), loop=loop)
+	await s.start()
+	await s.close()
+
+	await e.write("/task/foo/bar", "quux")
+	await e.delete("/device/dev3", recursive=True)
+	await e.write("/device/new/temp", "new")
+	e.reads = 0
+
+	c = FakeConn(e)
+	s = EtcSnapshot(path, c, loop=loop)
+	await s.start()
+	assert not s.full
+	assert s.n_events == 3
+	assert s.index == e.index
+	assert e.reads == 1
+	r = await c.client.read('/', recursive=True)
+	assert tree(r) == tree(await e.read('/', recursive=True))
+	assert "/device/dev3/temp" not in tree(r)
+	await s.close()
+
+@pytest.mark.run_loop
+async def test_snapshot_catch_up_timeout(loop, tmpdir):
+	e = FakeEtcd(loop)
+	await fill(e,10)
+	path = str(tmpdir.join("snap"))
+	s = EtcSnapshot(path, FakeConn(e), loop=loop)
+	await s.start()
+	await s.close()
+
+	await e.write("/task/foo/bar", "quux")
+	e.other() # never shows up under our root
+
+	c = FakeConn(e)
+	s = EtcSnapshot(path, c, loop=loop)
+	s.catchup_timeout = 0.1
+	await s.start()
+	assert s.full
+	assert s.index == e.index
+	r = await c.client.read('/', recursive=True)
+	assert tree(r) == tree(await e.read('/', recursive=True))
+	await s.close()
+
+@pytest.mark.run_loop
+async def test_snapshot_compacted(loop, tmpdir):
+	e = FakeEtcd(loop, history=10)
+	await fill(e,10)
+	path = str(tmpdir.join("snap"))
+	s = EtcSnapshot(path, FakeConn(e), loop=loop)
+	await s.start()
+	await s.close()
+
+	await fill(e,20)
+	c = FakeConn(e)
+	s = EtcSnapshot(path, c, loop=loop)
+	await s.start()
+	assert s.full
+	r = await c.client.read('/', recursive=True)
+	assert tree(r) == tree(await e.read('/', recursive=True))
+	await s.close()
+
+@pytest.mark.run_loop
+async def test_snapshot_watch(loop, tmpdir):
+	e = FakeEtcd(loop)
+	await fill(e,10)
+	c = FakeConn(e)
+	s = EtcSnapshot(str(tmpdir.join("snap")), c, loop=loop)
+	await s.start()
+
+	# our own write: read from etcd until the watcher has it
+	await c.client.write("/task/foo/bar", "changed")
+	assert s.need == e.index
+	e.reads = 0
+	r = await c.client.read("/task/foo/bar")
+	assert r.value == "changed"
+	assert e.reads == 1
+
+	await asyncio.sleep(0.05)
+	assert s.index == e.index
+	r = await c.client.read("/task/foo/bar")
+	assert r.value == "changed"
+
+	# a tree watcher is further along than the snapshot
+	w = FakeWatcher()
+	w.last_read = s.index+1
+	c._trees.add(w)
+	assert not s.current
+	c._trees.remove(w)
+	assert s.current
+
+	await s.close()